@@ -23,7 +23,7 @@ __docformat__ = 'restructuredtext'
 
 import csv, getopt, getpass, os, re, shutil, sys, UserDict, operator
 
-from roundup import date, hyperdb, roundupdb, init, password, token
+from roundup import date, hyperdb, roundupdb, init, password, token, profiler
 from roundup import __version__ as roundup_version
 import roundup.instance
 from roundup.configuration import CoreConfig
@@ -1145,11 +1145,11 @@ Erase it? Y/N: """))
             writer.writerow(fields)
 
             # all nodes for this class
-            for nodeid in cl.getnodeids():
+            for node in cl.getnodes(cl.getnodeids(), propnames):
+                nodeid = node.nodeid
                 if self.verbose:
                     sys.stdout.write('\rExporting %s - %s'%(classname, nodeid))
                     sys.stdout.flush()
-                node = cl.getnode(nodeid)
                 exp = cl.export_list(propnames, nodeid)
                 lensum = sum ([len (repr(node[p])) for p in propnames])
                 # for a safe upper bound of field length we add
@@ -1319,13 +1319,26 @@ Erase it? Y/N: """))
         return 0
 
     def do_reindex(self, args, desre=re.compile('([A-Za-z]+)([0-9]+)')):
-        ''"""Usage: reindex [classname|designator]*
+        ''"""Usage: reindex [classname|designator]* | --pending
         Re-generate a tracker's search indexes.
 
         This will re-generate the search indexes for a tracker.
         This will typically happen automatically.
+
+        With --pending, index the texts queued when the tracker's
+        "indexer_deferred" option is on, in batches of
+        "indexer_batch_size" texts each committed on its own.
         """
-        if args:
+        if args == ['--pending']:
+            count = 0
+            while 1:
+                done = self.db.indexer.index_pending()
+                if not done:
+                    break
+                self.db.commit()
+                count += done
+            print _('Indexed %(count)d queued texts')%locals()
+        elif args:
             for arg in args:
                 m = desre.match(arg)
                 if m:
@@ -1342,6 +1355,71 @@ Erase it? Y/N: """))
             self.db.reindex(show_progress=True)
         return 0
 
+    def do_expire(self, args):
+        ''"""Usage: expire [batch size]
+        Remove the sessions and one-time keys not used for a week.
+
+        They are removed in batches of "batch size" (default: the
+        tracker's "session_expiry_batch_size") each committed on its
+        own. Run this periodically (eg. from cron) when the tracker's
+        "session_expiry" option is "admin".
+        """
+        if len(args) > 1:
+            raise UsageError(_('Too many arguments supplied'))
+        batch_size = self.db.config.WEB_SESSION_EXPIRY_BATCH_SIZE
+        if args:
+            try:
+                batch_size = int(args[0])
+            except ValueError:
+                raise UsageError(_('"%(arg)s" is not a number')%{
+                    'arg': args[0]})
+        while self.db.expire_sessions(batch_size):
+            self.db.commit()
+        self.db.commit()
+        return 0
+
+    def do_profile(self, args):
+        ''"""Usage: profile [limit]
+        Report the web pages and SQL statements taking the most time.
+
+        Reads the request profiles appended to the file set by the
+        tracker's "profile_log" option while its "profile" option is
+        on, and lists the pages and SQL statements with the highest
+        total time, "limit" (default 10) of each.
+        """
+        if len(args) > 1:
+            raise UsageError(_('Too many arguments supplied'))
+        limit = 10
+        if args:
+            try:
+                limit = int(args[0])
+            except ValueError:
+                raise UsageError(_('"%(arg)s" is not a number')%{
+                    'arg': args[0]})
+        filename = self.db.config.WEB_PROFILE_LOG
+        if not filename:
+            raise UsageError(_('The tracker has no "profile_log" set'))
+        try:
+            f = open(filename)
+        except IOError, message:
+            raise UsageError(_('Cannot read the profile log: %(message)s')%{
+                'message': message})
+        try:
+            pages, statements = profiler.summarise(f, limit)
+        finally:
+            f.close()
+        print _('Pages by total time:')
+        print _('  requests     total      mean   SQL/req  SQL time  page')
+        for page, requests, seconds, count, sql_seconds in pages:
+            print '%10d %9.3f %9.3f %9.1f %9.3f  %s'%(requests, seconds,
+                seconds/requests, float(count)/requests, sql_seconds, page)
+        print
+        print _('SQL statements by total time:')
+        print _('     count     total  statement')
+        for sql, count, seconds in statements:
+            print '%10d %9.3f  %s'%(count, seconds, sql)
+        return 0
+
     def do_security(self, args):
         ''"""Usage: security [Role name]
         Display the Permissions available to one or all Roles.
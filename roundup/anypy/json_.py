@@ -0,0 +1,17 @@
+"""
+anypy.json_: json compatibility module
+
+The json module is part of the standard library since Python 2.6;
+for older versions the simplejson package provides the same API.
+Usage:
+
+    from roundup.anypy.json_ import json
+
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# vim: ts=8 sts=4 sw=4 si et
@@ -23,6 +23,7 @@ serious bugs, and is not available)
 __docformat__ = 'restructuredtext'
 
 import os, marshal, re, weakref, string, copy, time, shutil, logging
+import heapq
 
 from roundup.anypy.dbm_ import anydbm, whichdb, key_in
 
@@ -34,10 +35,7 @@ from roundup.i18n import _
 from roundup.backends.blobfiles import FileStorage
 from roundup.backends.sessions_dbm import Sessions, OneTimeKeys
 
-try:
-    from roundup.backends.indexer_xapian import Indexer
-except ImportError:
-    from roundup.backends.indexer_dbm import Indexer
+from roundup.backends.indexer_common import get_indexer
 
 def db_exists(config):
     # check for the user db
@@ -142,7 +140,9 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
       modified. Do some sort of conflict checking on the dirty stuff.
     - perhaps detect write collisions (related to above)?
     """
-    def __init__(self, config, journaltag=None):
+    dbtype = "anydbm"
+
+    def __init__(self, config, journaltag=None, base_security=None):
         """Open a hyperdatabase given a specifier to some storage.
 
         The 'storagelocator' is obtained from config.DATABASE.
@@ -156,6 +156,9 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         None, the database is opened in read-only mode: the Class.create(),
         Class.set(), Class.retire(), and Class.restore() methods are
         disabled.
+
+        If 'base_security' is given, the database gets a copy of that
+        Security instead of a new one.
         """
         FileStorage.__init__(self, config.UMASK)
         self.config, self.journaltag = config, journaltag
@@ -168,8 +171,12 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.newnodes = {}      # keep track of the new nodes by class
         self.destroyednodes = {}# keep track of the destroyed nodes by class
         self.transactions = []
-        self.indexer = Indexer(self)
-        self.security = security.Security(self)
+        self.textqueue = {}     # texts queued for deferred indexing
+        self.indexer = get_indexer(config, self)
+        if base_security is None:
+            self.security = security.Security(self)
+        else:
+            self.security = base_security.copy(self)
         os.umask(config.UMASK)
 
         # lock it
@@ -191,10 +198,14 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         self.reindex()
 
     def getSessionManager(self):
-        return Sessions(self)
+        if self.sessions is None:
+            self.sessions = Sessions(self)
+        return self.sessions
 
     def getOTKManager(self):
-        return OneTimeKeys(self)
+        if self.otks is None:
+            self.otks = OneTimeKeys(self)
+        return self.otks
 
     def reindex(self, classname=None, show_progress=False):
         if classname:
@@ -210,6 +221,9 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 for nodeid in klass.list():
                     klass.index(nodeid)
         self.indexer.save_index()
+        # with deferred indexing the texts have only been queued
+        while self.indexer.index_pending():
+            pass
 
     def __repr__(self):
         return '<back_anydbm instance at %x>'%id(self)
@@ -590,14 +604,15 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                         j[4][k] = password.JournalPassword(j[4][k])
         return journal
 
-    def getjournal(self, classname, nodeid):
-        """ get the journal for id
+    def getjournal(self, classname, nodeid, direction='ascending',
+            limit=None, offset=None, daterange=None):
+        """ get the journal for id, see hyperdb.Database.getjournal
 
             Raise IndexError if the node doesn't exist (as per history()'s
             API)
         """
-        # our journal result
-        res = []
+        # our journal result, with the dates serialised
+        journal = []
 
         # add any journal entries for transactions not committed to the
         # database
@@ -611,8 +626,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                     cache_creator = self.getuid()
                 if not cache_creation:
                     cache_creation = date.Date()
-                res.append((cache_nodeid, cache_creation, cache_creator,
-                    cache_action, cache_params))
+                journal.append((cache_nodeid, cache_creation.serialise(),
+                    cache_creator, cache_action, cache_params))
 
         # attempt to open the journal - in some rare cases, the journal may
         # not exist
@@ -624,25 +639,49 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             elif error.args[0] != 2:
                 # this isn't a "not found" error, be alarmed!
                 raise
-            if res:
-                # we have unsaved journal entries, return them
-                return self.fix_journal (classname, res)
-            raise IndexError('no such %s %s'%(classname, nodeid))
-        try:
-            journal = marshal.loads(db[nodeid])
-        except KeyError:
-            db.close()
-            if res:
-                # we have some unsaved journal entries, be happy!
-                return self.fix_journal (classname, res)
-            raise IndexError('no such %s %s'%(classname, nodeid))
-        db.close()
+            if not journal:
+                raise IndexError('no such %s %s'%(classname, nodeid))
+        else:
+            try:
+                saved = marshal.loads(db[nodeid])
+            except KeyError:
+                db.close()
+                if not journal:
+                    raise IndexError('no such %s %s'%(classname, nodeid))
+            else:
+                db.close()
+                # the saved entries come before the uncommitted ones
+                journal[0:0] = saved
 
-        # add all the saved journal entries for this node
+        # select the entries on the serialised dates, which sort like
+        # the dates, and only make up those returned
+        journal = self.select_journal(journal, direction, limit, offset,
+            daterange, date.Date.serialise)
+        res = []
         for nodeid, date_stamp, user, action, params in journal:
             res.append((nodeid, date.Date(date_stamp), user, action, params))
         return self.fix_journal (classname, res)
 
+    def select_journal(self, journal, direction='ascending', limit=None,
+            offset=None, daterange=None, stamp=lambda d: d):
+        """ Order and select the getjournal() entries of the list
+            "journal"; "stamp" converts a Date to the form of their dates.
+        """
+        date_from, date_to = self.journal_daterange(daterange)
+        if date_from is not None:
+            date_from = stamp(date_from)
+            journal = [entry for entry in journal if entry[1] >= date_from]
+        if date_to is not None:
+            date_to = stamp(date_to)
+            journal = [entry for entry in journal if entry[1] <= date_to]
+        journal.sort(key=lambda entry: tuple(entry[1:]),
+            reverse=(direction == 'descending'))
+        if offset:
+            journal = journal[offset:]
+        if limit is not None:
+            journal = journal[:limit]
+        return journal
+
     def pack(self, pack_before):
         """ Delete all journal entries except "create" before 'pack_before'.
         """
@@ -679,6 +718,50 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 db.reorganize()
             db.close()
 
+    def queue_text(self, identifier):
+        """ Queue the (classname, nodeid, property) "identifier" for
+            deferred full-text indexing. The entry is saved on commit().
+        """
+        self.textqueue[tuple(identifier)] = time.time()
+
+    def get_text_queue(self, limit=None):
+        """ Return at most "limit" queued (identifier, timestamp) entries,
+            oldest first.
+        """
+        db = self.opendb('textqueue', 'r')
+        try:
+            entries = [(tuple(key.split(':')), float(db[key]))
+                for key in db.keys()]
+        finally:
+            db.close()
+        key = lambda entry: entry[1]
+        if limit is not None:
+            # the oldest ones, without sorting the whole queue
+            return heapq.nsmallest(limit, entries, key=key)
+        entries.sort(key=key)
+        return entries
+
+    def dequeue_text(self, entries):
+        """ Remove the (identifier, timestamp) entries from the indexing
+            queue unless they've been queued again since.
+        """
+        db = self.opendb('textqueue', 'w')
+        try:
+            for identifier, stamp in entries:
+                key = ':'.join(identifier)
+                if key_in(db, key) and float(db[key]) <= stamp:
+                    del db[key]
+        finally:
+            db.close()
+
+    def doSaveTextQueue(self):
+        db = self.opendb('textqueue', 'c')
+        try:
+            for identifier, stamp in self.textqueue.iteritems():
+                db[':'.join(identifier)] = repr(stamp)
+        finally:
+            db.close()
+        self.textqueue = {}
 
     #
     # Basic transaction support
@@ -721,9 +804,14 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         for classname, nodeid in [k for k in reindex if k]:
             self.getclass(classname).index(nodeid)
 
+        # save the texts queued for deferred indexing
+        if self.textqueue:
+            self.doSaveTextQueue()
+
         # save the indexer state
         self.indexer.save_index()
 
+        self.commitSessions()
         self.clearCache()
 
     def clearCache(self):
@@ -827,15 +915,15 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             # delete temporary files
             if method == self.doStoreFile:
                 self.rollbackStoreFile(*args)
-        self.cache = {}
-        self.dirtynodes = {}
-        self.newnodes = {}
-        self.destroyednodes = {}
-        self.transactions = []
+        self.clearCache()
+        self.textqueue = {}
+        # the session and OTK stores aren't transactional
+        self.commitSessions()
 
     def close(self):
-        """ Nothing to do
+        """ Close the session and OTK stores and release the lock
         """
+        self.commitSessions()
         if self.lockfile is not None:
             locking.release_lock(self.lockfile)
             self.lockfile.close()
@@ -1120,6 +1208,25 @@ class Class(hyperdb.Class):
 
         return d[propname]
 
+    def getnodes(self, nodeids, props=None):
+        """Return an iterator over convenience wrappers for the nodes.
+
+        All the nodes are read into the node cache with a single open
+        of the class database. Nonexisting ids are skipped here and
+        raise IndexError on property access, as with getnode().
+        """
+        nodeids = list(nodeids)
+        cldb = self.db.getclassdb(self.classname)
+        try:
+            for nodeid in nodeids:
+                try:
+                    self.db.getnode(self.classname, nodeid, cldb)
+                except IndexError:
+                    pass
+        finally:
+            cldb.close()
+        return iter([hyperdb.Node(self, nodeid) for nodeid in nodeids])
+
     def set(self, nodeid, **propvalues):
         """Modify a property on an existing node of this class.
 
@@ -58,6 +58,7 @@ def connection_dict(config, dbnamestr=None):
 
 def db_nuke(config):
     """Clear all database contents and drop database itself"""
+    rdbms_common.clear_connection_pools(config)
     if db_exists(config):
         kwargs = connection_dict(config)
         conn = MySQLdb.connect(**kwargs)
@@ -210,6 +211,7 @@ class Database(Database):
             ENGINE=%s'''%self.mysql_backend)
         self.sql('''CREATE INDEX sessions_key_idx ON
             sessions(session_key)''')
+        self.create_session_time_indexes()
 
         # full-text indexing store
         self.sql('''CREATE TABLE __textids (_class VARCHAR(255),
@@ -224,6 +226,16 @@ class Database(Database):
         sql = 'insert into ids (name, num) values (%s,%s)'%(self.arg, self.arg)
         self.sql(sql, ('__textids', 1))
 
+        # deferred full-text indexing queue
+        self.create_textqueue_table()
+
+    def create_textqueue_table(self):
+        self.sql('''CREATE TABLE __textqueue (_class VARCHAR(255),
+            _itemid VARCHAR(255), _prop VARCHAR(255), _time DOUBLE)
+            ENGINE=%s'''%self.mysql_backend)
+        self.sql('CREATE INDEX __textqueue_by_props ON '
+                 '__textqueue (_class, _itemid, _prop)')
+
     def add_new_columns_v2(self):
         '''While we're adding the actor column, we need to update the
         tables to have the correct datatypes.'''
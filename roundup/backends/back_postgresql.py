@@ -7,7 +7,7 @@
 '''Postgresql backend via psycopg for Roundup.'''
 __docformat__ = 'restructuredtext'
 
-import os, shutil, time
+import os, re, shutil, time
 ISOLATION_LEVEL_READ_UNCOMMITTED = None
 ISOLATION_LEVEL_READ_COMMITTED = None
 ISOLATION_LEVEL_REPEATABLE_READ = None
@@ -65,6 +65,7 @@ def db_create(config):
 
 def db_nuke(config, fail_ok=0):
     """Clear all database contents and drop database itself"""
+    rdbms_common.clear_connection_pools(config)
     command = 'DROP DATABASE "%s"'% config.RDBMS_NAME
     logging.getLogger('roundup.hyperdb').info(command)
     db_command(config, command)
@@ -157,7 +158,9 @@ class Database(rdbms_common.Database):
     implements_intersect = 1
 
     def getSessionManager(self):
-        return Sessions(self)
+        if self.sessions is None:
+            self.sessions = Sessions(self)
+        return self.sessions
 
     def sql_open_connection(self):
         db = connection_dict(self.config, 'database')
@@ -205,6 +208,7 @@ class Database(rdbms_common.Database):
             session_value TEXT)''')
         self.sql('''CREATE INDEX sessions_key_idx ON
             sessions(session_key)''')
+        self.create_session_time_indexes()
 
         # full-text indexing store
         self.sql('CREATE SEQUENCE ___textids_ids')
@@ -218,6 +222,16 @@ class Database(rdbms_common.Database):
         self.sql('CREATE UNIQUE INDEX __textids_by_props ON '
                  '__textids (_class, _itemid, _prop)')
 
+        # deferred full-text indexing queue
+        self.create_textqueue_table()
+
+    def create_textqueue_table(self):
+        self.sql('''CREATE TABLE __textqueue (_class VARCHAR(255),
+            _itemid VARCHAR(255), _prop VARCHAR(255),
+            _time DOUBLE PRECISION)''')
+        self.sql('CREATE INDEX __textqueue_by_props ON '
+                 '__textqueue (_class, _itemid, _prop)')
+
     def fix_version_2_tables(self):
         # Convert journal date column to TIMESTAMP, params column to TEXT
         self._convert_journal_tables()
@@ -268,6 +282,43 @@ class Database(rdbms_common.Database):
         # open a new cursor for subsequent work
         self.cursor = self.conn.cursor()
 
+    # whether the statements of rdbms_common.ClassStatements are prepared
+    # on the server; switch off when connecting through a pooler that
+    # doesn't keep server sessions (eg. pgbouncer in transaction mode)
+    prepare_statements = True
+
+    def sql_prepared(self, sql, args):
+        ''' Execute the statement prepared once per connection, so that
+            the server doesn't parse and plan it again.
+        '''
+        if not self.prepare_statements:
+            return self.sql(sql, args)
+        # the names of the statements prepared on the connection (which
+        # may come from the connection pool) by statement text
+        try:
+            prepared = self.conn.roundup_prepared
+        except AttributeError:
+            prepared = {}
+            try:
+                self.conn.roundup_prepared = prepared
+            except (AttributeError, TypeError):
+                # we can't keep track of the statements
+                return self.sql(sql, args)
+        name = prepared.get(sql)
+        if name is None:
+            name = 'roundup_%d'%len(prepared)
+            params = []
+            def param(match):
+                params.append(match)
+                return '$%d'%len(params)
+            # the names differ between connections, so the profile
+            # records the statement text
+            self.sql('PREPARE %s AS %s'%(name, re.sub('%s', param, sql)),
+                statement='PREPARE '+sql)
+            prepared[sql] = name
+        self.sql('EXECUTE %s (%s)'%(name, ','.join([self.arg]*len(args))),
+            args, statement=sql)
+
     def sql_stringquote(self, value):
         ''' psycopg.QuotedString returns a "buffer" object with the
             single-quotes around it... '''
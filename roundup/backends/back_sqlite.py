@@ -31,6 +31,7 @@ def db_exists(config):
     return os.path.exists(os.path.join(config.DATABASE, 'db'))
 
 def db_nuke(config):
+    rdbms_common.clear_connection_pools(config)
     shutil.rmtree(config.DATABASE)
 
 class Database(rdbms_common.Database):
@@ -106,7 +107,12 @@ class Database(rdbms_common.Database):
             conn = sqlite.connect(db=db)
             conn.db.sqlite_busy_handler(self.sqlite_busy_handler)
         else:
-            conn = sqlite.connect(db, timeout=self.config.RDBMS_SQLITE_TIMEOUT)
+            kwargs = {}
+            if self.connection_pool is not None:
+                # pooled connections may be used by other threads
+                kwargs['check_same_thread'] = False
+            conn = sqlite.connect(db, timeout=self.config.RDBMS_SQLITE_TIMEOUT,
+                **kwargs)
             conn.row_factory = sqlite.Row
 
         # pysqlite2 / sqlite3 want us to store Unicode in the db but
@@ -143,6 +149,7 @@ class Database(rdbms_common.Database):
             'session_time integer, session_value varchar)')
         self.sql('create index sessions_key_idx on '
                 'sessions(session_key)')
+        self.create_session_time_indexes()
 
         # full-text indexing store
         self.sql('CREATE TABLE __textids (_class varchar, '
@@ -156,6 +163,9 @@ class Database(rdbms_common.Database):
         sql = 'insert into ids (name, num) values (%s,%s)'%(self.arg, self.arg)
         self.sql(sql, ('__textids', 1))
 
+        # deferred full-text indexing queue
+        self.create_textqueue_table()
+
     def add_new_columns_v2(self):
         # update existing tables to have the new actor column
         tables = self.database_schema['tables']
@@ -387,22 +397,23 @@ class Database(rdbms_common.Database):
         self.sql(sql, vals)
 
     if sqlite_version in (2,3):
-        def load_journal(self, classname, cols, nodeid):
+        def load_journal(self, classname, cols, nodeid, *args):
             """We need to turn the sqlite3.Row into a tuple so it can be
             unpacked"""
             l = rdbms_common.Database.load_journal(self,
-                classname, cols, nodeid)
+                classname, cols, nodeid, *args)
             cols = range(5)
             return [[row[col] for col in cols] for row in l]
 
 class sqliteClass:
     def filter(self, search_matches, filterspec, sort=(None,None),
-            group=(None,None)):
+            group=(None,None), limit=None, offset=None):
         """ If there's NO matches to a fetch, sqlite returns NULL
             instead of nothing
         """
         return [f for f in rdbms_common.Class.filter(self, search_matches,
-            filterspec, sort=sort, group=group) if f]
+            filterspec, sort=sort, group=group, limit=limit, offset=offset)
+            if f]
 
 class Class(sqliteClass, rdbms_common.Class):
     pass
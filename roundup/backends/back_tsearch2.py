@@ -25,8 +25,9 @@ def _getQueryDict(spec):
     return query_dict
 
 class Database(back_postgresql.Database):
-    def __init__(self, config, journaltag=None):
-        back_postgresql.Database.__init__(self, config, journaltag)
+    def __init__(self, config, journaltag=None, base_security=None):
+        back_postgresql.Database.__init__(self, config, journaltag,
+            base_security)
         self.indexer = Indexer(self)
     
     def create_version_2_tables(self):
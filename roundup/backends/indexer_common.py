@@ -1,6 +1,6 @@
-import re
+import re, math, threading
 
-from roundup import hyperdb
+from roundup import hyperdb, support
 
 STOPWORDS = [
     "A", "AND", "ARE", "AS", "AT", "BE", "BUT", "BY",
@@ -10,6 +10,42 @@ STOPWORDS = [
     "THEY", "THIS", "TO", "WAS", "WILL", "WITH"
 ]
 
+# whether xapian can be imported, see get_indexer
+_have_xapian = None
+
+def get_indexer(config, db):
+    """Return the full-text indexer selected by the "indexer" option
+    of the tracker configuration for the database.
+    """
+    global _have_xapian
+    indexer_name = getattr(config, 'INDEXER', '')
+    if not indexer_name:
+        # remember the outcome, failing imports are slow
+        if _have_xapian is None:
+            try:
+                import xapian
+            except ImportError:
+                _have_xapian = False
+            else:
+                _have_xapian = True
+        indexer_name = _have_xapian and 'xapian' or 'native'
+
+    if indexer_name == 'xapian':
+        from roundup.backends.indexer_xapian import Indexer
+    elif indexer_name == 'mmap':
+        from roundup.backends.indexer_mmap import Indexer
+    elif indexer_name == 'native':
+        if db.dbtype == 'anydbm':
+            from roundup.backends.indexer_dbm import Indexer
+        else:
+            from roundup.backends.indexer_rdbms import Indexer
+    else:
+        raise ValueError('Invalid indexer: %r'%indexer_name)
+
+    if getattr(config, 'INDEXER_DEFERRED', False):
+        return DeferredIndexer(db, Indexer(db))
+    return Indexer(db)
+
 def _isLink(propclass):
     return (isinstance(propclass, hyperdb.Link) or
             isinstance(propclass, hyperdb.Multilink))
@@ -27,6 +63,12 @@ class Indexer:
     def is_stopword(self, word):
         return word in self.stopwords
 
+    def index_pending(self, limit=None):
+        """Index queued texts, see DeferredIndexer. Texts aren't queued
+        by default so there's nothing to do.
+        """
+        return 0
+
     def getHits(self, search_terms, klass):
         return self.find(search_terms)
 
@@ -38,6 +80,177 @@ class Indexer:
         hits = self.getHits(search_terms, klass)
         if not hits:
             return {}
+        return self.resolveHits(hits, klass, ignore)
+
+    def parse_query(self, query):
+        """Split the search text "query" into (words, prefixes, phrases).
+
+        A word ending in "*" is a prefix, text in double quotes a phrase
+        (a list of words). All words, including those of the phrases
+        but not the stopwords, are uppercased utf-8 strings.
+        """
+        if not isinstance(query, unicode):
+            query = unicode(query, 'utf-8', 'replace')
+        query = query.upper()
+        words, prefixes, phrases = [], [], []
+        def add_word(word):
+            word = word.encode('utf-8')
+            if (self.minlength <= len(word) <= self.maxlength
+                    and not self.is_stopword(word) and word not in words):
+                words.append(word)
+        for phrase in re.findall(r'"([^"]*)"', query):
+            phrase = re.findall(r'(?u)\w+', phrase)
+            for word in phrase:
+                add_word(word)
+            if len(phrase) > 1:
+                phrases.append([w.encode('utf-8') for w in phrase])
+        query = re.sub(r'"[^"]*"', ' ', query)
+        for word, star in re.findall(r'(?u)\b(\w+)\b(\*?)', query):
+            if not star:
+                add_word(word)
+                continue
+            word = word.encode('utf-8')
+            if self.minlength <= len(word) <= self.maxlength:
+                prefixes.append(word)
+        return words, prefixes, phrases
+
+    def getScoredHits(self, words, prefixes):
+        """Return a dict {(classname, nodeid, property): score} of the
+        indexed texts containing all the words and a word starting with
+        each of the prefixes.
+
+        This default treats prefixes as words and gives all hits the
+        same score; the native indexers override it.
+        """
+        hits = {}
+        for entry in self.find(words + prefixes):
+            hits[(entry[0], str(entry[1]), entry[2])] = 1.0
+        return hits
+
+    # BM25 parameters
+    bm25_k1 = 1.2
+    bm25_b = 0.75
+
+    def bm25(self, terms, ndocs, doclen, avgdl):
+        """Score the documents containing all the terms.
+
+        "terms" is a list of {document: term frequency} dicts, "ndocs"
+        the number of indexed documents, "doclen" a function returning
+        the word count of a document and "avgdl" the average word count.
+        Returns {document: score}.
+        """
+        if not terms:
+            return {}
+        terms = list(terms)
+        terms.sort(lambda a, b: cmp(len(a), len(b)))
+        docs = dict.fromkeys(terms[0], 0.0)
+        for entry in terms[1:]:
+            for doc in list(docs):
+                if doc not in entry:
+                    del docs[doc]
+        k1, b = self.bm25_k1, self.bm25_b
+        avgdl = float(avgdl or 1)
+        for entry in terms:
+            df = len(entry)
+            idf = math.log(1 + (ndocs - df + 0.5) / (df + 0.5))
+            for doc in docs:
+                tf = entry[doc]
+                norm = k1 * (1 - b + b * doclen(doc) / avgdl)
+                docs[doc] += idf * tf * (k1 + 1) / (tf + norm)
+        return docs
+
+    def match_phrases(self, db, identifier, phrases):
+        """Check whether the indexed text contains all the phrases.
+        """
+        classname, nodeid, property = identifier
+        try:
+            text = db.getclass(classname).get(nodeid, property)
+        except (KeyError, IndexError):
+            return False
+        if not text:
+            return False
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8', 'replace')
+        words = [w.encode('utf-8') for w in
+            re.findall(r'(?u)\w+', text.upper())]
+        for phrase in phrases:
+            n = len(phrase)
+            for i in range(len(words) - n + 1):
+                if words[i:i + n] == phrase:
+                    break
+            else:
+                return False
+        return True
+
+    def search_scores(self, query, klass, ignore={}):
+        """Search the text "query", which may contain prefixes ("word*")
+        and phrases ("in quotes"), see parse_query.
+
+        Return {nodeid: score} for the nodes of the hyperdb Class "klass"
+        matching directly or through linked nodes; a node's score is the
+        sum of the scores of those hits. Like the result of search() the
+        dict may be used as search_matches in Class.filter.
+        """
+        words, prefixes, phrases = self.parse_query(query)
+        if not words and not prefixes:
+            return {}
+        hits = self.getScoredHits(words, prefixes)
+        if phrases:
+            for identifier in list(hits):
+                if not self.match_phrases(klass.db, identifier, phrases):
+                    del hits[identifier]
+        if not hits:
+            return {}
+
+        hit_scores = {}
+        for (classname, nodeid, property), score in hits.iteritems():
+            if (classname, property) in ignore:
+                continue
+            key = (classname, nodeid)
+            hit_scores[key] = hit_scores.get(key, 0) + score
+
+        # resolveHits doesn't report the linked hits of nodes that are
+        # hits themselves, so these are looked up here
+        propdefs = klass.getprops()
+        linked = {}
+        for classname, nodeid in hit_scores:
+            linked[classname] = 1
+        linkprops = [(name, propclass) for name, propclass
+            in propdefs.iteritems()
+            if _isLink(propclass) and propclass.classname in linked]
+
+        resolved = self.resolveHits(hits.keys(), klass, ignore)
+        direct = {}
+        if linkprops:
+            nodeids = [nodeid for nodeid in resolved
+                if hit_scores.get((klass.classname, nodeid))]
+            # fetch the link values of all these nodes at once
+            for node in klass.getnodes(nodeids,
+                    [name for name, propclass in linkprops]):
+                node_dict = {}
+                for name, propclass in linkprops:
+                    value = klass.get(node.nodeid, name)
+                    if isinstance(propclass, hyperdb.Link):
+                        value = value and [value] or []
+                    node_dict[name] = value
+                direct[node.nodeid] = node_dict
+
+        scores = {}
+        for nodeid, node_dict in resolved.iteritems():
+            score = hit_scores.get((klass.classname, nodeid), 0)
+            node_dict = direct.get(nodeid, node_dict)
+            for linkprop, linkids in node_dict.iteritems():
+                linkclass = propdefs[linkprop].classname
+                for linkid in linkids:
+                    score += hit_scores.get((linkclass, linkid), 0)
+            scores[nodeid] = score
+        return scores
+
+    def resolveHits(self, hits, klass, ignore={}):
+        """Map the index hits, (classname, nodeid, property) entries, to
+        the nodes of "klass" they were found in or are linked from.
+        Ignore hits on {class: property}.
+        """
 
         designator_propname = {}
         for nm, propclass in klass.getprops().iteritems():
@@ -107,3 +320,174 @@ class Indexer:
                             node_dict[linkprop].append(nodeid)
         return nodeids
 
+
+# process-wide cache of the words of the queued texts searched, keyed by
+# database directory and identifier; an entry holds the time the text
+# was queued, it is stale once the text is queued again
+_pending_words = support.LRUCache(10000)
+_pending_words_lock = threading.Lock()
+
+class DeferredIndexer(Indexer):
+    """Queue the texts to index in the database instead of indexing
+    them when items are created or changed; index_pending() indexes
+    the queue in batches with the real "indexer".
+
+    Searches look up the queued texts directly (unless the
+    "indexer_search_pending" option is off) so recent changes are
+    found before they are indexed. The words of a queued text are
+    kept in a cache of the process until the text is queued again,
+    so each text is only loaded and split into words once.
+    """
+    def __init__(self, db, indexer):
+        Indexer.__init__(self, db)
+        self.db = db
+        self.indexer = indexer
+        self.search_pending = db.config[('main', 'indexer_search_pending')]
+        self.batch_size = db.config[('main', 'indexer_batch_size')]
+
+    def add_text(self, identifier, text, mime_type='text/plain'):
+        self.db.queue_text(tuple(map(str, identifier)))
+
+    def save_index(self):
+        self.indexer.save_index()
+
+    def force_reindex(self):
+        self.indexer.force_reindex()
+
+    def should_reindex(self):
+        return self.indexer.should_reindex()
+
+    def rollback(self):
+        if hasattr(self.indexer, 'rollback'):
+            self.indexer.rollback()
+
+    def close(self):
+        self.indexer.close()
+        self.db = None
+
+    def get_text(self, identifier):
+        """Return the current (text, mime type) for the identifier or
+        None if the item has been destroyed.
+        """
+        classname, nodeid, property = identifier
+        try:
+            klass = self.db.getclass(classname)
+        except KeyError:
+            return None
+        if not klass.hasnode(nodeid):
+            return None
+        if property == 'content' and isinstance(klass, hyperdb.FileClass):
+            mime_type = klass.get(nodeid, 'type', klass.default_mime_type)
+        else:
+            mime_type = 'text/plain'
+        try:
+            return str(klass.get(nodeid, property)), mime_type
+        except (KeyError, IndexError):
+            return None
+
+    def index_pending(self, limit=None):
+        """Index at most "limit" (default: the "indexer_batch_size"
+        option) queued texts, oldest first, and return the number of
+        entries taken from the queue. Call repeatedly, committing the
+        database in between, until it returns 0 to index the whole
+        queue.
+        """
+        if limit is None:
+            limit = self.batch_size
+        entries = self.db.get_text_queue(limit)
+        if not entries:
+            return 0
+        for identifier, stamp in entries:
+            found = self.get_text(identifier)
+            if found is not None:
+                self.indexer.add_text(identifier, *found)
+        self.indexer.save_index()
+        self.db.dequeue_text(entries)
+        return len(entries)
+
+    def text_words(self, text):
+        if not isinstance(text, unicode):
+            text = unicode(text, 'utf-8', 'replace')
+        return set([w.encode('utf-8') for w in
+            re.findall(r'(?u)\b\w{%d,%d}\b'%(self.minlength,
+            self.maxlength), text.upper())])
+
+    def get_pending_words(self):
+        """Return {identifier: set of words} of the queued texts, the
+        set being None for texts that aren't indexed at all.
+        """
+        if not self.search_pending:
+            return {}
+        pending = {}
+        missing = []
+        database = self.db.config.DATABASE
+        _pending_words_lock.acquire()
+        try:
+            for identifier, stamp in self.db.get_text_queue():
+                entry = _pending_words.get((database, identifier))
+                if entry is not None and entry[0] == stamp:
+                    pending[identifier] = entry[1]
+                else:
+                    missing.append((identifier, stamp))
+        finally:
+            _pending_words_lock.release()
+        if not missing:
+            return pending
+        for identifier, stamp in missing:
+            found = self.get_text(identifier)
+            if found is None or found[1] != 'text/plain':
+                pending[identifier] = None
+            else:
+                pending[identifier] = self.text_words(found[0])
+        _pending_words_lock.acquire()
+        try:
+            for identifier, stamp in missing:
+                _pending_words[(database, identifier)] = (stamp,
+                    pending[identifier])
+        finally:
+            _pending_words_lock.release()
+        return pending
+
+    def find(self, wordlist):
+        hits = self.indexer.find(wordlist)
+        pending = self.get_pending_words()
+        if not pending:
+            return hits
+        # the index has stale entries for queued texts
+        hits = [entry for entry in hits
+            if (entry[0], str(entry[1]), entry[2]) not in pending]
+        words = []
+        for word in wordlist:
+            if not isinstance(word, unicode):
+                word = unicode(word, 'utf-8', 'replace')
+            words.append(word.upper().encode('utf-8'))
+        for identifier, textwords in pending.iteritems():
+            if textwords is None:
+                continue
+            for word in words:
+                if word not in textwords:
+                    break
+            else:
+                hits.append(identifier)
+        return hits
+
+    def getScoredHits(self, words, prefixes):
+        hits = self.indexer.getScoredHits(words, prefixes)
+        for identifier, textwords in self.get_pending_words().iteritems():
+            hits.pop(identifier, None)
+            if textwords is None:
+                continue
+            for word in words:
+                if word not in textwords:
+                    break
+            else:
+                for prefix in prefixes:
+                    for word in textwords:
+                        if word.startswith(prefix):
+                            break
+                    else:
+                        break
+                else:
+                    # queued texts have no term statistics to rank by
+                    hits[identifier] = 1.0
+        return hits
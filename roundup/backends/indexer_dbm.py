@@ -174,6 +174,44 @@ class Indexer(IndexerBase):
             return {}
         return list(hits.values())
 
+    def getScoredHits(self, words, prefixes):
+        '''Score the files matching all words and prefixes by BM25
+        '''
+        if not hasattr(self, 'words'):
+            self.load_index()
+        self.load_index(wordlist=words + prefixes)
+        terms = []
+        for word in words:
+            entry = self.words.get(word)
+            if not entry:
+                return {}
+            terms.append(entry)
+        for prefix in prefixes:
+            entry = {}
+            for word, occurs in self.words.iteritems():
+                if word.startswith(prefix):
+                    for fileid, count in occurs.iteritems():
+                        entry[fileid] = entry.get(fileid, 0) + count
+            if not entry:
+                return {}
+            terms.append(entry)
+
+        total = 0
+        for identifier, (fileid, wordcount) in self.files.iteritems():
+            if identifier != '_TOP':
+                total += wordcount
+        ndocs = len(self.fileids)
+        files, fileids = self.files, self.fileids
+        def doclen(fileid):
+            return files[fileids[fileid]][1]
+        hits = {}
+        for fileid, score in self.bm25(terms, ndocs, doclen,
+                float(total) / (ndocs or 1)).iteritems():
+            if fileid not in fileids:
+                raise ValueError('Index is corrupted: re-generate it')
+            hits[fileids[fileid]] = score
+        return hits
+
     segments = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ#_-!"
     def load_index(self, reload=0, wordlist=None):
         # Unless reload is indicated, do not load twice
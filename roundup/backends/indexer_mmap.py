@@ -0,0 +1,581 @@
+''' This implements the full-text indexer as a set of immutable on-disk
+segments that are read through mmap.
+
+Each segment file holds
+
+- a term dictionary: fixed size records (term, postings offset, postings
+  length, document frequency) sorted by term, so a term is found by
+  binary search directly in the mapped file,
+- the posting lists: per term the (document number delta, term frequency)
+  pairs encoded as varints,
+- a document table: fixed size records (document number, identifier
+  offset, identifier length, word count) sorted by document number and a
+  table of document table positions sorted by identifier,
+- the document numbers of older segments the segment deletes (documents
+  that were reindexed or cleared).
+
+Changes are collected in memory and written as a new, small segment by
+save_index; the list of live segments is kept in a "manifest" file that
+is replaced atomically, so readers always see a consistent index. When
+more than `merge_factor` segments exist they are merged into one, which
+drops deleted documents.
+'''
+__docformat__ = 'restructuredtext'
+
+import os, re, mmap, marshal, struct, errno, shutil
+
+from roundup.backends import locking
+from roundup.backends.indexer_common import Indexer as IndexerBase
+
+MAGIC = 'RMX1'
+# magic, nterms, ndocs, ndeleted and the offsets of the term dictionary,
+# document table, identifier table, deleted table and the identifiers
+HEADER = struct.Struct('<4sIII5Q')
+TERM = struct.Struct('<25sQII')
+DOC = struct.Struct('<IQII')
+UINT = struct.Struct('<I')
+
+def encode_varints(numbers):
+    ''' Encode the non-negative integers as a string of varints.
+    '''
+    l = []
+    append = l.append
+    for n in numbers:
+        while n > 0x7f:
+            append(chr((n & 0x7f) | 0x80))
+            n >>= 7
+        append(chr(n))
+    return ''.join(l)
+
+def decode_varints(data):
+    ''' Decode a string of varints into a list of integers.
+    '''
+    l = []
+    value = shift = 0
+    for c in data:
+        b = ord(c)
+        if b & 0x80:
+            value |= (b & 0x7f) << shift
+            shift += 7
+        else:
+            l.append(value | (b << shift))
+            value = shift = 0
+    return l
+
+class Segment:
+    ''' Read access to a segment file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, self.nterms, self.ndocs, self.ndeleted, self.term_off,
+            self.doc_off, self.ident_off, self.deleted_off,
+            self.string_off) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('Index is corrupted: re-generate it')
+
+    def close(self):
+        self.map.close()
+
+    def term(self, i):
+        ''' Return the i'th (term, offset, length, docfreq) record.
+        '''
+        term, offset, length, df = TERM.unpack_from(self.map,
+            self.term_off + i * TERM.size)
+        return term.rstrip('\0'), offset, length, df
+
+    def lookup(self, word):
+        ''' Return the index of the first term >= word.
+        '''
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid)[0] < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def postings(self, word):
+        ''' Return the list of (docnum, termfreq) of the word.
+        '''
+        i = self.lookup(word)
+        if i >= self.nterms:
+            return []
+        term, offset, length, df = self.term(i)
+        if term != word:
+            return []
+        return self.decode_postings(offset, length)
+
+    def prefix_postings(self, prefix):
+        ''' Return the list of (docnum, termfreq) of all words starting
+            with prefix; a document may appear more than once.
+        '''
+        l = []
+        i = self.lookup(prefix)
+        while i < self.nterms:
+            term, offset, length, df = self.term(i)
+            if not term.startswith(prefix):
+                break
+            l.extend(self.decode_postings(offset, length))
+            i += 1
+        return l
+
+    def decode_postings(self, offset, length):
+        numbers = decode_varints(self.map[offset:offset + length])
+        l = []
+        docnum = 0
+        for i in range(0, len(numbers), 2):
+            docnum += numbers[i]
+            l.append((docnum, numbers[i + 1]))
+        return l
+
+    def iterterms(self):
+        ''' Yield (term, postings) in term order.
+        '''
+        for i in range(self.nterms):
+            term, offset, length, df = self.term(i)
+            yield term, self.decode_postings(offset, length)
+
+    def doc(self, i):
+        ''' Return the i'th (docnum, identifier, wordcount) record.
+        '''
+        docnum, offset, length, words = DOC.unpack_from(self.map,
+            self.doc_off + i * DOC.size)
+        return docnum, self.map[offset:offset + length], words
+
+    def get_doc(self, docnum):
+        ''' Return the (docnum, identifier, wordcount) record of the
+            document number or None.
+        '''
+        lo, hi = 0, self.ndocs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            d = DOC.unpack_from(self.map, self.doc_off + mid * DOC.size)[0]
+            if d < docnum:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.ndocs:
+            doc = self.doc(lo)
+            if doc[0] == docnum:
+                return doc
+        return None
+
+    def find_doc(self, identifier):
+        ''' Return the (docnum, identifier, wordcount) record of the
+            identifier string or None.
+        '''
+        lo, hi = 0, self.ndocs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = UINT.unpack_from(self.map, self.ident_off + mid * UINT.size)[0]
+            if self.doc(i)[1] < identifier:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.ndocs:
+            i = UINT.unpack_from(self.map, self.ident_off + lo * UINT.size)[0]
+            doc = self.doc(i)
+            if doc[1] == identifier:
+                return doc
+        return None
+
+    def iterdocs(self):
+        for i in range(self.ndocs):
+            yield self.doc(i)
+
+    def deleted(self):
+        ''' Return the document numbers deleted by this segment.
+        '''
+        return [UINT.unpack_from(self.map, self.deleted_off + i * UINT.size)[0]
+            for i in range(self.ndeleted)]
+
+def write_segment(path, docs, terms, deleted):
+    ''' Write a segment file.
+
+        'docs' is a list of (docnum, identifier, wordcount) sorted by
+        docnum, 'terms' an iterable of (term, [(docnum, termfreq), ...])
+        sorted by term and 'deleted' a list of document numbers.
+    '''
+    f = open(path, 'wb')
+    try:
+        f.write('\0' * HEADER.size)
+        offset = HEADER.size
+
+        # the posting lists
+        termtable = []
+        nterms = 0
+        for term, postings in terms:
+            if not postings:
+                continue
+            numbers = []
+            last = 0
+            for docnum, tf in postings:
+                numbers.append(docnum - last)
+                numbers.append(tf)
+                last = docnum
+            data = encode_varints(numbers)
+            f.write(data)
+            termtable.append(TERM.pack(term, offset, len(data),
+                len(postings)))
+            offset += len(data)
+            nterms += 1
+
+        # the term dictionary
+        term_off = offset
+        f.write(''.join(termtable))
+        offset += TERM.size * nterms
+
+        # the documents and their identifiers
+        doc_off = offset
+        string_off = doc_off + DOC.size * len(docs)
+        l = []
+        pos = string_off
+        for docnum, identifier, words in docs:
+            l.append(DOC.pack(docnum, pos, len(identifier), words))
+            pos += len(identifier)
+        f.write(''.join(l))
+        offset = string_off
+        f.write(''.join([identifier for d, identifier, w in docs]))
+        offset = pos
+
+        ident_off = offset
+        order = range(len(docs))
+        order.sort(lambda a, b: cmp(docs[a][1], docs[b][1]))
+        f.write(''.join([UINT.pack(i) for i in order]))
+        offset += UINT.size * len(docs)
+
+        deleted_off = offset
+        f.write(''.join([UINT.pack(docnum) for docnum in deleted]))
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, nterms, len(docs), len(deleted), term_off,
+            doc_off, ident_off, deleted_off, string_off))
+    finally:
+        f.close()
+
+class Indexer(IndexerBase):
+    ''' Full-text indexer keeping its index in mmap-ed segment files in
+        the "indexes-mmap" directory of the tracker database.
+    '''
+    # merge all segments into one when there are more than this many
+    merge_factor = 10
+
+    def __init__(self, db):
+        IndexerBase.__init__(self, db)
+        self.indexdb_path = os.path.join(db.config.DATABASE, 'indexes-mmap')
+        self.manifest_path = os.path.join(self.indexdb_path, 'manifest')
+        self.lock_path = os.path.join(self.indexdb_path, 'lock')
+        self.reindex = 0
+        # open segments by file name
+        self.segments = {}
+        # (manifest, set of deleted docnums) as last read
+        self.state = None
+        # uncommitted changes: identifier string -> {word: count},
+        # an empty dict for an identifier that is to be removed
+        self.pending = {}
+
+        version = os.path.join(self.indexdb_path, 'version')
+        if not os.path.exists(version):
+            self.force_reindex()
+        elif open(version).read().strip() != '1':
+            self.force_reindex()
+
+    def force_reindex(self):
+        '''Force a reindex condition
+        '''
+        self.close()
+        if os.path.exists(self.indexdb_path):
+            shutil.rmtree(self.indexdb_path)
+        os.makedirs(self.indexdb_path)
+        os.chmod(self.indexdb_path, 0775)
+        open(os.path.join(self.indexdb_path, 'version'), 'w').write('1\n')
+        self.pending = {}
+        self.reindex = 1
+
+    def should_reindex(self):
+        '''Should we reindex?
+        '''
+        return self.reindex
+
+    def text_splitter(self, text):
+        '''Split text/plain string into a list of words
+        '''
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        text = str(text).upper()
+        return re.findall(r'\b\w{%d,%d}\b' % (self.minlength, self.maxlength),
+            text)
+
+    def add_text(self, identifier, text, mime_type='text/plain'):
+        '''Add some text associated with the (classname, nodeid, property)
+        identifier.
+        '''
+        words = {}
+        if mime_type == 'text/plain':
+            for word in self.text_splitter(text or ''):
+                if self.is_stopword(word):
+                    continue
+                words[word] = words.get(word, 0) + 1
+        self.pending['%s:%s:%s'%identifier] = words
+
+    def read_manifest(self):
+        ''' Return the current manifest: a dict with the list of segment
+            file names, the next free document number and segment
+            generation, and the number of live documents and their words.
+        '''
+        try:
+            f = open(self.manifest_path, 'rb')
+        except IOError, error:
+            if error.errno != errno.ENOENT: raise
+            return {'segments': [], 'next_docnum': 1, 'generation': 0,
+                'ndocs': 0, 'nwords': 0}
+        try:
+            return marshal.loads(f.read())
+        finally:
+            f.close()
+
+    def write_manifest(self, manifest):
+        tmp = self.manifest_path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(marshal.dumps(manifest))
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        os.rename(tmp, self.manifest_path)
+
+    def get_segment(self, name):
+        if name not in self.segments:
+            self.segments[name] = Segment(os.path.join(self.indexdb_path,
+                name))
+        return self.segments[name]
+
+    def load(self):
+        ''' Return the live segments and the set of deleted docnums.
+        '''
+        manifest = self.read_manifest()
+        if self.state is None or self.state[0] != manifest:
+            deleted = set()
+            try:
+                for name in manifest['segments']:
+                    deleted.update(self.get_segment(name).deleted())
+            except IOError, error:
+                # a concurrent merge removed the segment: try again
+                if error.errno != errno.ENOENT: raise
+                return self.load()
+            # forget segments that have been merged away
+            for name in list(self.segments):
+                if name not in manifest['segments']:
+                    self.segments.pop(name).close()
+            self.state = (manifest, deleted)
+        manifest, deleted = self.state
+        return [self.get_segment(name) for name in manifest['segments']], \
+            deleted
+
+    def find(self, wordlist):
+        '''Locate files that match ALL the words in wordlist
+        '''
+        words = []
+        for word in wordlist:
+            if not self.minlength <= len(word) <= self.maxlength:
+                continue
+            word = word.upper()
+            if self.is_stopword(word):
+                continue
+            words.append(word)
+        if not words:
+            return []
+
+        return self.getScoredHits(words, []).keys()
+
+    def getScoredHits(self, words, prefixes):
+        '''Score the texts matching all words and prefixes by BM25,
+        including the uncommitted changes.
+        '''
+        segments, deleted = self.load()
+        manifest = self.state[0]
+        ndocs = manifest['ndocs'] + len(self.pending)
+        nwords = manifest['nwords']
+        for doc in self.pending.itervalues():
+            nwords += sum(doc.values())
+
+        # committed documents are keyed by docnum, uncommitted ones by
+        # their identifier string
+        docsegment = {}
+        terms = []
+        for word, prefix in [(w, False) for w in words] + \
+                [(p, True) for p in prefixes]:
+            entry = {}
+            for segment in segments:
+                if prefix:
+                    postings = segment.prefix_postings(word)
+                else:
+                    postings = segment.postings(word)
+                for docnum, tf in postings:
+                    if docnum not in deleted:
+                        entry[docnum] = entry.get(docnum, 0) + tf
+                        docsegment[docnum] = segment
+            for identifier, doc in self.pending.iteritems():
+                if prefix:
+                    tf = 0
+                    for w, count in doc.iteritems():
+                        if w.startswith(word):
+                            tf += count
+                else:
+                    tf = doc.get(word, 0)
+                if tf:
+                    entry[identifier] = tf
+            if not entry:
+                return {}
+            terms.append(entry)
+
+        pending = self.pending
+        def doclen(key):
+            if key in pending:
+                return sum(pending[key].values())
+            return docsegment[key].get_doc(key)[2]
+        hits = {}
+        for key, score in self.bm25(terms, ndocs, doclen,
+                float(nwords) / (ndocs or 1)).iteritems():
+            if key not in pending:
+                key = docsegment[key].get_doc(key)[1]
+                # changed in this transaction
+                if key in pending:
+                    continue
+            hits[tuple(key.split(':', 2))] = score
+        return hits
+
+    def save_index(self):
+        '''Write the uncommitted changes as a new segment.
+        '''
+        if not self.pending:
+            return
+        lock = locking.acquire_lock(self.lock_path)
+        try:
+            self.state = None
+            segments, deleted = self.load()
+            manifest = self.state[0]
+
+            # the documents replaced by the new ones
+            replaced = []
+            ndocs = manifest['ndocs']
+            nwords = manifest['nwords']
+            for segment in segments:
+                for identifier in self.pending:
+                    doc = segment.find_doc(identifier)
+                    if doc is not None and doc[0] not in deleted:
+                        replaced.append(doc[0])
+                        ndocs -= 1
+                        nwords -= doc[2]
+
+            docnum = manifest['next_docnum']
+            docs = []
+            terms = {}
+            identifiers = self.pending.keys()
+            identifiers.sort()
+            for identifier in identifiers:
+                words = self.pending[identifier]
+                if not words:
+                    continue
+                docs.append((docnum, identifier, sum(words.values())))
+                ndocs += 1
+                nwords += docs[-1][2]
+                for word, count in words.iteritems():
+                    terms.setdefault(word, []).append((docnum, count))
+                docnum += 1
+            terms = terms.items()
+            terms.sort()
+
+            generation = manifest['generation'] + 1
+            name = 'segment%d'%generation
+            write_segment(os.path.join(self.indexdb_path, name), docs,
+                terms, replaced)
+            manifest = {'segments': manifest['segments'] + [name],
+                'next_docnum': docnum, 'generation': generation,
+                'ndocs': ndocs, 'nwords': nwords}
+            self.write_manifest(manifest)
+            self.pending = {}
+            if len(manifest['segments']) > self.merge_factor:
+                self.merge()
+        finally:
+            locking.release_lock(lock)
+
+    def merge(self):
+        '''Merge all segments into one, dropping the deleted documents.
+
+        The caller must hold the index lock.
+        '''
+        self.state = None
+        segments, deleted = self.load()
+        manifest = self.state[0]
+        if len(segments) < 2:
+            return
+
+        # the docnum ranges of the segments are ascending, so the
+        # documents and posting lists can simply be concatenated
+        docs = []
+        for segment in segments:
+            docs.extend([doc for doc in segment.iterdocs()
+                if doc[0] not in deleted])
+
+        def merged_terms():
+            iters = [segment.iterterms() for segment in segments]
+            heads = []
+            for i in range(len(iters)):
+                for entry in iters[i]:
+                    heads.append([entry[0], i, entry[1]])
+                    break
+            while heads:
+                term = min([h[0] for h in heads])
+                postings = []
+                for head in heads[:]:
+                    if head[0] != term:
+                        continue
+                    postings.extend([p for p in head[2]
+                        if p[0] not in deleted])
+                    for entry in iters[head[1]]:
+                        head[0], head[2] = entry
+                        break
+                    else:
+                        heads.remove(head)
+                yield term, postings
+
+        generation = manifest['generation'] + 1
+        name = 'segment%d'%generation
+        write_segment(os.path.join(self.indexdb_path, name), docs,
+            merged_terms(), [])
+        old = manifest['segments']
+        manifest = manifest.copy()
+        manifest['segments'] = [name]
+        manifest['generation'] = generation
+        self.write_manifest(manifest)
+        for name in old:
+            segment = self.segments.pop(name, None)
+            if segment is not None:
+                segment.close()
+            try:
+                os.remove(os.path.join(self.indexdb_path, name))
+            except OSError:
+                # may still be mapped by another process (on Windows)
+                pass
+        self.state = None
+
+    def rollback(self):
+        '''Discard the uncommitted changes.
+        '''
+        self.pending = {}
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+        self.state = None
+
+# vim: set filetype=python ts=4 sw=4 et si
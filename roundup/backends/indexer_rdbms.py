@@ -138,3 +138,45 @@ class Indexer(IndexerBase):
 
         return self.db.cursor.fetchall()
 
+    def getScoredHits(self, words, prefixes):
+        """Score the texts matching all words and prefixes.
+
+        The word table doesn't record term frequencies or text lengths,
+        so the BM25 score reduces to the sum of the terms' idf.
+        """
+        a = self.db.arg
+        terms = []
+        for word in words:
+            sql = 'select distinct(_textid) from __words where _word=%s'%a
+            self.db.cursor.execute(sql, (word,))
+            terms.append(dict.fromkeys([int(r[0])
+                for r in self.db.cursor.fetchall()], 1))
+        for prefix in prefixes:
+            # all words w with prefix <= w < prefix with its last
+            # character incremented
+            end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            sql = 'select distinct(_textid) from __words '\
+                'where _word>=%s and _word<%s'%(a, a)
+            self.db.cursor.execute(sql, (prefix, end))
+            terms.append(dict.fromkeys([int(r[0])
+                for r in self.db.cursor.fetchall()], 1))
+        for entry in terms:
+            if not entry:
+                return {}
+
+        self.db.cursor.execute('select count(*) from __textids')
+        ndocs = int(self.db.cursor.fetchone()[0])
+        scores = self.bm25(terms, ndocs, lambda textid: 1, 1)
+
+        hits = {}
+        textids = scores.keys()
+        for i in range(0, len(textids), 500):
+            chunk = textids[i:i + 500]
+            sql = 'select _textid, _class, _itemid, _prop from __textids '\
+                'where _textid in (%s)'%','.join([a] * len(chunk))
+            self.db.cursor.execute(sql, tuple(chunk))
+            for textid, classname, itemid, prop in \
+                    self.db.cursor.fetchall():
+                hits[(classname, str(itemid), prop)] = scores[int(textid)]
+        return hits
+
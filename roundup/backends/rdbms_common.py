@@ -53,6 +53,7 @@ __docformat__ = 'restructuredtext'
 
 # standard python modules
 import sys, os, time, re, errno, weakref, copy, logging, datetime
+import threading
 
 # roundup modules
 from roundup import hyperdb, date, password, roundupdb, security, support
@@ -65,11 +66,9 @@ from roundup.i18n import _
 
 # support
 from roundup.backends.blobfiles import FileStorage
-try:
-    from roundup.backends.indexer_xapian import Indexer
-except ImportError:
-    from roundup.backends.indexer_rdbms import Indexer
-from roundup.backends.sessions_rdbms import Sessions, OneTimeKeys
+from roundup.backends.indexer_common import get_indexer
+from roundup.backends.sessions_rdbms import Sessions, OneTimeKeys, \
+    upgrade_value
 from roundup.date import Range
 
 from roundup.backends.back_anydbm import compile_expression
@@ -159,6 +158,298 @@ class IdListOptimizer:
         return "ranges: %r / singles: %r" % (self.ranges, self.singles)
 
 
+def decode_row(decoder, row):
+    """ Make up a node dict from a database row. The "decoder" is a
+        sequence of (column index, property name, sql -> hyperdb value
+        converter), as figured out once per class or query.
+    """
+    node = {}
+    for idx, name, cvt in decoder:
+        value = row[idx]
+        if value is not None:
+            value = cvt(value)
+        node[name] = value
+    return node
+
+
+class ClassStatements:
+    """ The columns, value converters and SQL statement texts used to
+        read and write the nodes of a class, figured out once from its
+        properties instead of on every call.
+
+        An instance is kept on the class (see Database.class_statements)
+        and shared with its clones, so it must not refer to a database.
+    """
+    def __init__(self, db, klass):
+        cn = klass.classname
+        a = db.arg
+        self.cols, self.mls = db.determine_columns(
+            list(klass.properties.iteritems()))
+        self.scols = ','.join([col for col,dt in self.cols])
+
+        # the row decoder (see decode_row) of the columns, skipping the
+        # Interval-as-seconds ones
+        props = klass.getprops(protected=1)
+        decoder = []
+        for idx in range(len(self.cols)):
+            name = self.cols[idx][0][1:]
+            if name.endswith('_int__'):
+                # XXX eugh, this test suxxors
+                continue
+            decoder.append((idx, name,
+                db.to_hyperdb_value(props[name].__class__)))
+        self.decoder = tuple(decoder)
+
+        self.getnode = 'select %s from _%s where id=%s'%(self.scols, cn, a)
+        self.getnodes = 'select %s,id from _%s where id in (%%s)'%(
+            self.scols, cn)
+        self.hasnode = 'select count(*) from _%s where id=%s'%(cn, a)
+        self.addnode = 'insert into _%s (%s,id) values (%s)'%(cn,
+            self.scols, ','.join([a] * (len(self.cols) + 1)))
+        self.destroynode = 'delete from _%s where id=%s'%(cn, a)
+        self.multilink = {}
+        self.multilink_add = {}
+        self.multilink_clear = {}
+        for col in self.mls:
+            t = '%s_%s'%(cn, col)
+            self.multilink[col] = 'select linkid from %s where nodeid=%s'%(
+                t, a)
+            self.multilink_add[col] = \
+                'insert into %s (nodeid, linkid) values (%s,%s)'%(t, a, a)
+            self.multilink_clear[col] = 'delete from %s where nodeid=%s'%(
+                t, a)
+        self.journal_delete = 'delete from %s__journal where nodeid=%s'%(
+            cn, a)
+
+        # texts that depend on the arguments, by argument
+        self.setnode_sql = {}
+        self.journal_sql = {}
+        self.classname, self.arg = cn, a
+
+    def setnode(self, cols):
+        """ The update of the (sorted) column names "cols".
+        """
+        sql = self.setnode_sql.get(cols)
+        if sql is None:
+            s = ','.join(['_%s=%s'%(x, self.arg) for x in cols])
+            sql = 'update _%s set %s where id=%s'%(self.classname, s,
+                self.arg)
+            self.setnode_sql[cols] = sql
+        return sql
+
+    def journal(self, cols):
+        """ The insert of a journal entry with the columns "cols".
+        """
+        sql = self.journal_sql.get(cols)
+        if sql is None:
+            a = self.arg
+            sql = 'insert into %s__journal (%s) values (%s,%s,%s,%s,%s)'%(
+                self.classname, cols, a, a, a, a, a)
+            self.journal_sql[cols] = sql
+        return sql
+
+
+class SharedNodeCache:
+    """ Process-wide cache of nodes of rarely-changing classes (status,
+        priority, ...), shared by all Database instances that are opened
+        on the same tracker.
+
+        Each class has a version stamp that is bumped when a transaction
+        that changed nodes of the class commits. Entries are only stored
+        if the class version didn't change while they were read from the
+        database. Changes committed by other processes are picked up once
+        an entry is older than 'ttl' seconds.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # bumped when all classes are invalidated (eg. on schema change)
+        self.generation = 0
+        self.versions = {}
+        self.nodes = {}
+        self.hits = self.misses = 0
+
+    def version(self, classname):
+        return (self.generation, self.versions.get(classname, 0))
+
+    def get(self, classname, nodeid):
+        """ Return a copy of the cached node or None.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.nodes.get((classname, nodeid))
+            if entry is not None:
+                version, stamp, node = entry
+                if (version == self.version(classname)
+                        and time.time() - stamp < self.ttl):
+                    self.hits += 1
+                    return node.copy()
+                del self.nodes[(classname, nodeid)]
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+
+    def put(self, classname, nodeid, node, version):
+        """ Store the node if the class is still at 'version'.
+        """
+        self.lock.acquire()
+        try:
+            if version == self.version(classname):
+                self.nodes[(classname, nodeid)] = (version, time.time(),
+                    node.copy())
+        finally:
+            self.lock.release()
+
+    def invalidate(self, classname=None):
+        """ Bump the version of the class (or of all classes) and drop its
+            nodes from the cache.
+        """
+        self.lock.acquire()
+        try:
+            if classname is None:
+                self.generation += 1
+                self.nodes = {}
+            else:
+                self.versions[classname] = self.versions.get(classname, 0) + 1
+                for key in list(self.nodes):
+                    if key[0] == classname:
+                        del self.nodes[key]
+        finally:
+            self.lock.release()
+
+# process-wide SharedNodeCache instances, keyed by backend and database
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+def get_shared_cache(key, ttl):
+    """ Return the SharedNodeCache for 'key', creating it if necessary.
+    """
+    _shared_caches_lock.acquire()
+    try:
+        if key not in _shared_caches:
+            _shared_caches[key] = SharedNodeCache(ttl)
+        return _shared_caches[key]
+    finally:
+        _shared_caches_lock.release()
+
+
+class ConnectionPool:
+    """ Idle database connections of a tracker kept for reuse.
+
+        Connections are handed out most recently returned first;
+        those idle for more than 'max_idle' seconds are closed.
+    """
+    def __init__(self, size, max_idle):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = []          # (connection, time returned)
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.discarded = 0
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get(self):
+        """ Return an idle connection or None if there's none.
+        """
+        expired = []
+        conn = None
+        self.lock.acquire()
+        try:
+            limit = time.time() - self.max_idle
+            while self.idle:
+                conn, returned = self.idle.pop()
+                if returned >= limit:
+                    self.hits += 1
+                    break
+                expired.append(conn)
+                conn = None
+            else:
+                self.misses += 1
+            # the remaining connections were returned even earlier
+            while self.idle and self.idle[0][1] < limit:
+                expired.append(self.idle.pop(0)[0])
+            self.discarded += len(expired)
+        finally:
+            self.lock.release()
+        for old in expired:
+            self.close_connection(old)
+        return conn
+
+    def put(self, conn):
+        """ Keep the connection for reuse. Return False if the pool is
+            full, the caller then closes the connection.
+        """
+        self.lock.acquire()
+        try:
+            if len(self.idle) >= self.size:
+                return False
+            self.idle.append((conn, time.time()))
+            return True
+        finally:
+            self.lock.release()
+
+    def discard(self, conn):
+        """ Close a connection handed out that turned out unusable.
+        """
+        self.lock.acquire()
+        try:
+            self.discarded += 1
+        finally:
+            self.lock.release()
+        self.close_connection(conn)
+
+    def clear(self):
+        """ Close all the idle connections.
+        """
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.lock.release()
+        for conn, returned in idle:
+            self.close_connection(conn)
+
+    def stats(self):
+        """ Return a dict of the pool statistics.
+        """
+        return {'size': self.size, 'idle': len(self.idle),
+            'hits': self.hits, 'misses': self.misses,
+            'discarded': self.discarded}
+
+# process-wide ConnectionPool instances, keyed by backend and database
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(key, size, max_idle):
+    """ Return the ConnectionPool for 'key', creating it if necessary.
+    """
+    _connection_pools_lock.acquire()
+    try:
+        if key not in _connection_pools:
+            _connection_pools[key] = ConnectionPool(size, max_idle)
+        return _connection_pools[key]
+    finally:
+        _connection_pools_lock.release()
+
+def clear_connection_pools(config):
+    """ Close the pooled connections to the tracker database of
+        'config', eg. before it is removed.
+    """
+    _connection_pools_lock.acquire()
+    try:
+        pools = [pool for key, pool in _connection_pools.items()
+            if key[1:] == (config.DATABASE, config.RDBMS_NAME)]
+    finally:
+        _connection_pools_lock.release()
+    for pool in pools:
+        pool.clear()
+
+
 class Database(FileStorage, hyperdb.Database, roundupdb.Database):
     """ Wrapper around an SQL database that presents a hyperdb interface.
 
@@ -166,15 +457,23 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
           the sql_* methods that are NotImplemented
         - we keep a cache of the latest N row fetches (where N is configurable).
     """
-    def __init__(self, config, journaltag=None):
+    dbtype = "rdbms"
+
+    def __init__(self, config, journaltag=None, base_security=None):
         """ Open the database and load the schema from it.
+
+        If 'base_security' is given, the database gets a copy of that
+        Security instead of a new one.
         """
         FileStorage.__init__(self, config.UMASK)
         self.config, self.journaltag = config, journaltag
         self.dir = config.DATABASE
         self.classes = {}
-        self.indexer = Indexer(self)
-        self.security = security.Security(self)
+        self.indexer = get_indexer(config, self)
+        if base_security is None:
+            self.security = security.Security(self)
+        else:
+            self.security = base_security.copy(self)
 
         # additional transaction support for external files and the like
         self.transactions = []
@@ -182,27 +481,57 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # keep a cache of the N most recently retrieved rows of any kind
         # (classname, nodeid) = row
         self.cache_size = config.RDBMS_CACHE_SIZE
+        self.cache = support.LRUCache(self.cache_size)
         self.clearCache()
+
+        # nodes of these classes are also kept in a cache shared by all
+        # connections to this tracker in this process
+        self.shared_cache_classes = {}
+        for cn in config.RDBMS_SHARED_CACHE_CLASSES:
+            cn = cn.strip()
+            if cn:
+                self.shared_cache_classes[cn] = 1
+        if self.shared_cache_classes:
+            self.shared_cache = get_shared_cache((self.__module__,
+                config.DATABASE, config.RDBMS_NAME),
+                config.RDBMS_SHARED_CACHE_TTL)
+        else:
+            self.shared_cache = None
+        # shared-cache classes modified in the current transaction
+        self.shared_cache_dirty = {}
         self.stats = {'cache_hits': 0, 'cache_misses': 0, 'get_items': 0,
             'filtering': 0}
 
         # database lock
         self.lockfile = None
 
+        # idle connections of this tracker kept for reuse
+        if config.RDBMS_CONNECTION_POOL_SIZE > 0:
+            self.connection_pool = get_connection_pool((self.__module__,
+                config.DATABASE, config.RDBMS_NAME),
+                config.RDBMS_CONNECTION_POOL_SIZE,
+                config.RDBMS_CONNECTION_POOL_MAX_IDLE)
+        else:
+            self.connection_pool = None
+
         # open a connection to the database, creating the "conn" attribute
-        self.open_connection()
+        if not self.open_pooled_connection():
+            self.open_connection()
 
     def clearCache(self):
-        self.cache = {}
-        self.cache_lru = []
+        self.cache.clear()
         # upcall is necessary!
         roundupdb.Database.clearCache(self)
 
     def getSessionManager(self):
-        return Sessions(self)
+        if self.sessions is None:
+            self.sessions = Sessions(self)
+        return self.sessions
 
     def getOTKManager(self):
-        return OneTimeKeys(self)
+        if self.otks is None:
+            self.otks = OneTimeKeys(self)
+        return self.otks
 
     def open_connection(self):
         """ Open a connection to the database, creating it if necessary.
@@ -211,16 +540,98 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """
         raise NotImplemented
 
-    def sql(self, sql, args=None, cursor=None):
+    def open_pooled_connection(self):
+        """ Use a connection from the connection pool, if there's one
+            that works. Return whether there was.
+        """
+        if self.connection_pool is None:
+            return False
+        while 1:
+            conn = self.connection_pool.get()
+            if conn is None:
+                return False
+            if self.config.RDBMS_CONNECTION_POOL_CHECK and \
+                    not self.sql_check_connection(conn):
+                self.connection_pool.discard(conn)
+                continue
+            self.conn, self.cursor = conn, conn.cursor()
+            self.load_dbschema()
+            return True
+
+    def sql_check_connection(self, conn):
+        """ Check that a pooled connection still works.
+        """
+        try:
+            cursor = conn.cursor()
+            cursor.execute('select 1')
+            cursor.fetchall()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def release_connection(self):
+        """ Roll back and return the connection to the connection pool.
+            Return False if it wasn't taken and has to be closed.
+        """
+        if self.connection_pool is None:
+            return False
+        try:
+            self.sql_rollback()
+        except Exception:
+            return False
+        return self.connection_pool.put(self.conn)
+
+    def sql(self, sql, args=None, cursor=None, statement=None):
         """ Execute the sql with the optional args.
+
+            The profile records "statement" instead of the sql if given,
+            as it is when the sql executes a prepared statement.
         """
         self.log_debug('SQL %r %r'%(sql, args))
         if not cursor:
             cursor = self.cursor
+        profile = self.profile
+        if profile is not None:
+            start = time.time()
         if args:
             cursor.execute(sql, args)
         else:
             cursor.execute(sql)
+        if profile is not None:
+            profile.add_sql(statement or sql, time.time() - start)
+
+    def sql_prepared(self, sql, args):
+        """ Execute one of the statements of ClassStatements, whose text
+            only depends on the schema. Backends that support server-side
+            prepared statements override this to prepare it once per
+            connection.
+        """
+        self.sql(sql, args)
+
+    def class_statements(self, classname):
+        """ Return the ClassStatements of the class, building them if
+            necessary.
+        """
+        cl = self.classes[classname]
+        statements = cl.statements
+        if statements is None:
+            statements = cl.statements = ClassStatements(self, cl)
+        return statements
+
+    # LIMIT used when only an OFFSET is requested
+    sql_max_limit = sys.maxint
+
+    def sql_limit(self, sql, args, limit, offset):
+        """ Add a LIMIT/OFFSET clause to the sql.
+        """
+        if limit is None and not offset:
+            return sql, args
+        if limit is None:
+            # we need a LIMIT for an OFFSET
+            limit = self.sql_max_limit
+        sql = '%s limit %s offset %s'%(sql, self.arg, self.arg)
+        return sql, args + (int(limit), int(offset or 0))
 
     def sql_fetchone(self):
         """ Fetch a single row. If there's nothing to fetch, return None.
@@ -307,6 +718,14 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # update the database version of the schema
         if save:
             self.save_dbschema()
+            if self.shared_cache is not None:
+                self.shared_cache.invalidate()
+
+        # figure the statements of the classes now, so that databases
+        # opened with a copy of this schema share them
+        for classname, spec in self.classes.iteritems():
+            spec.statements = None
+            self.class_statements(classname)
 
         # reindex the db if necessary
         if self.indexer.should_reindex():
@@ -317,7 +736,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
     # update this number when we need to make changes to the SQL structure
     # of the backen database
-    current_db_version = 5
+    current_db_version = 7
     db_version_updated = False
     def upgrade_db(self):
         """ Update the SQL database to reflect changes in the backend code.
@@ -357,6 +776,16 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             self.log_info('upgrade to version 5')
             self.fix_version_4_tables()
 
+        # version 2 tables created above already include the queue
+        if 2 <= version < 6:
+            self.log_info('upgrade to version 6')
+            self.fix_version_5_tables()
+
+        # postgresql re-creates the session and OTK tables above
+        if version < 7:
+            self.log_info('upgrade to version 7')
+            self.fix_version_6_tables()
+
         self.database_schema['version'] = self.current_db_version
         self.db_version_updated = True
         return 1
@@ -384,6 +813,38 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             if klass.key:
                 self.add_class_key_required_unique_constraint(cn, klass.key)
 
+    def fix_version_5_tables(self):
+        # add the deferred full-text indexing queue
+        self.create_textqueue_table()
+
+    def fix_version_6_tables(self):
+        # session and OTK values are now marshalled, convert the old ones
+        c = self.cursor
+        for name in ('otk', 'session'):
+            c.execute('SELECT %s_key, %s_value FROM %ss'%(name, name, name))
+            for key, text in c.fetchall():
+                text = upgrade_value(text)
+                if text is None:
+                    c.execute('DELETE FROM %ss WHERE %s_key=%s'%(name, name,
+                        self.arg), (key,))
+                else:
+                    c.execute('UPDATE %ss SET %s_value=%s WHERE %s_key=%s'%(
+                        name, name, self.arg, name, self.arg), (text, key))
+        self.create_session_time_indexes()
+
+    def create_session_time_indexes(self):
+        # expire sessions and OTKs by their time
+        for name in ('otk', 'session'):
+            if not self.sql_index_exists('%ss'%name, '%ss_time_idx'%name):
+                self.sql('CREATE INDEX %ss_time_idx ON %ss(%s_time)'%(name,
+                    name, name))
+
+    def create_textqueue_table(self):
+        self.sql('CREATE TABLE __textqueue (_class VARCHAR(255), '
+            '_itemid VARCHAR(255), _prop VARCHAR(255), _time REAL)')
+        self.sql('CREATE INDEX __textqueue_by_props ON '
+            '__textqueue (_class, _itemid, _prop)')
+
     def _convert_journal_tables(self):
         """Get current journal table contents, drop the table and re-create"""
         c = self.cursor
@@ -452,6 +913,9 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 for nodeid in klass.list():
                     klass.index(nodeid)
         self.indexer.save_index()
+        # with deferred indexing the texts have only been queued
+        while self.indexer.index_pending():
+            pass
 
     hyperdb_to_sql_datatypes = {
         hyperdb.String : 'TEXT',
@@ -854,6 +1318,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         for cn in self.classes:
             sql = 'delete from _%s'%cn
             self.sql(sql)
+            self._shared_cache_touch(cn)
 
     #
     # Nodes
@@ -885,18 +1350,31 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
     def _cache_del(self, key):
         del self.cache[key]
-        self.cache_lru.remove(key)
 
     def _cache_refresh(self, key):
-        self.cache_lru.remove(key)
-        self.cache_lru.insert(0, key)
+        self.cache.refresh(key)
 
     def _cache_save(self, key, node):
+        # the LRU cache evicts the least recently used node if it's full
         self.cache[key] = node
-        # update the LRU
-        self.cache_lru.insert(0, key)
-        if len(self.cache_lru) > self.cache_size:
-            del self.cache[self.cache_lru.pop()]
+
+    def _shared_cache_touch(self, classname):
+        """ Note that the current transaction changed a node of a class
+            held in the shared cache. The class bypasses the shared cache
+            until the transaction ends and is invalidated on commit.
+        """
+        if classname in self.shared_cache_classes:
+            self.shared_cache_dirty[classname] = 1
+
+    def _shared_cache_commit(self):
+        for classname in self.shared_cache_dirty:
+            self.shared_cache.invalidate(classname)
+        self.shared_cache_dirty = {}
+
+    def cache_stats(self):
+        """ Return the node cache hit/miss/eviction counters.
+        """
+        return self.cache.stats()
 
     def addnode(self, classname, nodeid, node):
         """ Add the specified node to its class's db.
@@ -905,8 +1383,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             nodeid, node))
 
         # determine the column definitions and multilink tables
-        cl = self.classes[classname]
-        cols, mls = self.determine_columns(list(cl.properties.iteritems()))
+        statements = self.class_statements(classname)
+        cols, mls = statements.cols, statements.mls
 
         # we'll be supplied these props if we're doing an import
         values = node.copy()
@@ -932,6 +1410,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         key = (classname, nodeid)
         if key in self.cache:
             self._cache_del(key)
+        self._shared_cache_touch(classname)
 
         # figure the values to insert
         vals = []
@@ -955,21 +1434,14 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         vals.append(nodeid)
         vals = tuple(vals)
 
-        # make sure the ordering is correct for column name -> column value
-        s = ','.join([self.arg for x in cols]) + ',%s'%self.arg
-        cols = ','.join([col for col,dt in cols]) + ',id'
-
         # perform the inserts
-        sql = 'insert into _%s (%s) values (%s)'%(classname, cols, s)
-        self.sql(sql, vals)
+        self.sql_prepared(statements.addnode, vals)
 
         # insert the multilink rows
         for col in mls:
-            t = '%s_%s'%(classname, col)
+            sql = statements.multilink_add[col]
             for entry in node[col]:
-                sql = 'insert into %s (linkid, nodeid) values (%s,%s)'%(t,
-                    self.arg, self.arg)
-                self.sql(sql, (entry, nodeid))
+                self.sql_prepared(sql, (nodeid, entry))
 
     def setnode(self, classname, nodeid, values, multilink_changes={}):
         """ Change the specified node.
@@ -981,6 +1453,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         key = (classname, nodeid)
         if key in self.cache:
             self._cache_del(key)
+        self._shared_cache_touch(classname)
 
         cl = self.classes[classname]
         props = cl.getprops()
@@ -1026,45 +1499,34 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         vals.append(int(nodeid))
         vals = tuple(vals)
 
+        statements = self.class_statements(classname)
+
         # if there's any updates to regular columns, do them
         if cols:
-            # make sure the ordering is correct for column name -> column value
-            s = ','.join(['_%s=%s'%(x, self.arg) for x in cols])
-            cols = ','.join(cols)
-
-            # perform the update
-            sql = 'update _%s set %s where id=%s'%(classname, s, self.arg)
-            self.sql(sql, vals)
+            self.sql_prepared(statements.setnode(tuple(cols)), vals)
 
         # we're probably coming from an import, not a change
         if not multilink_changes:
             for name in mls:
-                prop = props[name]
-                value = values[name]
-
-                t = '%s_%s'%(classname, name)
-
                 # clear out previous values for this node
                 # XXX numeric ids
-                self.sql('delete from %s where nodeid=%s'%(t, self.arg),
-                        (nodeid,))
+                self.sql_prepared(statements.multilink_clear[name],
+                    (nodeid,))
 
                 # insert the values for this node
+                sql = statements.multilink_add[name]
                 for entry in values[name]:
-                    sql = 'insert into %s (linkid, nodeid) values (%s,%s)'%(t,
-                        self.arg, self.arg)
                     # XXX numeric ids
-                    self.sql(sql, (entry, nodeid))
+                    self.sql_prepared(sql, (nodeid, entry))
 
         # we have multilink changes to apply
         for col, (add, remove) in multilink_changes.iteritems():
             tn = '%s_%s'%(classname, col)
             if add:
-                sql = 'insert into %s (nodeid, linkid) values (%s,%s)'%(tn,
-                    self.arg, self.arg)
+                sql = statements.multilink_add[col]
                 for addid in add:
                     # XXX numeric ids
-                    self.sql(sql, (int(nodeid), int(addid)))
+                    self.sql_prepared(sql, (int(nodeid), int(addid)))
             if remove:
                 s = ','.join([self.arg]*len(remove))
                 sql = 'delete from %s where nodeid=%s and linkid in (%s)'%(tn,
@@ -1100,15 +1562,93 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         """ evaluation of single Multilink (lazy eval may have skipped this)
         """
         if propname not in node:
-            sql = 'select linkid from %s_%s where nodeid=%s'%(classname,
-                propname, self.arg)
-            self.sql(sql, (nodeid,))
+            sql = self.class_statements(classname).multilink[propname]
+            self.sql_prepared(sql, (nodeid,))
             # extract the first column from the result
             # XXX numeric ids
             items = [int(x[0]) for x in self.cursor.fetchall()]
             items.sort ()
             node[propname] = [str(x) for x in items]
 
+    # maximum number of ids in a single "id in (...)" clause
+    sql_in_chunk_size = 500
+
+    def _chunks(self, ids):
+        """ Split the list of ids into chunks for "in (...)" clauses.
+        """
+        size = self.sql_in_chunk_size
+        for i in range(0, len(ids), size):
+            yield ids[i:i + size]
+
+    def _load_nodes(self, classname, nodeids):
+        """ Make sure the nodes are in the node cache, fetching the
+            missing ones with one query per chunk of ids. Multilinks are
+            not fetched. Ids of nonexisting nodes are ignored.
+        """
+        missing = []
+        for nodeid in nodeids:
+            if (classname, nodeid) not in self.cache:
+                missing.append(nodeid)
+        if not missing:
+            return
+        statements = self.class_statements(classname)
+        for chunk in self._chunks(missing):
+            sql = statements.getnodes%','.join([self.arg] * len(chunk))
+            self.sql(sql, tuple(chunk))
+            for values in self.sql_fetchall():
+                node = self._node_from_row(classname, values)
+                # XXX numeric ids
+                self._cache_save((classname, str(values[-1])), node)
+
+    def prefetch_multilinks(self, classname, nodeids, propnames=None):
+        """ Materialize the given Multilink properties (default: all) of
+            the nodes with one query per property (and chunk of ids)
+            instead of one query per node and property. The nodes are
+            loaded into the node cache if necessary.
+        """
+        cl = self.classes[classname]
+        if propnames is None:
+            propnames = [pn for (pn, p) in cl.properties.iteritems()
+                if isinstance(p, Multilink)]
+        if not propnames or not nodeids:
+            return
+        self._load_nodes(classname, nodeids)
+        nodes = {}
+        for nodeid in nodeids:
+            key = (classname, nodeid)
+            if key in self.cache:
+                nodes[nodeid] = self.cache[key]
+        self._fetch_multilinks(classname, nodes, propnames)
+
+    def _fetch_multilinks(self, classname, nodes, propnames):
+        """ Fill in the Multilink properties of the nodes, a dict
+            nodeid -> node, with one query per property and chunk.
+        """
+        for propname in propnames:
+            todo = [nodeid for nodeid, node in nodes.iteritems()
+                if propname not in node]
+            if not todo:
+                continue
+            values = {}
+            for nodeid in todo:
+                values[nodeid] = []
+            for chunk in self._chunks(todo):
+                sql = 'select nodeid, linkid from %s_%s where nodeid in (%s)'%(
+                    classname, propname, ','.join([self.arg] * len(chunk)))
+                self.sql(sql, tuple(chunk))
+                # XXX numeric ids
+                for nodeid, linkid in self.sql_fetchall():
+                    values[str(nodeid)].append(int(linkid))
+            for nodeid, items in values.iteritems():
+                items.sort()
+                nodes[nodeid][propname] = [str(x) for x in items]
+
+    def _node_from_row(self, classname, values):
+        """ Convert a row of the class table (the columns of its
+            ClassStatements) into a node dict.
+        """
+        return decode_row(self.class_statements(classname).decoder, values)
+
     def _materialize_multilinks(self, classname, nodeid, node, props=None):
         """ get all Multilinks of a node (lazy eval may have skipped this)
         """
@@ -1125,48 +1665,46 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             (lazy Multilinks).
             But for internal database operations we need them.
         """
-        # see if we have this node cached
+        # see if we have this node cached (this pushes us back to the top
+        # of the LRU)
         key = (classname, nodeid)
-        if key in self.cache:
-            # push us back to the top of the LRU
-            self._cache_refresh(key)
+        node = self.cache.get(key)
+        if node is not None:
             if __debug__:
                 self.stats['cache_hits'] += 1
             # return the cached information
             if fetch_multilinks:
-                self._materialize_multilinks(classname, nodeid, self.cache[key])
-            return self.cache[key]
+                self._materialize_multilinks(classname, nodeid, node)
+            return node
 
         if __debug__:
             self.stats['cache_misses'] += 1
             start_t = time.time()
 
-        # figure the columns we're fetching
-        cl = self.classes[classname]
-        cols, mls = self.determine_columns(list(cl.properties.iteritems()))
-        scols = ','.join([col for col,dt in cols])
+        # try the process-wide cache (for classes that weren't changed in
+        # this transaction)
+        shared = (classname in self.shared_cache_classes
+            and classname not in self.shared_cache_dirty)
+        if shared:
+            node = self.shared_cache.get(classname, nodeid)
+            if node is not None:
+                self._cache_save(key, node)
+                return node
+            version = self.shared_cache.version(classname)
+            # shared nodes always carry their multilinks
+            fetch_multilinks = True
 
         # perform the basic property fetch
-        sql = 'select %s from _%s where id=%s'%(scols, classname, self.arg)
-        self.sql(sql, (nodeid,))
+        statements = self.class_statements(classname)
+        mls = statements.mls
+        self.sql_prepared(statements.getnode, (nodeid,))
 
         values = self.sql_fetchone()
         if values is None:
             raise IndexError('no such %s node %s'%(classname, nodeid))
 
         # make up the node
-        node = {}
-        props = cl.getprops(protected=1)
-        for col in range(len(cols)):
-            name = cols[col][0][1:]
-            if name.endswith('_int__'):
-                # XXX eugh, this test suxxors
-                # ignore the special Interval-as-seconds column
-                continue
-            value = values[col]
-            if value is not None:
-                value = self.to_hyperdb_value(props[name].__class__)(value)
-            node[name] = value
+        node = self._node_from_row(classname, values)
 
         if fetch_multilinks and mls:
             self._materialize_multilinks(classname, nodeid, node, mls)
@@ -1174,6 +1712,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # save off in the cache
         key = (classname, nodeid)
         self._cache_save(key, node)
+        if shared:
+            self.shared_cache.put(classname, nodeid, node, version)
 
         if __debug__:
             self.stats['get_items'] += (time.time() - start_t)
@@ -1192,8 +1732,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             raise IndexError('%s has no node %s'%(classname, nodeid))
 
         # see if we have this node cached
-        if (classname, nodeid) in self.cache:
-            del self.cache[(classname, nodeid)]
+        self.cache.pop((classname, nodeid))
+        self._shared_cache_touch(classname)
 
         # see if there's any obvious commit actions that we should get rid of
         for entry in self.transactions[:]:
@@ -1201,20 +1741,15 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 self.transactions.remove(entry)
 
         # now do the SQL
-        sql = 'delete from _%s where id=%s'%(classname, self.arg)
-        self.sql(sql, (nodeid,))
+        statements = self.class_statements(classname)
+        self.sql(statements.destroynode, (nodeid,))
 
         # remove from multilnks
-        cl = self.getclass(classname)
-        x, mls = self.determine_columns(list(cl.properties.iteritems()))
-        for col in mls:
-            # get the link ids
-            sql = 'delete from %s_%s where nodeid=%s'%(classname, col, self.arg)
-            self.sql(sql, (nodeid,))
+        for col in statements.mls:
+            self.sql(statements.multilink_clear[col], (nodeid,))
 
         # remove journal entries
-        sql = 'delete from %s__journal where nodeid=%s'%(classname, self.arg)
-        self.sql(sql, (nodeid,))
+        self.sql(statements.journal_delete, (nodeid,))
 
         # cleanup any blob filestorage when we commit
         self.transactions.append((FileStorage.destroy, (self, classname, nodeid)))
@@ -1228,8 +1763,8 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             # Return 1, not True, to match the type of the result of
             # the SQL operation below.
             return 1
-        sql = 'select count(*) from _%s where id=%s'%(classname, self.arg)
-        self.sql(sql, (nodeid,))
+        self.sql_prepared(self.class_statements(classname).hasnode,
+            (nodeid,))
         return int(self.cursor.fetchone()[0])
 
     def countnodes(self, classname):
@@ -1318,15 +1853,20 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
             elif isinstance(property, Boolean):
                 params[param] = cvt(value)
 
-    def getjournal(self, classname, nodeid):
-        """ get the journal for id
+    def getjournal(self, classname, nodeid, direction='ascending',
+            limit=None, offset=None, daterange=None):
+        """ get the journal for id, see hyperdb.Database.getjournal
+
+            The ordering, date range and page are done by the database
+            so only the entries returned are unmarshalled.
         """
         # make sure the node exists
         if not self.hasnode(classname, nodeid):
             raise IndexError('%s has no node %s'%(classname, nodeid))
 
         cols = ','.join('nodeid date tag action params'.split())
-        journal = self.load_journal(classname, cols, nodeid)
+        journal = self.load_journal(classname, cols, nodeid, direction,
+            limit, offset, daterange)
 
         # now unmarshal the data
         dc = self.to_hyperdb_value(hyperdb.Date)
@@ -1362,18 +1902,32 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         entry = (nodeid, journaldate, journaltag, action, params)
 
         # do the insert
-        a = self.arg
-        sql = 'insert into %s__journal (%s) values (%s,%s,%s,%s,%s)'%(
-            classname, cols, a, a, a, a, a)
-        self.sql(sql, entry)
+        self.sql_prepared(self.class_statements(classname).journal(cols),
+            entry)
 
-    def load_journal(self, classname, cols, nodeid):
+    def load_journal(self, classname, cols, nodeid, direction='ascending',
+            limit=None, offset=None, daterange=None):
         """ Load the journal from the database
         """
+        where = ['nodeid=%s'%self.arg]
+        args = [nodeid]
+        date_from, date_to = self.journal_daterange(daterange)
+        dc = self.to_sql_value(hyperdb.Date)
+        if date_from is not None:
+            where.append('date>=%s'%self.arg)
+            args.append(dc(date_from))
+        if date_to is not None:
+            where.append('date<=%s'%self.arg)
+            args.append(dc(date_to))
+        order = ['date', 'tag', 'action', 'params']
+        if direction == 'descending':
+            order = [col + ' desc' for col in order]
+
         # now get the journal entries
-        sql = 'select %s from %s__journal where nodeid=%s order by date'%(
-            cols, classname, self.arg)
-        self.sql(sql, (nodeid,))
+        sql = 'select %s from %s__journal where %s order by %s'%(cols,
+            classname, ' and '.join(where), ','.join(order))
+        sql, args = self.sql_limit(sql, tuple(args), limit, offset)
+        self.sql(sql, args)
         return self.cursor.fetchall()
 
     def pack(self, pack_before):
@@ -1387,6 +1941,40 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
                 "action<>'create'"%(classname, self.arg)
             self.sql(sql, (date_stamp,))
 
+    def queue_text(self, identifier):
+        """ Queue the (classname, nodeid, property) "identifier" for
+            deferred full-text indexing.
+        """
+        a = self.arg
+        sql = 'delete from __textqueue where _class=%s and _itemid=%s '\
+            'and _prop=%s'%(a, a, a)
+        self.sql(sql, identifier)
+        sql = 'insert into __textqueue (_class, _itemid, _prop, _time) '\
+            'values (%s, %s, %s, %s)'%(a, a, a, a)
+        self.sql(sql, tuple(identifier) + (time.time(),))
+
+    def get_text_queue(self, limit=None):
+        """ Return at most "limit" queued (identifier, timestamp) entries,
+            oldest first.
+        """
+        sql = 'select _class, _itemid, _prop, _time from __textqueue '\
+            'order by _time'
+        if limit is not None:
+            sql += ' limit %d'%limit
+        self.sql(sql)
+        return [((str(c), str(i), str(p)), t)
+            for c, i, p, t in self.cursor.fetchall()]
+
+    def dequeue_text(self, entries):
+        """ Remove the (identifier, timestamp) entries from the indexing
+            queue unless they've been queued again since.
+        """
+        a = self.arg
+        sql = 'delete from __textqueue where _class=%s and _itemid=%s '\
+            'and _prop=%s and _time<=%s'%(a, a, a, a)
+        for identifier, stamp in entries:
+            self.sql(sql, tuple(identifier) + (stamp,))
+
     def sql_commit(self, fail_ok=False):
         """ Actually commit to the database.
         """
@@ -1412,6 +2000,9 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # commit the database
         self.sql_commit(fail_ok)
 
+        # let other connections see our changes to shared-cache classes
+        self._shared_cache_commit()
+
         # now, do all the other transaction stuff
         for method, args in self.transactions:
             method(*args)
@@ -1426,6 +2017,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         # transaction to the next (there may be other changes from other
         # transactions)
         self.clearCache()
+        self.commitSessions()
 
     def sql_rollback(self):
         self.conn.rollback()
@@ -1439,6 +2031,7 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
         logging.getLogger('roundup.hyperdb').info('rollback')
 
         self.sql_rollback()
+        self.shared_cache_dirty = {}
 
         # roll back "other" transaction stuff
         for method, args in self.transactions:
@@ -1449,16 +2042,24 @@ class Database(FileStorage, hyperdb.Database, roundupdb.Database):
 
         # clear the cache
         self.clearCache()
+        self.commitSessions()
 
     def sql_close(self):
         logging.getLogger('roundup.hyperdb').info('close')
         self.conn.close()
 
     def close(self):
-        """ Close off the connection.
+        """ Close off the connection, or return it to the connection
+            pool.
         """
         self.indexer.close()
-        self.sql_close()
+        if self.conn is None:
+            # already returned to the pool
+            return
+        if self.release_connection():
+            self.conn = self.cursor = None
+        else:
+            self.sql_close()
 
 #
 # The base Class class
@@ -1474,6 +2075,9 @@ class Class(hyperdb.Class):
     # We define the default here, can be changed in derivative class
     case_insensitive_like = 'LIKE'
 
+    # the ClassStatements, see Database.class_statements
+    statements = None
+
     def schema(self):
         """ A dumpable version of the schema that we can store in the
             database
@@ -1709,6 +2313,30 @@ class Class(hyperdb.Class):
 
         return d[propname]
 
+    def getnodes(self, nodeids, props=None):
+        """Return an iterator over convenience wrappers for the nodes.
+
+        The nodes are fetched with one "id in (...)" query per chunk of
+        ids, the Multilinks listed in 'props' (default: all) with one
+        query per property and chunk. Chunks are no larger than the
+        node cache so the nodes of a chunk are still cached while the
+        caller consumes them.
+        """
+        if props is None:
+            props = self.properties.keys()
+        mls = [p for p in props
+            if isinstance(self.properties.get(p), Multilink)]
+        nodeids = list(nodeids)
+        size = max(1, min(self.db.sql_in_chunk_size, self.db.cache_size))
+        for i in range(0, len(nodeids), size):
+            chunk = nodeids[i:i + size]
+            if mls:
+                self.db.prefetch_multilinks(self.classname, chunk, mls)
+            else:
+                self.db._load_nodes(self.classname, chunk)
+            for nodeid in chunk:
+                yield hyperdb.Node(self, nodeid)
+
     def set(self, nodeid, **propvalues):
         """Modify a property on an existing node of this class.
 
@@ -2640,7 +3268,13 @@ class Class(hyperdb.Class):
         __traceback_info__ = (sql, args)
         return proptree, sql, args
 
-    def filter(self, search_matches, filterspec, sort=[], group=[]):
+    def _sql_limit(self, sql, args, limit, offset):
+        """ Add a LIMIT/OFFSET clause to the sql.
+        """
+        return self.db.sql_limit(sql, args, limit, offset)
+
+    def filter(self, search_matches, filterspec, sort=[], group=[],
+            limit=None, offset=None):
         """Return a list of the ids of the active nodes in this class that
         match the 'filter' spec, sorted by the group spec and then the
         sort spec
@@ -2654,6 +3288,10 @@ class Class(hyperdb.Class):
 
         "search_matches" is a container type or None
 
+        "limit" and "offset" select a page of the (sorted) result. They
+        are passed on to the database unless the sort order has to be
+        computed in python (eg. when sorting by a Multilink).
+
         The filter must match all properties specificed. If the property
         value to match is a list:
 
@@ -2669,6 +3307,11 @@ class Class(hyperdb.Class):
             return []
         proptree, sql, args = sq
 
+        # can the database do the paging?
+        sql_paged = not [s for s in proptree.sortattr if not s.attr_sort_done]
+        if sql_paged:
+            sql, args = self._sql_limit(sql, args, limit, offset)
+
         self.db.sql(sql, args)
         l = self.db.sql_fetchall()
 
@@ -2681,12 +3324,34 @@ class Class(hyperdb.Class):
         # XXX numeric ids
         l = [str(row[0]) for row in l]
         l = proptree.sort (l)
+        if not sql_paged and (limit is not None or offset):
+            offset = offset or 0
+            if limit is None:
+                l = l[offset:]
+            else:
+                l = l[offset:offset + limit]
 
         if __debug__:
             self.db.stats['filtering'] += (time.time() - start_t)
         return l
 
-    def filter_iter(self, search_matches, filterspec, sort=[], group=[]):
+    def filter_count(self, search_matches, filterspec):
+        """Return the number of active nodes in this class that match
+        the 'filter' spec, see filter for the arguments.
+        """
+        sq = self._filter_sql (search_matches, filterspec)
+        # nothing to match?
+        if sq is None:
+            return 0
+        proptree, sql, args = sq
+        self.db.sql('select count(*) from (%s) as filtered'%sql, args)
+        return int(self.db.sql_fetchone()[0])
+
+    # number of rows filter_iter reads (and fetches Multilinks for) at once
+    filter_iter_chunk_size = 50
+
+    def filter_iter(self, search_matches, filterspec, sort=[], group=[],
+            limit=None, offset=None, multilinks=None):
         """Iterator similar to filter above with same args.
         Limitation: We don't sort on multilinks.
         This uses an optimisation: We put all nodes that are in the
@@ -2694,12 +3359,15 @@ class Class(hyperdb.Class):
         That way a fetch of a node won't create another sql-fetch (with
         a join) from the database because the nodes are already in the
         cache. We're using our own temporary cursor.
+        Rows are read in chunks, the Multilink properties named in
+        "multilinks" are fetched for a whole chunk with one query each.
         """
         sq = self._filter_sql(search_matches, filterspec, sort, group, retr=1)
         # nothing to match?
         if sq is None:
             return
         proptree, sql, args = sq
+        sql, args = self._sql_limit(sql, args, limit, offset)
         cursor = self.db.conn.cursor()
         self.db.sql(sql, args, cursor)
         classes = {}
@@ -2713,25 +3381,52 @@ class Class(hyperdb.Class):
                 name = p.name
                 assert (name)
                 classes[key][name] = p
-                p.to_hyperdb = self.db.to_hyperdb_value(p.propclass.__class__)
+        # the row decoders of the classes retrieved:
+        # (classname, id column index, decoder, is this class)
+        decoders = []
+        to_hyperdb_value = self.db.to_hyperdb_value
+        for (classname, ptid), pt in classes.iteritems():
+            decoder = tuple([(p.sql_idx, propname,
+                to_hyperdb_value(p.propclass.__class__))
+                for propname, p in pt.iteritems()])
+            decoders.append((classname, pt['id'].sql_idx, decoder,
+                classname == self.classname and ptid == proptree.id))
+        cache = self.db.cache
         while True:
-            row = cursor.fetchone()
-            if not row: break
-            # populate cache with current items
-            for (classname, ptid), pt in classes.iteritems():
-                nodeid = str(row[pt['id'].sql_idx])
-                key = (classname, nodeid)
-                if key in self.db.cache:
-                    self.db._cache_refresh(key)
-                    continue
-                node = {}
-                for propname, p in pt.iteritems():
-                    value = row[p.sql_idx]
-                    if value is not None:
-                        value = p.to_hyperdb(value)
-                    node[propname] = value
-                self.db._cache_save(key, node)
-            yield str(row[0])
+            rows = cursor.fetchmany(self.filter_iter_chunk_size)
+            if not rows: break
+            # make up the nodes of the current rows
+            chunk = []
+            mlnodes = {}
+            for row in rows:
+                nodes = []
+                for classname, id_idx, decoder, main in decoders:
+                    nodeid = str(row[id_idx])
+                    key = (classname, nodeid)
+                    if key in cache:
+                        node = cache[key]
+                    else:
+                        node = decode_row(decoder, row)
+                    nodes.append((key, node))
+                    if main:
+                        mlnodes[nodeid] = node
+                chunk.append((str(row[0]), nodes))
+            if multilinks:
+                self.db._fetch_multilinks(self.classname, mlnodes, multilinks)
+            for nodeid, nodes in chunk:
+                # populate cache with current items
+                for key, node in nodes:
+                    if key in self.db.cache:
+                        self.db._cache_refresh(key)
+                    else:
+                        self.db._cache_save(key, node)
+                yield nodeid
+
+    def prefetch_multilinks(self, nodeids, propnames=None):
+        """Fetch the given Multilink properties (default: all) of the
+        nodes in bulk, see Database.prefetch_multilinks.
+        """
+        self.db.prefetch_multilinks(self.classname, nodeids, propnames)
 
     def filter_sql(self, sql):
         """Return a list of the ids of the items in this class that match
@@ -2788,6 +3483,7 @@ class Class(hyperdb.Class):
             if key in self.properties:
                 raise ValueError(key)
         self.properties.update(properties)
+        self.statements = None
 
     def index(self, nodeid):
         """Add (or refresh) the node to search indexes
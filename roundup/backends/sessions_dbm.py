@@ -17,9 +17,21 @@ class BasicDatabase:
     ''' Provide a nice encapsulation of an anydbm store.
 
         Keys are id strings, values are automatically marshalled data.
+
+        The dbm file is opened and closed by every call, as two handles
+        open on one file at the same time lose each other's writes.
+
+        For expiry the keys are also filed by their timestamp in a
+        second dbm file, "<name>_expiry", in buckets of "bucket_size"
+        seconds: clean() only has to look at the keys in the buckets
+        old enough to expire.
     '''
     _db_type = None
 
+    # records not used for this many seconds are removed by clean()
+    lifetime = 60*60*24*7
+    bucket_size = 600
+
     def __init__(self, db):
         self.config = db.config
         self.dir = db.config.DATABASE
@@ -33,11 +45,12 @@ class BasicDatabase:
             db.close()
 
     def clear(self):
-        path = os.path.join(self.dir, self.name)
-        if os.path.exists(path):
-            os.remove(path)
-        elif os.path.exists(path+'.db'):    # dbm appends .db
-            os.remove(path+'.db')
+        for name in self.name, self.name + '_expiry':
+            path = os.path.join(self.dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+            elif os.path.exists(path+'.db'):    # dbm appends .db
+                os.remove(path+'.db')
 
     def cache_db_type(self, path):
         ''' determine which DB wrote the class file, and cache it as an
@@ -85,15 +98,44 @@ class BasicDatabase:
     def set(self, infoid, **newvalues):
         db = self.opendb('c')
         try:
-            if key_in(db, infoid):
-                values = marshal.loads(db[infoid])
-            else:
-                values = {'__timestamp': time.time()}
-            values.update(newvalues)
-            db[infoid] = marshal.dumps(values)
+            self.setvalues(db, infoid, newvalues)
         finally:
             db.close()
 
+    def setvalues(self, db, infoid, newvalues):
+        ''' Update the values of the item in the open dbm file "db".
+        '''
+        if key_in(db, infoid):
+            values = marshal.loads(db[infoid])
+            old = values.get('__timestamp')
+        else:
+            values = {'__timestamp': time.time()}
+            old = None
+        values.update(newvalues)
+        # file the key again when it moves to another bucket
+        timestamp = values.get('__timestamp')
+        if timestamp is None or (old is not None and int(old) //
+                self.bucket_size == int(timestamp) // self.bucket_size):
+            db[infoid] = marshal.dumps(values)
+            return
+        # opened before the write, so a new file doesn't get the key twice
+        expiry = self.openexpirydb(db)
+        try:
+            db[infoid] = marshal.dumps(values)
+            self.file_expiry(expiry, infoid, timestamp)
+        finally:
+            expiry.close()
+
+    def file_expiry(self, expiry, infoid, timestamp):
+        ''' File the key in the expiry bucket of its timestamp. An older
+            entry is left in place and dropped by clean().
+        '''
+        bucket = str(int(timestamp) // self.bucket_size)
+        if key_in(expiry, bucket):
+            expiry[bucket] = expiry[bucket] + ' ' + infoid
+        else:
+            expiry[bucket] = infoid
+
     def list(self):
         db = self.opendb('r')
         try:
@@ -109,6 +151,23 @@ class BasicDatabase:
         finally:
             db.close()
 
+    def openexpirydb(self, db):
+        ''' Open the dbm file of the expiry buckets, filing the keys of
+            the open dbm file "db" if it is new.
+        '''
+        path = os.path.join(os.getcwd(), self.dir, self.name + '_expiry')
+        new = not (os.path.exists(path) or os.path.exists(path + '.db')
+            or os.path.exists(path + '.dat'))
+        expiry = anydbm.open(path, 'c')
+        if new:
+            # file the keys stored before there were expiry buckets
+            now = time.time()
+            for infoid in db.keys():
+                values = marshal.loads(db[infoid])
+                self.file_expiry(expiry, infoid,
+                    values.get('__timestamp', now))
+        return expiry
+
     def opendb(self, mode):
         '''Low-level database opener that gets around anydbm/dbm
            eccentricities.
@@ -136,23 +195,59 @@ class BasicDatabase:
 
     def updateTimestamp(self, sessid):
         ''' don't update every hit - once a minute should be OK '''
-        sess = self.get(sessid, '__timestamp', None)
-        now = time.time()
-        if sess is None or now > sess + 60:
-            self.set(sessid, __timestamp=now)
-
-    def clean(self):
-        ''' Remove session records that haven't been used for a week. '''
-        now = time.time()
-        week = 60*60*24*7
-        for sessid in self.list():
-            sess = self.get(sessid, '__timestamp', None)
-            if sess is None:
-                self.updateTimestamp(sessid)
-                continue
-            interval = now - sess
-            if interval > week:
-                self.destroy(sessid)
+        db = self.opendb('c')
+        try:
+            sess = None
+            if key_in(db, sessid):
+                sess = marshal.loads(db[sessid]).get('__timestamp')
+            now = time.time()
+            if sess is None or now > sess + 60:
+                self.setvalues(db, sessid, {'__timestamp': now})
+        finally:
+            db.close()
+
+    def clean(self, limit=None):
+        ''' Remove records that haven't been used for a week.
+
+            Look at no more than "limit" keys filed in the expiry buckets,
+            oldest first. Return the number of keys looked at, which is
+            less than "limit" once nothing is left to expire.
+        '''
+        db = self.opendb('c')
+        try:
+            expiry = self.openexpirydb(db)
+            try:
+                return self.clean_buckets(db, expiry, limit)
+            finally:
+                expiry.close()
+        finally:
+            db.close()
+
+    def clean_buckets(self, db, expiry, limit):
+        old = time.time() - self.lifetime
+        last = int(old) // self.bucket_size
+        buckets = [int(bucket) for bucket in expiry.keys()]
+        buckets.sort()
+        count = 0
+        for bucket in buckets:
+            if bucket >= last or count == limit:
+                break
+            infoids = expiry[str(bucket)].split()
+            while infoids and count != limit:
+                infoid = infoids.pop()
+                count += 1
+                if not key_in(db, infoid):
+                    continue
+                timestamp = marshal.loads(db[infoid]).get('__timestamp')
+                if timestamp is None:
+                    self.file_expiry(expiry, infoid, time.time())
+                elif timestamp < old:
+                    del db[infoid]
+            if infoids:
+                expiry[str(bucket)] = ' '.join(infoids)
+            else:
+                del expiry[str(bucket)]
+        return count
 
 class Sessions(BasicDatabase):
     name = 'sessions'
@@ -6,71 +6,109 @@ class. It's now also used for One Time Key handling too.
 """
 __docformat__ = 'restructuredtext'
 
-import os, time
+import os, time, marshal, base64
 from cgi import escape
 
+def encode_value(values):
+    ''' Return the dict "values" as text to store in a value column.
+    '''
+    return base64.b64encode(marshal.dumps(values))
+
+def decode_value(text):
+    return marshal.loads(base64.b64decode(text))
+
+def upgrade_value(text):
+    ''' Return the repr() text a value column held before version 7 of
+    the database as the text it holds now, None if it can't be read.
+    '''
+    try:
+        values = eval(text, {'__builtins__': {}}, {})
+    except Exception:
+        return None
+    if not isinstance(values, dict):
+        return None
+    return encode_value(values)
+
 class BasicDatabase:
     ''' Provide a nice encapsulation of an RDBMS table.
 
         Keys are id strings, values are automatically marshalled data.
+
+        The values read or written are remembered, so that set() of an
+        item already seen needs a single update (or insert) statement.
     '''
+    # records not used for this many seconds are removed by clean()
+    lifetime = 60*60*24*7
+
     def __init__(self, db):
         self.db = db
         self.cursor = self.db.cursor
+        # infoid -> values, or None if there's no such item
+        self.values = {}
 
     def clear(self):
         self.cursor.execute('delete from %ss'%self.name)
+        self.values = {}
 
     def exists(self, infoid):
-        n = self.name
-        self.cursor.execute('select count(*) from %ss where %s_key=%s'%(n,
-            n, self.db.arg), (infoid,))
-        return int(self.cursor.fetchone()[0])
+        return self.load(infoid) is not None
 
-    _marker = []
-    def get(self, infoid, value, default=_marker):
+    def load(self, infoid):
+        ''' Return the values of the item, None if it doesn't exist.
+        '''
+        if infoid in self.values:
+            return self.values[infoid]
         n = self.name
         self.cursor.execute('select %s_value from %ss where %s_key=%s'%(n,
             n, n, self.db.arg), (infoid,))
         res = self.cursor.fetchone()
-        if not res:
+        if res:
+            values = decode_value(res[0])
+        else:
+            values = None
+        self.values[infoid] = values
+        return values
+
+    _marker = []
+    def get(self, infoid, value, default=_marker):
+        values = self.load(infoid)
+        if values is None:
             if default != self._marker:
                 return default
             raise KeyError('No such %s "%s"'%(self.name, escape(infoid)))
-        values = eval(res[0])
         return values.get(value, None)
 
     def getall(self, infoid):
-        n = self.name
-        self.cursor.execute('select %s_value from %ss where %s_key=%s'%(n,
-            n, n, self.db.arg), (infoid,))
-        res = self.cursor.fetchone()
-        if not res:
+        values = self.load(infoid)
+        if values is None:
             raise KeyError('No such %s "%s"'%(self.name, escape (infoid)))
-        return eval(res[0])
+        return dict(values)
 
     def set(self, infoid, **newvalues):
-        c = self.cursor
-        n = self.name
-        a = self.db.arg
-        c.execute('select %s_value from %ss where %s_key=%s'%(n, n, n, a),
-            (infoid,))
-        res = c.fetchone()
-        if res:
-            values = eval(res[0])
+        values = self.load(infoid)
+        exists = values is not None
+        if exists:
+            values = dict(values)
         else:
             values = {}
         values.update(newvalues)
-
-        if res:
-            sql = 'update %ss set %s_value=%s where %s_key=%s'%(n, n,
-                a, n, a)
-            args = (repr(values), infoid)
-        else:
-            sql = 'insert into %ss (%s_key, %s_time, %s_value) '\
-                'values (%s, %s, %s)'%(n, n, n, n, a, a, a)
-            args = (infoid, time.time(), repr(values))
-        c.execute(sql, args)
+        n = self.name
+        a = self.db.arg
+        now = time.time()
+        args = (encode_value(values), now, infoid)
+        if exists:
+            self.cursor.execute('update %ss set %s_value=%s, %s_time=%s '
+                'where %s_key=%s'%(n, n, a, n, a, n, a), args)
+            # MySQL counts only the rows changed, so make sure
+            if self.cursor.rowcount == 0:
+                self.cursor.execute('select 1 from %ss where %s_key=%s'%(n,
+                    n, a), (infoid,))
+                exists = self.cursor.fetchone() is not None
+        if not exists:
+            # a new item or one destroyed by someone else since
+            self.cursor.execute('insert into %ss (%s_value, %s_time, %s_key) '
+                'values (%s, %s, %s)'%(n, n, n, n, a, a, a), args)
+        self.values[infoid] = values
 
     def list(self):
         c = self.cursor
@@ -81,6 +119,7 @@ class BasicDatabase:
     def destroy(self, infoid):
         self.cursor.execute('delete from %ss where %s_key=%s'%(self.name,
             self.name, self.db.arg), (infoid,))
+        self.values[infoid] = None
 
     def updateTimestamp(self, infoid):
         """ don't update every hit - once a minute should be OK """
@@ -90,13 +129,43 @@ class BasicDatabase:
             self.name, self.db.arg, self.name, self.db.arg),
             (now, infoid, now-60))
 
-    def clean(self):
-        ''' Remove session records that haven't been used for a week. '''
-        now = time.time()
-        week = 60*60*24*7
-        old = now - week
-        self.cursor.execute('delete from %ss where %s_time < %s'%(self.name,
-            self.name, self.db.arg), (old, ))
+    def commit(self):
+        ''' Forget the values read, others may change them from now on.
+        '''
+        self.values = {}
+        # the database opens a new cursor for every transaction
+        self.cursor = self.db.cursor
+
+    def close(self):
+        self.values = {}
+
+    def clean(self, limit=None):
+        ''' Remove records that haven't been used for a week.
+
+            Remove no more than "limit" records, the oldest first, found
+            through the index of the time column. Return the number
+            removed, which is less than "limit" once nothing is left to
+            expire.
+        '''
+        n = self.name
+        a = self.db.arg
+        old = time.time() - self.lifetime
+        self.values = {}
+        if limit is None:
+            self.cursor.execute('delete from %ss where %s_time < %s'%(n, n,
+                a), (old, ))
+            return self.cursor.rowcount
+        sql, args = self.db.sql_limit('select %s_key from %ss where '
+            '%s_time < %s order by %s_time'%(n, n, n, a, n), (old,), limit,
+            None)
+        self.cursor.execute(sql, args)
+        keys = [row[0] for row in self.cursor.fetchall()]
+        # stay below the SQLite limit of 999 arguments
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            self.cursor.execute('delete from %ss where %s_key in (%s)'%(n,
+                n, ','.join([a] * len(chunk))), tuple(chunk))
+        return len(keys)
 
 class Sessions(BasicDatabase):
     name = 'session'
@@ -1026,8 +1026,20 @@ class ExportCSVAction(Action):
     name = 'export'
     permissionType = 'View'
 
+    # number of items converted to rows at a time
+    chunk_size = 100
+    # write the CSV text out whenever this many bytes are pending
+    flush_size = 64 * 1024
+
     def handle(self):
-        ''' Export the specified search query as CSV. '''
+        ''' Export the specified search query as CSV.
+
+        The items are streamed: their ids come from filter_iter (or from
+        filter when sorting by a Multilink), rows are made a chunk of
+        items at a time with the labels of Link and Multilink values
+        fetched in bulk, and the CSV text is written out whenever
+        flush_size bytes are pending.
+        '''
         # figure the request
         request = templating.HTMLRequest(self.client)
         filterspec = request.filterspec
@@ -1050,8 +1062,8 @@ class ExportCSVAction(Action):
 
         # full-text search
         if request.search_text:
-            matches = self.db.indexer.search(
-                re.findall(r'\b\w{2,25}\b', request.search_text), klass)
+            matches = self.db.indexer.search_scores(request.search_text,
+                klass)
         else:
             matches = None
 
@@ -1060,34 +1072,136 @@ class ExportCSVAction(Action):
         # some browsers will honor the filename here...
         h['Content-Disposition'] = 'inline; filename=query.csv'
 
+        compress = self.client.use_compression(h['Content-Type'])
         self.client.header()
 
         if self.client.env['REQUEST_METHOD'] == 'HEAD':
             # all done, return a dummy string
             return 'dummy'
 
+        if compress:
+            self.client.start_compression()
+
         wfile = self.client.request.wfile
         if self.client.charset != self.client.STORAGE_CHARSET:
             wfile = codecs.EncodedFile(wfile,
                 self.client.STORAGE_CHARSET, self.client.charset, 'replace')
 
-        writer = csv.writer(wfile)
-        self.client._socket_op(writer.writerow, columns)
+        # the permission to view a column is decided once; only the
+        # columns depending on check functions are checked per item
+        checked = []
+        for name in columns:
+            granted, perms = self.db.security.getDecision('View',
+                self.client.userid, request.classname, name)
+            if not granted:
+                checked.append(name)
+
+        buf = io_.BytesIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        multilinks = [name for name in columns
+            if isinstance(props[name], hyperdb.Multilink)]
+        if self.sorts_on_multilink(klass, sort + group):
+            # filter_iter doesn't sort by Multilinks
+            itemids = klass.filter(matches, filterspec, sort, group)
+        else:
+            itemids = klass.filter_iter(matches, filterspec, sort, group,
+                multilinks=multilinks)
+        chunk = []
+        for itemid in itemids:
+            chunk.append(itemid)
+            if len(chunk) < self.chunk_size:
+                continue
+            self.write_rows(writer, klass, columns, checked, chunk)
+            chunk = []
+            if buf.tell() >= self.flush_size and not self.flush(wfile, buf):
+                # the client went away
+                return '\n'
+        if chunk:
+            self.write_rows(writer, klass, columns, checked, chunk)
+        self.flush(wfile, buf)
+        return '\n'
+
+    def sorts_on_multilink(self, klass, sortattrs):
+        ''' Tell whether any of the (direction, property path) pairs
+        "sortattrs" goes through a Multilink.
+        '''
+        for direction, name in sortattrs:
+            path = name.split('.')
+            for i in range(len(path)):
+                prop = klass.get_transitive_prop('.'.join(path[:i+1]))
+                if isinstance(prop, hyperdb.Multilink):
+                    return True
+        return False
+
+    def write_rows(self, writer, klass, columns, checked, itemids):
+        ''' Write the rows of the items "itemids".
+
+        Raise Unauthorised at the first item a "checked" column may not
+        be viewed of.
+        '''
+        classname = klass.classname
+        allowed = {}
+        for name in checked:
+            allowed[name] = dict.fromkeys(self.db.security.filterItems(
+                'View', self.client.userid, classname, itemids, name))
+
+        # find the linked items in the chunk and fetch their labels
+        props = klass.getprops()
+        labels = self.db.getlabels()
+        links = {}
+        klass.prefetch_multilinks(itemids, [name for name in columns
+            if isinstance(props[name], hyperdb.Multilink)])
+        for name in columns:
+            prop = props[name]
+            if isinstance(prop, hyperdb.Link):
+                labels.want(prop.classname, [v for v in
+                    [klass.get(itemid, name) for itemid in itemids] if v])
+                links[name] = prop.classname
+            elif isinstance(prop, hyperdb.Multilink):
+                for itemid in itemids:
+                    labels.want(prop.classname, klass.get(itemid, name))
+                links[name] = prop.classname
+
+        def label(classname, linkid):
+            try:
+                return str(labels.get(classname, linkid))
+            except IndexError:
+                return linkid
 
-        # and search
-        for itemid in klass.filter(matches, filterspec, sort, group):
+        for itemid in itemids:
             row = []
             for name in columns:
                 # check permission to view this property on this item
-                if not self.hasPermission('View', itemid=itemid,
-                        classname=request.classname, property=name):
+                if name in allowed and itemid not in allowed[name]:
                     raise exceptions.Unauthorised(self._(
                         'You do not have permission to view %(class)s'
-                    ) % {'class': request.classname})
-                row.append(str(klass.get(itemid, name)))
-            self.client._socket_op(writer.writerow, row)
+                    ) % {'class': classname})
+                value = klass.get(itemid, name)
+                if value is None:
+                    row.append('')
+                elif name not in links:
+                    row.append(str(value))
+                elif isinstance(value, type([])):
+                    row.append(';'.join([label(links[name], v)
+                        for v in value]))
+                else:
+                    row.append(label(links[name], value))
+            writer.writerow(row)
 
-        return '\n'
+    def flush(self, wfile, buf):
+        ''' Write the CSV text pending in "buf" to the client.
+
+        Return False if the client has gone away.
+        '''
+        data = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        if not self.client._socket_op(wfile.write, data):
+            return False
+        if hasattr(wfile, 'flush'):
+            return self.client._socket_op(wfile.flush)
+        return True
 
 
 class Bridge(BaseAction):
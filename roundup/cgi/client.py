@@ -3,8 +3,8 @@
 __docformat__ = 'restructuredtext'
 
 import base64, binascii, cgi, codecs, mimetypes, os
-import quopri, random, re, stat, sys, time
-import socket, errno
+import quopri, random, re, stat, sys, time, logging
+import socket, errno, threading, struct, zlib
 import email.utils
 from traceback import format_exc
 
@@ -13,7 +13,7 @@ try:
 except ImportError:
     SysCallError = None
 
-from roundup import roundupdb, date, hyperdb, password
+from roundup import roundupdb, date, hyperdb, password, profiler
 from roundup.cgi import templating, cgitb, TranslationService
 from roundup.cgi.actions import *
 from roundup.exceptions import *
@@ -25,7 +25,7 @@ from roundup import xmlrpc
 
 from roundup.anypy.cookie_ import CookieError, BaseCookie, SimpleCookie, \
     get_cookie_date
-from roundup.anypy.io_ import StringIO
+from roundup.anypy.io_ import StringIO, BytesIO
 from roundup.anypy import http_
 from roundup.anypy import urllib_
 
@@ -204,6 +204,180 @@ class Session:
 
 
 
+class SessionExpiry(threading.Thread):
+    """Remove the expired sessions and One Time Keys of a tracker once an
+       hour, a batch per transaction, in a background thread.
+
+       start_for() runs one such thread per tracker in the process.
+    """
+    interval = 60*60
+
+    # tracker home -> SessionExpiry thread
+    threads = {}
+    lock = threading.Lock()
+
+    def start_for(cls, tracker):
+        cls.lock.acquire()
+        try:
+            thread = cls.threads.get(tracker.tracker_home)
+            # threads don't survive a fork() of a prefork worker
+            if thread is None or not thread.isAlive():
+                thread = cls.threads[tracker.tracker_home] = cls(tracker)
+                thread.start()
+        finally:
+            cls.lock.release()
+    start_for = classmethod(start_for)
+
+    def __init__(self, tracker):
+        threading.Thread.__init__(self, name='roundup-session-expiry')
+        self.setDaemon(True)
+        self.tracker = tracker
+
+    def run(self):
+        while 1:
+            try:
+                self.expire()
+            except:
+                logging.getLogger('roundup').exception(
+                    'removing expired sessions failed')
+            time.sleep(self.interval)
+
+    def expire(self):
+        db = self.tracker.open('admin')
+        failed = True
+        try:
+            batch_size = self.tracker.config.WEB_SESSION_EXPIRY_BATCH_SIZE
+            while db.expire_sessions(batch_size):
+                db.commit()
+            db.commit()
+            failed = False
+        finally:
+            self.tracker.release_db(db, failed)
+
+class GzipWriter:
+    """Compress the data written to a file with the gzip content coding
+       (RFC 1952) as it is written.
+
+       flush() sends out what has been compressed so far, close() ends
+       the compressed data but leaves the file open.
+    """
+    # magic, deflate, no flags, no modification time, unknown OS
+    header = '\037\213\010\000\000\000\000\000\000\377'
+
+    def __init__(self, wfile, level=6):
+        self.wfile = wfile
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+            -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.started = 0
+
+    def _write(self, data):
+        if not self.started:
+            data = self.header + data
+            self.started = 1
+        if data:
+            self.wfile.write(data)
+
+    def write(self, data):
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self._write(self.compressor.compress(data))
+
+    def flush(self):
+        self._write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        if hasattr(self.wfile, 'flush'):
+            self.wfile.flush()
+
+    def close(self):
+        self._write(self.compressor.flush() + struct.pack('<LL',
+            self.crc & 0xffffffffL, self.size & 0xffffffffL))
+
+def gzip_string(data, level=6):
+    """Return 'data' compressed with the gzip content coding."""
+    out = BytesIO()
+    writer = GzipWriter(out, level)
+    writer.write(data)
+    writer.close()
+    return out.getvalue()
+
+class PageStream:
+    """The file templates are rendered to when pages are streamed.
+
+       What is written is sent to the client whenever chunk_size bytes
+       have been gathered; the headers go out with the first chunk, so
+       errors found before then are reported as usual. Until the first
+       chunk has been sent, "started" is false.
+    """
+    def __init__(self, client, chunk_size):
+        self.client = client
+        self.chunk_size = chunk_size
+        self.content_type = 'text/html'
+        self.buffer = []
+        self.size = 0
+        self.started = 0
+        self.gone = 0
+        self.decoder = None
+        if client.charset != client.STORAGE_CHARSET:
+            self.decoder = codecs.getincrementaldecoder(
+                client.STORAGE_CHARSET)('replace')
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def getvalue(self):
+        return ''.join(self.buffer)
+
+    def discard(self):
+        """Forget what hasn't been sent yet."""
+        self.buffer = []
+        self.size = 0
+
+    def flush(self, final=False):
+        """Send what has been written so far.
+
+        Raise IOError, and set "gone", if the client has gone away to
+        stop the rendering.
+        """
+        client = self.client
+        data = self.getvalue()
+        self.discard()
+        if self.decoder is not None:
+            # recode output, keeping characters split between chunks
+            data = self.decoder.decode(data, final)
+            data = data.encode(client.charset, 'xmlcharrefreplace')
+        if not self.started:
+            self.started = 1
+            client.additional_headers['Content-Type'] = self.content_type
+            compress = client.use_compression(self.content_type)
+            client.header()
+            if compress:
+                client.start_compression()
+        wfile = client.request.wfile
+        if not client._socket_op(wfile.write, data) or (
+                hasattr(wfile, 'flush')
+                and not client._socket_op(wfile.flush)):
+            self.gone = 1
+            raise IOError('the client has gone away')
+
+    def close(self):
+        """Send the rest of the page.
+        """
+        if self.started:
+            self.flush(final=True)
+        else:
+            # the whole page fits in a chunk
+            self.client.additional_headers['Content-Type'] = \
+                self.content_type
+            self.client.write_html(self.getvalue())
+            self.discard()
+
+
 class Client:
     """Instantiate to handle one CGI request.
 
@@ -256,6 +430,17 @@ class Client:
     # XXX take this from instance.config?
     STORAGE_CHARSET = 'utf-8'
 
+    # size of the blocks files are read and sent in when the request
+    # doesn't provide a sendfile method
+    FILE_CHUNK_SIZE = 64 * 1024
+
+    # zlib compression level of the responses compressed on the fly
+    COMPRESSION_LEVEL = 6
+
+    # size of the pieces pages are sent in if the "stream_templates"
+    # option is set
+    STREAM_CHUNK_SIZE = 16 * 1024
+
     #
     # special form variables
     #
@@ -292,6 +477,11 @@ class Client:
         self.instance = instance
         self.request = request
         self.env = env
+        # statistics of this request, see roundup.profiler
+        if instance.config.WEB_PROFILE or env.get('CGI_SHOW_TIMING'):
+            self.profile = profiler.Profile()
+        else:
+            self.profile = None
         self.setTranslator(translator)
         self.mailer = Mailer(instance.config)
 
@@ -331,6 +521,10 @@ class Client:
         # flag to indicate that the HTTP headers have been sent
         self.headers_done = 0
 
+        # the GzipWriter request.wfile is replaced with while a response
+        # is compressed as it is written
+        self.gzip_writer = None
+
         # additional headers to send with the request - must be registered
         # before the first write
         self.additional_headers = {}
@@ -371,14 +565,44 @@ class Client:
     def main(self):
         """ Wrap the real main in a try/finally so we always close off the db.
         """
+        failed = True
         try:
             if self.path == 'xmlrpc':
                 self.handle_xmlrpc()
             else:
                 self.inner_main()
+            failed = False
         finally:
+            self.finish_compression()
+            if self.profile:
+                self.log_profile()
             if hasattr(self, 'db'):
-                self.db.close()
+                self.instance.release_db(self.db, failed)
+
+    def log_profile(self):
+        """Log the statistics of the request if the tracker's "profile"
+        option is set: to the "roundup.profile" logger and, if the
+        "profile_log" option is set, to that file as a line of JSON.
+        """
+        config = self.instance.config
+        if config.WEB_PROFILE:
+            if self.path == 'xmlrpc':
+                page = 'xmlrpc'
+            else:
+                page = self.classname or 'home'
+                if self.template:
+                    page = '%s.%s' % (page, self.template)
+            line = profiler.dumps(self.profile.report(page=page,
+                path=self.path, method=self.env.get('REQUEST_METHOD'),
+                status=self.response_code, userid=self.userid))
+            logging.getLogger('roundup.profile').info(line)
+            if config.WEB_PROFILE_LOG:
+                f = open(config.WEB_PROFILE_LOG, 'a')
+                try:
+                    f.write(line + '\n')
+                finally:
+                    f.close()
+        self.profile.detach()
 
 
     def handle_xmlrpc(self):
@@ -500,7 +724,7 @@ class Client:
                     email.utils.formatdate(date, usegmt=True)
 
                 # render the content
-                self.write_html(self.renderContext())
+                self.write_context()
             except SendFile, designator:
                 # The call to serve_file may result in an Unauthorised
                 # exception or a NotModified exception.  Those
@@ -553,7 +777,7 @@ class Client:
             self.template = '404'
             try:
                 cl = self.db.getclass(self.classname)
-                self.write_html(self.renderContext())
+                self.write_context()
             except KeyError:
                 # we can't map the URL to a class we know about
                 # reraise the NotFound and let roundup_server
@@ -561,7 +785,7 @@ class Client:
                 raise NotFound(e)
         except FormError, e:
             self.add_error_message(self._('Form Error: ') + str(e))
-            self.write_html(self.renderContext())
+            self.write_context()
         except IOError:
             # IOErrors here are due to the client disconnecting before
             # receiving the reply.
@@ -598,8 +822,17 @@ class Client:
     def clean_up(self):
         """Remove expired sessions and One Time Keys.
 
-           Do it only once an hour.
+           Depending on the "session_expiry" option this is done here
+           (once an hour, a batch at a time until all are gone), in a
+           background SessionExpiry thread or by "roundup-admin expire".
         """
+        config = self.instance.config
+        if config.WEB_SESSION_EXPIRY == 'thread':
+            SessionExpiry.start_for(self.instance)
+            return
+        if config.WEB_SESSION_EXPIRY != 'request':
+            return
+
         hour = 60*60
         now = time.time()
 
@@ -609,9 +842,8 @@ class Client:
         if now - last_clean < hour:
             return
 
-        self.session_api.clean_up()
-        self.db.getOTKManager().clean()
-        self.db.getOTKManager().set('last_clean', last_use=now)
+        if not self.db.expire_sessions(config.WEB_SESSION_EXPIRY_BATCH_SIZE):
+            self.db.getOTKManager().set('last_clean', last_use=now)
         self.db.commit(fail_ok=True)
 
     def determine_charset(self):
@@ -836,6 +1068,8 @@ class Client:
                 # The old session API refers to the closed database;
                 # we can no longer use it.
                 self.session_api = Session(self)
+        if self.profile and self.profile.db is not self.db:
+            self.profile.attach(self.db)
 
 
     def determine_context(self, dre=re.compile(r'([^\d]+)0*(\d+)')):
@@ -1068,6 +1302,19 @@ class Client:
             else:
                 mime_type = 'text/plain'
 
+        # serve the precompressed copy of the file if there is an up to
+        # date one and the client accepts it
+        if self.instance.config.WEB_COMPRESSION:
+            try:
+                gz_lmt = os.stat(filename + '.gz')[stat.ST_MTIME]
+            except OSError:
+                gz_lmt = None
+            if gz_lmt is not None and gz_lmt >= lmt:
+                self.add_vary('Accept-Encoding')
+                if self.accepts_gzip():
+                    filename += '.gz'
+                    self.setHeader('Content-Encoding', 'gzip')
+
         self._serve_file(lmt, mime_type, '', filename)
 
     def _serve_file(self, lmt, mime_type, content=None, filename=None):
@@ -1123,7 +1370,7 @@ class Client:
         self.classname = self.nodeid = None
         self.template = ''
         self.add_error_message(message)
-        self.write_html(self.renderContext())
+        self.write_context()
 
     def selectTemplate(self, name, view):
         """ Choose existing template for the given combination of
@@ -1165,8 +1412,63 @@ class Client:
             '"%s" with template "%s" (neither "%s" nor "%s")' % (name, view,
             tplname, generic))
 
-    def renderContext(self):
+    def profile_footer(self, starttag, endtag, limit=10):
+        """Return the SQL, template and permission statistics of the
+        request so far for the CGI_SHOW_TIMING page footer.
+        """
+        report = self.profile.report()
+        report['starttag'], report['endtag'] = starttag, endtag
+        s = self._("%(starttag)sSQL: %(sql_count)d statements in %(sql_time)f"
+            " secs. Permission checks: %(permission_checks)d.%(endtag)s\n"
+            ) % report
+        for label, entries in (('SQL', report['sql']),
+                ('Template', report['templates'])):
+            for name, count, seconds in entries[:limit]:
+                if endtag == ' -->':
+                    name = name.replace('--', '- -')
+                else:
+                    name = cgi.escape(name)
+                s += '%s%s: %dx %fs %s%s\n' % (starttag, label, count,
+                    seconds, name, endtag)
+        return s
+
+    def write_context(self):
+        """ Render the page for the context and send it.
+
+            If the "stream_templates" option is set, the page is sent a
+            piece at a time while it is rendered (see PageStream). An
+            error found once the first piece has been sent can only be
+            reported at the point reached in the page.
+        """
+        if (not self.instance.config.WEB_STREAM_TEMPLATES
+                or self.headers_done
+                or self.env['REQUEST_METHOD'] == 'HEAD'
+                or self.env.get('CGI_SHOW_TIMING', '')):
+            self.write_html(self.renderContext())
+            return
+
+        stream = PageStream(self, self.STREAM_CHUNK_SIZE)
+        try:
+            html = self.renderContext(stream)
+        except Unauthorised, message:
+            if not stream.started:
+                raise
+            html = '<strong>%s</strong>' % message
+        if html:
+            # an error page or message
+            if not stream.started:
+                stream.discard()
+                self.write_html(html)
+                return
+            stream.write(html)
+        stream.close()
+
+    def renderContext(self, stream=None):
         """ Return a PageTemplate for the named page
+
+            If 'stream' is given, the page is written to it (see
+            write_context) and an empty string is returned unless the
+            page couldn't be rendered.
         """
         tplname = self.selectTemplate(self.classname, self.template)
 
@@ -1178,7 +1480,18 @@ class Client:
         try:
             pt = self.instance.templates.load(tplname)
             # let the template render figure stuff out
-            result = pt.render(self, None, None, **args)
+            if self.profile:
+                start = time.time()
+            if stream is None:
+                result = pt.render(self, None, None, **args)
+            else:
+                stream.content_type = pt.content_type
+                pt.render_stream(stream, self, None, None, **args)
+            if self.profile:
+                self.profile.add_template(tplname, time.time() - start)
+            if stream is not None:
+                # the page has been written to the stream
+                return ''
             self.additional_headers['Content-Type'] = pt.content_type
             if self.env.get('CGI_SHOW_TIMING', ''):
                 if self.env['CGI_SHOW_TIMING'].upper() == 'COMMENT':
@@ -1195,6 +1508,9 @@ class Client:
                         " Loading items: %(get_items)f secs."
                         " Filtering: %(filtering)f secs."
                         "%(endtag)s\n") % timings
+                if self.profile:
+                    s += self.profile_footer(timings['starttag'],
+                        timings['endtag'])
                 s += '</body>'
                 result = result.replace('</body>', s)
             return result
@@ -1203,6 +1519,9 @@ class Client:
         except templating.Unauthorised, message:
             raise Unauthorised(cgi.escape(str(message)))
         except:
+            if stream is not None and stream.gone:
+                # the client has gone away while the page was streamed
+                raise
             # everything else
             if self.instance.config.WEB_DEBUG:
                 return cgitb.pt_html(i18n=self.translator)
@@ -1299,9 +1618,12 @@ class Client:
             call: a callable to execute
             args, kwargs: call arguments
 
+        Return True if the operation succeeded.
+
         """
         try:
             call(*args, **kwargs)
+            return True
         except socket.error, err:
             err_errno = getattr (err, 'errno', None)
             if err_errno is None:
@@ -1322,30 +1644,127 @@ class Client:
 
     def write(self, content):
         if not self.headers_done:
+            content = self.compress(content)
             self.header()
         if self.env['REQUEST_METHOD'] != 'HEAD':
             self._socket_op(self.request.wfile.write, content)
 
     def write_html(self, content):
+        if self.charset != self.STORAGE_CHARSET:
+            # recode output
+            content = content.decode(self.STORAGE_CHARSET, 'replace')
+            content = content.encode(self.charset, 'xmlcharrefreplace')
+
         if not self.headers_done:
             # at this point, we are sure about Content-Type
             if 'Content-Type' not in self.additional_headers:
                 self.additional_headers['Content-Type'] = \
                     'text/html; charset=%s' % self.charset
+            content = self.compress(content)
             self.header()
 
         if self.env['REQUEST_METHOD'] == 'HEAD':
             # client doesn't care about content
             return
 
-        if self.charset != self.STORAGE_CHARSET:
-            # recode output
-            content = content.decode(self.STORAGE_CHARSET, 'replace')
-            content = content.encode(self.charset, 'xmlcharrefreplace')
-
         # and write
         self._socket_op(self.request.wfile.write, content)
 
+    def accepts_gzip(self):
+        """Return whether the client accepts the gzip content coding.
+        """
+        # RFC 2616 14.3: Accept-Encoding
+        #
+        # A coding is not acceptable if its quality value is 0; "*"
+        # stands for the codings not listed.
+        accept = {}
+        for element in self.http_split(
+                self.env.get('HTTP_ACCEPT_ENCODING', '')):
+            params = element.split(';')
+            qvalue = 1.0
+            for param in params[1:]:
+                name, value = (param.split('=', 1) + [''])[:2]
+                if self.http_strip(name).lower() == 'q':
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            accept[self.http_strip(params[0]).lower()] = qvalue
+        for coding in ('gzip', 'x-gzip', '*'):
+            if coding in accept:
+                return accept[coding] > 0
+        return False
+
+    def add_vary(self, header):
+        """Add 'header' to the request headers the response varies on.
+        """
+        vary = self.http_split(self.additional_headers.get('Vary', ''))
+        if header.lower() not in [h.lower() for h in vary]:
+            vary.append(header)
+            self.setHeader('Vary', ', '.join(vary))
+
+    def use_compression(self, mime_type, length=None):
+        """Decide whether to compress a response of 'mime_type' which is
+        'length' bytes long (None if that isn't known beforehand).
+
+        The response is compressed if it is of one of the MIME types of
+        the "compression_types" option, isn't smaller than
+        "compression_min_size" and the client accepts gzip; the
+        Content-Encoding and Vary headers are set accordingly.
+        """
+        config = self.instance.config
+        if (not config.WEB_COMPRESSION or not mime_type
+                or 'Content-Encoding' in self.additional_headers
+                or self.response_code in (204, 206, 304)):
+            return False
+        mime_type = mime_type.split(';')[0].strip().lower()
+        if mime_type not in [t.strip().lower()
+                for t in config.WEB_COMPRESSION_TYPES]:
+            return False
+        if length is not None and length < config.WEB_COMPRESSION_MIN_SIZE:
+            return False
+        self.add_vary('Accept-Encoding')
+        if not self.accepts_gzip():
+            return False
+        self.setHeader('Content-Encoding', 'gzip')
+        return True
+
+    def compress(self, content):
+        """Return the complete response body 'content' compressed if
+        use_compression() says so, else 'content' itself.
+
+        Must be called before the headers are sent.
+        """
+        if not self.use_compression(
+                self.additional_headers.get('Content-Type'), len(content)):
+            return content
+        content = gzip_string(content, self.COMPRESSION_LEVEL)
+        if 'Content-Length' in self.additional_headers:
+            self.setHeader('Content-Length', str(len(content)))
+        return content
+
+    def start_compression(self):
+        """Compress everything written to request.wfile from now on,
+        until the end of the request.
+
+        For responses written a piece at a time: call use_compression()
+        before the headers are sent and this once they have been.
+        """
+        if self.gzip_writer is None:
+            self.gzip_writer = GzipWriter(self.request.wfile,
+                self.COMPRESSION_LEVEL)
+            self.request.wfile = self.gzip_writer
+
+    def finish_compression(self):
+        """End the compressed response started by start_compression().
+        """
+        writer = self.gzip_writer
+        if writer is None:
+            return
+        self.gzip_writer = None
+        self.request.wfile = writer.wfile
+        self._socket_op(writer.close)
+
     def http_strip(self, content):
         """Remove HTTP Linear White Space from 'content'.
 
@@ -1522,6 +1941,7 @@ class Client:
         length = stat_info[stat.ST_SIZE]
         # Assume we will return the entire file.
         offset = 0
+        compress = False
         # If the headers have not already been finalized,
         if not self.headers_done:
             # RFC 2616 14.19: ETag
@@ -1531,6 +1951,19 @@ class Client:
             etag = '"%x-%x-%x"' % (stat_info[stat.ST_INO],
                                    length,
                                    stat_info[stat.ST_MTIME])
+            # RFC 2616 14.11: Content-Encoding
+            #
+            # Compress the file as it is sent unless a part of it is
+            # asked for: ranges are of the bytes sent, which aren't
+            # known beforehand. The compressed entity gets an entity
+            # tag of its own.
+            if 'HTTP_RANGE' not in self.env:
+                compress = self.use_compression(
+                    self.additional_headers.get('Content-Type'), length)
+        if compress:
+            self.setHeader("ETag", etag[:-1] + '-gzip"')
+            self.header()
+        elif not self.headers_done:
             self.setHeader("ETag", etag)
             # RFC 2616 14.5: Accept-Ranges
             #
@@ -1555,18 +1988,27 @@ class Client:
             or self.response_code == http_.client.REQUESTED_RANGE_NOT_SATISFIABLE):
             return
         # Use the optimized "sendfile" operation, if possible.
-        if hasattr(self.request, "sendfile"):
+        if compress:
+            self.start_compression()
+        elif hasattr(self.request, "sendfile"):
             self._socket_op(self.request.sendfile, filename, offset, length)
             return
-        # Fallback to the "write" operation.
+        # Fallback to the "write" operation, a chunk at a time so that
+        # large files are not read into memory.
         f = open(filename, 'rb')
         try:
             if offset:
                 f.seek(offset)
-            content = f.read(length)
+            while length > 0:
+                content = f.read(min(length, self.FILE_CHUNK_SIZE))
+                if not content:
+                    break
+                length -= len(content)
+                if not self._socket_op(self.request.wfile.write, content):
+                    # the client has gone away
+                    break
         finally:
             f.close()
-        self.write(content)
 
     def setHeader(self, header, value):
         """Override a header to be returned to the user's browser.
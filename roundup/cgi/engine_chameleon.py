@@ -32,6 +32,10 @@ class RoundupPageTemplate(object):
         output = self._pt.render(None, translate, **c)
         return output.encode(client.charset)
 
+    def render_stream(self, out, client, classname, request, **options):
+        # Chameleon renders the whole page at once
+        out.write(self.render(client, classname, request, **options))
+
     def __getitem__(self, name):
         return self._pt[name]
 
@@ -77,6 +77,12 @@ class Jinja2ProxyPageTemplate(TemplateBase):
         c.update({'options': options})
         return self._tpl.render(c).encode(client.charset, )
 
+    def render_stream(self, out, client, classname, request, **options):
+        c = context(client, self, classname, request)
+        c.update({'options': options})
+        for chunk in self._tpl.generate(c):
+            out.write(chunk.encode(client.charset))
+
     def __getitem__(self, name):
         # [ ] figure out what are these for
         raise NotImplemented
@@ -7,6 +7,7 @@ import errno
 import mimetypes
 import os
 import os.path
+import time
 
 from roundup.cgi.templating import StringIO, context, translationService, TALLoaderBase
 from roundup.cgi.PageTemplates import PageTemplate, GlobalTranslationService
@@ -72,6 +73,13 @@ class RoundupPageTemplate(PageTemplate.PageTemplate):
 
     def render(self, client, classname, request, **options):
         """Render this Page Template"""
+        output = StringIO.StringIO()
+        self.render_stream(output, client, classname, request, **options)
+        return output.getvalue()
+
+    def render_stream(self, out, client, classname, request, **options):
+        """Render this Page Template, the interpreter writing the output
+        to "out" as it goes"""
 
         if not self._v_cooked:
             self._cook()
@@ -87,8 +95,30 @@ class RoundupPageTemplate(PageTemplate.PageTemplate):
         c.update({'options': options})
 
         # and go
-        output = StringIO.StringIO()
-        TALInterpreter.TALInterpreter(self._v_program, self.macros,
-            getEngine().getContext(c), output, tal=1, strictinsert=0)()
-        return output.getvalue()
+        args = (self._v_program, self.macros, getEngine().getContext(c),
+            out)
+        if client.profile:
+            interpreter = ProfilingTALInterpreter(client.profile, tal=1,
+                strictinsert=0, *args)
+        else:
+            interpreter = TALInterpreter.TALInterpreter(tal=1,
+                strictinsert=0, *args)
+        interpreter()
+
+class ProfilingTALInterpreter(TALInterpreter.TALInterpreter):
+    """Record the time spent in each macro used in a profile.
+    """
+    def __init__(self, profile, *args, **kwargs):
+        TALInterpreter.TALInterpreter.__init__(self, *args, **kwargs)
+        self.profile = profile
+
+    def do_useMacro(self, args):
+        start = time.time()
+        TALInterpreter.TALInterpreter.do_useMacro(self, args)
+        self.profile.add_template('macro %s' % args[0], time.time() - start)
+    bytecode_handlers = TALInterpreter.TALInterpreter.bytecode_handlers.copy()
+    bytecode_handlers["useMacro"] = do_useMacro
+    bytecode_handlers_tal = \
+        TALInterpreter.TALInterpreter.bytecode_handlers_tal.copy()
+    bytecode_handlers_tal["useMacro"] = do_useMacro
 
@@ -21,7 +21,7 @@ __docformat__ = 'restructuredtext'
 
 
 import cgi, urllib, re, os.path, mimetypes, csv
-import calendar, textwrap
+import calendar, textwrap, heapq, time
 
 from roundup import hyperdb, date, support
 from roundup import i18n
@@ -178,6 +178,15 @@ class MultiLoader(LoaderBase):
 class TemplateBase:
     content_type = 'text/html'
 
+    def render_stream(self, out, client, classname, request, **options):
+        """ Render the template like render() does, writing the output
+            to the file-like object "out".
+
+            Engines able to produce the output a piece at a time write
+            the pieces as they are produced.
+        """
+        out.write(self.render(client, classname, request, **options))
+
 
 def get_loader(dir, template_engine):
 
@@ -558,6 +567,8 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
         """
         # get the list and sort it nicely
         l = self._klass.list()
+        self._db.getlabels().want(self._classname, l,
+            sort_on or self._klass.orderprop())
         sortfunc = make_sort_function(self._db, self._classname, sort_on)
         l.sort(sortfunc)
 
@@ -567,8 +578,9 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
         if not check('Web Access', userid):
             return []
 
-        l = [HTMLItem(self._client, self._classname, id) for id in l
-            if check('View', userid, self._classname, itemid=id)]
+        l = [HTMLItem(self._client, self._classname, node.nodeid)
+            for node in self._klass.getnodes(l, [])
+            if check('View', userid, self._classname, itemid=node.nodeid)]
 
         return l
 
@@ -583,7 +595,8 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
         userid = self._client.userid
         if not check('Web Access', userid):
             return ''
-        for nodeid in self._klass.list():
+        for node in self._klass.getnodes(self._klass.list(), props):
+            nodeid = node.nodeid
             l = []
             for name in props:
                 # check permission to view this property on this item
@@ -632,9 +645,10 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
         if not check('Web Access', userid):
             return []
 
-        l = [HTMLItem(self._client, self.classname, id)
-             for id in self._klass.filter(None, filterspec, sort, group)
-             if check('View', userid, self.classname, itemid=id)]
+        ids = self._klass.filter(None, filterspec, sort, group)
+        l = [HTMLItem(self._client, self.classname, node.nodeid)
+             for node in self._klass.getnodes(ids, [])
+             if check('View', userid, self.classname, itemid=node.nodeid)]
         return l
 
     def classhelp(self, properties=None, label=''"(list)", width='500',
@@ -743,11 +757,20 @@ class HTMLClass(HTMLInputMixin, HTMLPermissions):
             'ok_message': self._client._ok_message,
             'error_message': self._client._error_message
         }
-        return pt.render(self._client, self.classname, req, **args)
+        profile = self._client.profile
+        if profile:
+            start = time.time()
+        result = pt.render(self._client, self.classname, req, **args)
+        if profile:
+            profile.add_template(tplname, time.time() - start)
+        return result
 
 class _HTMLItem(HTMLInputMixin, HTMLPermissions):
     """ Accesses through an *item*
     """
+    # the most history entries a form variable may ask for
+    max_history_limit = 10000
+
     def __init__(self, client, classname, nodeid, anonymous=0):
         self._client = client
         self._db = client.db
@@ -865,10 +888,26 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
         return []
 
     def history(self, direction='descending', dre=re.compile('^\d+$'),
-            limit=None):
+            limit=None, daterange=None, more=None):
+        """ Render the history of the item as a table.
+
+            Only the latest "limit" entries (in the date.Range or range
+            spec "daterange") are fetched from the database. If "more" is
+            given it is the name of a form variable that overrides
+            "limit" (up to max_history_limit), and a "Show more" link
+            doubling it is added when there are more entries.
+        """
         if not self.is_view_ok():
             return self._('[hidden]')
 
+        if more:
+            try:
+                value = int(self._client.form[more].value)
+            except (KeyError, AttributeError, TypeError, ValueError):
+                value = 0
+            if value > 0:
+                limit = min(value, self.max_history_limit)
+
         # pre-load the history with the current state
         current = {}
         for prop_n in self._props.keys():
@@ -891,14 +930,42 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
                     current[prop_n] = '<a rel="nofollow" href="%s%s">%s</a>'%(
                         classname, id, current[prop_n])
 
-        # get the journal, sort and reverse
-        history = self._klass.history(self._nodeid)
-        history.sort()
-        history.reverse()
-
-        # restrict the volume
+        # get the latest entries, and one more to know whether there
+        # are more of them
         if limit:
+            history = self._klass.history(self._nodeid, 'descending',
+                limit + 1, daterange=daterange)
+            truncated = len(history) > limit
             history = history[:limit]
+        else:
+            history = self._klass.history(self._nodeid, 'descending',
+                daterange=daterange)
+            truncated = False
+
+        # declare the labels shown so they are fetched in bulk
+        labels = self._db.getlabels()
+        for id, evt_date, user, action, args in history:
+            if dre.match(user):
+                labels.want('user', [user], 'username')
+            if type(args) != type({}):
+                continue
+            for k, v in args.items():
+                prop = self._props.get(k)
+                if not v or not isinstance(prop, (hyperdb.Link,
+                        hyperdb.Multilink)):
+                    continue
+                if prop.classname not in self._db.classes:
+                    continue
+                if isinstance(prop, hyperdb.Link):
+                    labels.want(prop.classname, [v])
+                    continue
+                linkids = []
+                for linkid in v:
+                    if isinstance(linkid, type(())):
+                        linkids.extend(linkid[1])
+                    else:
+                        linkids.append(linkid)
+                labels.want(prop.classname, linkids)
 
         timezone = self._db.getUserTimezone()
         l = []
@@ -978,7 +1045,8 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
                                 try:
                                     if labelprop is not None and \
                                             labelprop != 'id':
-                                        label = linkcl.get(linkid, labelprop)
+                                        label = labels.get(classname,
+                                            linkid, labelprop)
                                         label = cgi.escape(label)
                                 except IndexError:
                                     comments['no_link'] = self._(
@@ -1003,8 +1071,8 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
                         # there's no labelprop!
                         if labelprop is not None and labelprop != 'id':
                             try:
-                                label = cgi.escape(linkcl.get(args[k],
-                                    labelprop))
+                                label = cgi.escape(labels.get(classname,
+                                    args[k], labelprop))
                             except IndexError:
                                 comments['no_link'] = self._(
                                     "<strike>The linked node"
@@ -1087,7 +1155,7 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
             # if the user's an itemid, figure the username (older journals
             # have the username)
             if dre.match(user):
-                user = self._db.user.get(user, 'username')
+                user = labels.get('user', user, 'username')
             l.append('<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>'%(
                 date_s, cgi.escape(user), self._(action), arg_s))
         if comments:
@@ -1099,6 +1167,16 @@ class _HTMLItem(HTMLInputMixin, HTMLPermissions):
         if direction == 'ascending':
             l.reverse()
 
+        if truncated and more and limit < self.max_history_limit:
+            # the same page with only the limit raised
+            args = [(k, v) for k, v in cgi.parse_qsl(
+                self._client.env.get('QUERY_STRING', ''), True)
+                if k != more]
+            args.append((more, min(limit * 2, self.max_history_limit)))
+            l.append('<tr><td colspan=4><a rel="nofollow" href="%s%s?%s">'
+                '%s</a></td></tr>'%(self._classname, self._nodeid,
+                cgi.escape(urllib.urlencode(args)), self._('Show more')))
+
         l[0:0] = ['<table class="history table table-condensed table-striped">'
              '<tr><th colspan="4" class="header">',
              self._('History'),
@@ -1955,11 +2033,10 @@ class LinkHTMLProperty(HTMLProperty):
 
         if self._value is None:
             return ''
-        linkcl = self._db.classes[self._prop.classname]
-        k = linkcl.labelprop(1)
         if num_re.match(self._value):
             try:
-                value = str(linkcl.get(self._value, k))
+                value = str(self._db.getlabels().get(self._prop.classname,
+                    self._value))
             except IndexError:
                 value = self._value
         else :
@@ -2125,6 +2202,9 @@ class MultilinkHTMLProperty(HTMLProperty):
         if self._value:
             display_value = lookupIds(self._db, self._prop, self._value,
                 fail_ok=1, do_lookup=False)
+            self._db.getlabels().want(self._prop.classname,
+                [v for v in display_value if num_re.match(v)],
+                self._db.getclass(self._prop.classname).orderprop())
             sortfun = make_sort_function(self._db, self._prop.classname)
             # sorting fails if the value contains
             # items not yet stored in the database
@@ -2187,17 +2267,18 @@ class MultilinkHTMLProperty(HTMLProperty):
         if not self.is_view_ok():
             return self._('[hidden]')
 
-        linkcl = self._db.classes[self._prop.classname]
-        k = linkcl.labelprop(1)
+        classname = self._prop.classname
+        cache = self._db.getlabels()
+        cache.want(classname, [v for v in self._value if num_re.match(v)])
         labels = []
         for v in self._value:
             if num_re.match(v):
                 try:
-                    label = linkcl.get(v, k)
+                    label = cache.get(classname, v)
                 except IndexError:
                     label = None
                 # fall back to designator if label is None
-                if label is None: label = '%s%s'%(self._prop.classname, k)
+                if label is None: label = '%s%s'%(classname, v)
             else:
                 label = v
             labels.append(label)
@@ -2373,11 +2454,12 @@ def make_sort_function(db, classname, sort_on=None):
     linkcl = db.getclass(classname)
     if sort_on is None:
         sort_on = linkcl.orderprop()
+    labels = db.getlabels()
     def sortfunc(a, b):
         if num_re.match(a):
-            a = linkcl.get(a, sort_on)
+            a = labels.get(classname, a, sort_on)
         if num_re.match(b):
-            b = linkcl.get(b, sort_on)
+            b = labels.get(classname, b, sort_on)
         return cmp(a, b)
     return sortfunc
 
@@ -2778,21 +2860,80 @@ function help_window(helpurl, width, height) {
         # get the list of ids we're batching over
         klass = self.client.db.getclass(self.classname)
         if self.search_text:
-            matches = self.client.db.indexer.search(
-                [w.upper().encode("utf-8", "replace") for w in re.findall(
-                    r'(?u)\b\w{2,25}\b',
-                    unicode(self.search_text, "utf-8", "replace")
-                )], klass)
+            matches = self.client.db.indexer.search_scores(self.search_text,
+                klass)
         else:
             matches = None
 
-        # filter for visibility
-        l = [id for id in klass.filter(matches, filterspec, sort, group)
-            if check(permission, userid, self.classname, itemid=id)]
+        if matches is not None and not sort and not group:
+            # no sort order requested: rank the matches by relevance,
+            # only sorting as far as the page shown
+            l = self._client.db.security.filterItems(permission, userid,
+                self.classname, klass.filter(matches, filterspec))
+            top = heapq.nlargest(self.startwith + self.pagesize, l,
+                key=matches.get)
+            shown = dict.fromkeys(top)
+            l = top + [id for id in l if id not in shown]
+        elif check(permission, userid, self.classname,
+                skip_permissions_with_check=True):
+            # every item is visible: only fetch the ids of the page shown
+            l = PagedFilter(klass, matches, filterspec, sort, group,
+                self.pagesize)
+        else:
+            # filter for visibility
+            l = self._client.db.security.filterItems(permission, userid,
+                self.classname, klass.filter(matches, filterspec, sort, group))
+
+        # fetch the Multilinks shown in the index for the whole page
+        props = klass.getprops()
+        multilinks = [name for name in self.columns
+            if isinstance(props.get(name), hyperdb.Multilink)]
 
         # return the batch object, using IDs only
         return Batch(self.client, l, self.pagesize, self.startwith,
-            classname=self.classname)
+            classname=self.classname, multilinks=multilinks)
+
+class PagedFilter:
+    """ Sequence of the ids matching a filter, for use by Batch.
+
+        Only the length (via Class.filter_count) and the ids actually
+        accessed are fetched; the latter using Class.filter with limit
+        and offset, 'pagesize' ids at a time.
+    """
+    def __init__(self, klass, search_matches, filterspec, sort, group,
+            pagesize):
+        self.klass = klass
+        self.args = (search_matches, filterspec, sort, group)
+        self.pagesize = max(pagesize, 1)
+        self.length = None
+        self.first = 0
+        self.ids = []
+
+    def __len__(self):
+        if self.length is None:
+            search_matches, filterspec = self.args[:2]
+            self.length = self.klass.filter_count(search_matches, filterspec)
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not self.first <= index < self.first + len(self.ids):
+            if index < 0 or index >= len(self):
+                raise IndexError, index
+            search_matches, filterspec, sort, group = self.args
+            self.first = index
+            self.ids = self.klass.filter(search_matches, filterspec, sort,
+                group, limit=self.pagesize, offset=index)
+        try:
+            return self.ids[index - self.first]
+        except IndexError:
+            # the result changed since we counted it
+            raise IndexError, index
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 # extend the standard ZTUtils Batch object to remove dependency on
 # Acquisition and add a couple of useful methods
@@ -2811,6 +2952,8 @@ class Batch(ZTUtils.Batch):
         orphan    if the next batch would contain less items than this
                   value, then it is combined with this batch
         overlap   the number of items shared between adjacent batches
+        multilinks Multilink properties of the items in this batch that
+                  are fetched in bulk (if the sequence is item ids)
         ========= ========================================================
 
         Attributes: Note that the "start" attribute, unlike the
@@ -2821,7 +2964,7 @@ class Batch(ZTUtils.Batch):
         "sequence_length" is the length of the original, unbatched, sequence.
     """
     def __init__(self, client, sequence, size, start, end=0, orphan=0,
-            overlap=0, classname=None):
+            overlap=0, classname=None, multilinks=None):
         self.client = client
         self.last_index = self.last_item = None
         self.current_item = None
@@ -2829,6 +2972,10 @@ class Batch(ZTUtils.Batch):
         self.sequence_length = len(sequence)
         ZTUtils.Batch.__init__(self, sequence, size, start, end, orphan,
             overlap)
+        if classname and multilinks and self.length > 0:
+            ids = [sequence[i] for i in range(self.first, self.end)]
+            klass = self.client.db.getclass(classname)
+            klass.prefetch_multilinks(ids, multilinks)
 
     # overwrite so we can late-instantiate the HTMLItem instance
     def __getitem__(self, index):
@@ -2881,9 +3028,7 @@ class Batch(ZTUtils.Batch):
             self.overlap)
 
     def next(self):
-        try:
-            self._sequence[self.end]
-        except IndexError:
+        if self.end >= self.sequence_length:
             return None
         return Batch(self.client, self._sequence, self._size,
             self.end - self.overlap, 0, self.orphan, self.overlap)
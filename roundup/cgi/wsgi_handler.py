@@ -7,6 +7,7 @@
 import os
 import cgi
 import weakref
+import threading
 
 import roundup.instance
 from roundup.cgi import TranslationService
@@ -22,6 +23,75 @@ class Writer(object):
         self.write = f
         return f(data)
 
+class FileSlice(object):
+    '''Read no more than 'length' bytes from a file.'''
+    def __init__(self, f, length):
+        self.f = f
+        self.length = length
+    def read(self, size=-1):
+        if size < 0 or size > self.length:
+            size = self.length
+        data = self.f.read(size)
+        self.length -= len(data)
+        return data
+    def close(self):
+        self.f.close()
+
+class ThreadDatabaseTracker(object):
+    '''Hand out the Database of the current thread, kept open across
+    requests, from open(). Other attributes are those of the tracker.
+
+    When the Client releases the database at the end of a request its
+    uncommitted changes are rolled back and the caches cleared. If the
+    request failed or the rollback does, the database is closed and the
+    next request opens a new one.
+    '''
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.tracker, name)
+
+    def open(self, name=None):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.tracker.open(name)
+            # the anydbm backends lock the database while it's open
+            if db.dbtype == 'rdbms':
+                self.local.db = db
+        else:
+            db.setCurrentUser(name)
+            db.tx_Source = None
+        return db
+
+    def release_db(self, db, failed=False):
+        if db is not getattr(self.local, 'db', None):
+            db.close()
+            return
+        if not failed:
+            try:
+                db.rollback()
+                return
+            except:
+                # the connection may be broken, don't reuse it
+                self.local.db = None
+                try:
+                    db.close()
+                except:
+                    pass
+                raise
+        self.local.db = None
+        db.close()
+
+    def close(self):
+        '''Close the database of the current thread.
+        '''
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            self.local.db = None
+            db.close()
+
 class RequestDispatcher(object):
     def __init__(self, home, debug=False, timing=False, lang=None):
         assert os.path.isdir(home), '%r is not a directory'%(home,)
@@ -33,15 +103,52 @@ class RequestDispatcher(object):
                 tracker_home=home)
         else:
             self.translator = None
+        # the tracker is opened once; in debug mode it's opened again
+        # when its configuration or interfaces.py change
+        self.tracker = None
+        self.tracker_mtime = None
+        self.tracker_lock = threading.Lock()
+
+    def get_tracker_mtime(self):
+        mtime = 0
+        for name in ('config.ini', 'interfaces.py'):
+            try:
+                mtime = max(mtime, os.stat(os.path.join(self.home,
+                    name)).st_mtime)
+            except OSError:
+                pass
+        return mtime
+
+    def get_tracker(self):
+        """Return the tracker, opening it if necessary.
+        """
+        if self.debug:
+            mtime = self.get_tracker_mtime()
+        elif self.tracker is not None:
+            return self.tracker
+        self.tracker_lock.acquire()
+        try:
+            if self.debug:
+                if self.tracker is None or mtime != self.tracker_mtime:
+                    self.tracker = roundup.instance.open(self.home, 0)
+                    self.tracker_mtime = mtime
+            elif self.tracker is None:
+                self.tracker = ThreadDatabaseTracker(
+                    roundup.instance.open(self.home, 1))
+            return self.tracker
+        finally:
+            self.tracker_lock.release()
 
     def __call__(self, environ, start_response):
         """Initialize with `apache.Request` object"""
         self.environ = environ
         request = RequestDispatcher(self.home, self.debug, self.timing)
+        request.translator = self.translator
         request.__start_response = start_response
 
         request.wfile = Writer(request)
         request.__wfile = None
+        request.__file = None
 
         if environ ['REQUEST_METHOD'] == 'OPTIONS':
             code = 501
@@ -51,7 +158,7 @@ class RequestDispatcher(object):
             request.wfile.write(DEFAULT_ERROR_MESSAGE % locals())
             return []
 
-        tracker = roundup.instance.open(self.home, not self.debug)
+        tracker = self.get_tracker()
 
         # need to strip the leading '/'
         environ["PATH_INFO"] = environ["PATH_INFO"][1:]
@@ -68,6 +175,10 @@ class RequestDispatcher(object):
             request.start_response([('Content-Type', 'text/html')], 404)
             request.wfile.write('Not found: %s'%client.path)
 
+        if request.__file is not None:
+            # the file is sent by iterating over the response
+            return request.file_iterable(environ, *request.__file)
+
         # all body data has been written using wfile
         return []
 
@@ -77,6 +188,38 @@ class RequestDispatcher(object):
         self.__wfile = self.__start_response('%d %s'%(response_code,
             message), headers)
 
+    def sendfile(self, filename, offset=0, length=-1):
+        """Send 'length' bytes of 'filename' from 'offset' once the
+        Client is done, using the server's wsgi.file_wrapper if there
+        is one.
+        """
+        self.__file = (filename, offset, length)
+
+    def file_iterable(self, environ, filename, offset, length):
+        blksize = roundup.cgi.client.Client.FILE_CHUNK_SIZE
+        f = open(filename, 'rb')
+        if offset:
+            f.seek(offset)
+        if length < 0 or offset + length >= os.fstat(f.fileno()).st_size:
+            # the server may be able to send the real file more efficiently
+            source = f
+        else:
+            source = FileSlice(f, length)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(source, blksize)
+        return self.iter_file(source, blksize)
+
+    def iter_file(self, source, blksize):
+        try:
+            while 1:
+                data = source.read(blksize)
+                if not data:
+                    break
+                yield data
+        finally:
+            source.close()
+
     def get_wfile(self):
         if self.__wfile is None:
             raise ValueError, 'start_response() not called'
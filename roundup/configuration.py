@@ -293,6 +293,32 @@ class RunDetectorOption(Option):
         else:
             raise OptionValueError(self, value, self.class_description)
 
+class IndexerOption(Option):
+
+    """Full-text indexer: empty for autodetection or an indexer name"""
+
+    class_description = "Allowed values: (empty), native, xapian, mmap"
+
+    def str2value(self, value):
+        _val = value.lower()
+        if _val in ("", "native", "xapian", "mmap"):
+            return _val
+        else:
+            raise OptionValueError(self, value, self.class_description)
+
+class SessionExpiryOption(Option):
+
+    """Where expired sessions and one-time keys are removed"""
+
+    class_description = "Allowed values: request, thread, admin"
+
+    def str2value(self, value):
+        _val = value.lower()
+        if _val in ("request", "thread", "admin"):
+            return _val
+        else:
+            raise OptionValueError(self, value, self.class_description)
+
 class IsolationOption(Option):
     """Database isolation levels"""
 
@@ -540,10 +566,26 @@ SETTINGS = (
             "email?"),
         (BooleanOption, "email_registration_confirmation", "yes",
             "Offer registration confirmation by email or only through the web?"),
+        (IndexerOption, "indexer", "",
+            "Full-text indexer to use. If empty, xapian is used when it is\n"
+            "installed, the native indexer of the database backend if not.\n"
+            "\"mmap\" selects an on-disk index of sorted terms and compressed\n"
+            "posting lists that is read via mmap, suited to large trackers."),
         (WordListOption, "indexer_stopwords", "",
             "Additional stop-words for the full-text indexer specific to\n"
             "your tracker. See the indexer source for the default list of\n"
             "stop-words (eg. A,AND,ARE,AS,AT,BE,BUT,BY, ...)"),
+        (BooleanOption, "indexer_deferred", "no",
+            "Queue the texts to index in the database instead of indexing\n"
+            "them when items are created or changed. The queue is indexed\n"
+            "in batches by \"roundup-admin reindex --pending\", which may\n"
+            "be run periodically (eg. from cron) as a background worker."),
+        (BooleanOption, "indexer_search_pending", "yes",
+            "When indexing is deferred, also search the texts still\n"
+            "waiting in the queue so search results stay up to date."),
+        (IntegerNumberOption, "indexer_batch_size", "1000",
+            "Number of queued texts indexed per batch (and transaction)\n"
+            "when the deferred indexing queue is processed."),
         (OctalNumberOption, "umask", "02",
             "Defines the file creation mode mask."),
         (IntegerNumberOption, 'csv_field_size', '131072',
@@ -615,6 +657,47 @@ SETTINGS = (
             "Setting this option makes Roundup migrate passwords with\n"
             "an insecure password-scheme to a more secure scheme\n"
             "when the user logs in via the web-interface."),
+        (BooleanOption, "profile", "no",
+            "Record the SQL statements, template and macro rendering\n"
+            "times, node cache hits and permission checks of each\n"
+            "web request and log them to the \"roundup.profile\" logger\n"
+            "as a line of JSON."),
+        (NullableFilePathOption, "profile_log", "",
+            "If \"profile\" is set, also append the request profiles\n"
+            "to this file. The roundup-admin \"profile\" command\n"
+            "reports the most expensive pages and SQL statements\n"
+            "found in it."),
+        (SessionExpiryOption, "session_expiry", "request",
+            "How sessions and one-time keys not used for a week are\n"
+            "removed: \"request\" removes a batch of them in a web request\n"
+            "once an hour (and in the following requests until all are\n"
+            "gone), \"thread\" in a background thread of each web server\n"
+            "process and \"admin\" leaves it to \"roundup-admin expire\",\n"
+            "which may be run periodically (eg. from cron)."),
+        (IntegerNumberOption, "session_expiry_batch_size", "1000",
+            "Number of sessions and of one-time keys looked at per batch\n"
+            "(and transaction) when expired ones are removed."),
+        (BooleanOption, "compression", "yes",
+            "Compress responses with the gzip content coding for web\n"
+            "clients accepting it (see \"compression_min_size\" and\n"
+            "\"compression_types\"). Static files are served from\n"
+            "precompressed copies (the file name with \".gz\" appended)\n"
+            "if there are up to date ones."),
+        (IntegerNumberOption, "compression_min_size", "1024",
+            "Responses smaller than this number of bytes are not\n"
+            "compressed."),
+        (WordListOption, "compression_types", "text/html,text/css,"
+            "text/plain,text/csv,text/xml,application/xml,"
+            "application/javascript,application/json,image/svg+xml",
+            "Comma-separated list of the MIME types of the responses\n"
+            "which are compressed."),
+        (BooleanOption, "stream_templates", "no",
+            "Send pages to the browser a piece at a time while their\n"
+            "templates are rendered instead of once they are complete.\n"
+            "Big pages then start to show sooner and are never held in\n"
+            "memory as a whole, but errors found in the middle of a\n"
+            "page can only be reported at the point reached. Pages\n"
+            "smaller than a piece are sent as usual."),
     )),
     ("rdbms", (
         (Option, 'name', 'roundup',
@@ -646,6 +729,27 @@ SETTINGS = (
             "Only used in SQLite connections."),
         (IntegerNumberOption, 'cache_size', '100',
             "Size of the node cache (in elements)"),
+        (WordListOption, 'shared_cache_classes', '',
+            "Comma-separated list of classes (eg. status,priority) whose\n"
+            "nodes are kept in a cache shared by all database connections\n"
+            "of this tracker in the same process. Use this for classes\n"
+            "that are read often but rarely change. The cache is updated\n"
+            "when a change is committed in the same process, changes made\n"
+            "by other processes are seen after shared_cache_ttl seconds."),
+        (IntegerNumberOption, 'shared_cache_ttl', '60',
+            "Number of seconds a node is kept in the shared cache\n"
+            "(see shared_cache_classes)."),
+        (IntegerNumberOption, 'connection_pool_size', '0',
+            "Number of idle database connections kept open per tracker\n"
+            "in a process for reuse by later requests. Closing the\n"
+            "database rolls back and returns its connection to the pool.\n"
+            "0 disables the pool."),
+        (IntegerNumberOption, 'connection_pool_max_idle', '300',
+            "Number of seconds after which an idle pooled connection\n"
+            "is closed instead of reused."),
+        (BooleanOption, 'connection_pool_check', 'yes',
+            "Check that a pooled connection still works (eg. hasn't\n"
+            "been closed by the database server) before reusing it."),
         (BooleanOption, "allow_create", "yes",
             "Setting this option to 'no' protects the database against table creations."),
         (BooleanOption, "allow_alter", "yes",
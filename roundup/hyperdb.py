@@ -21,7 +21,7 @@
 __docformat__ = 'restructuredtext'
 
 # standard python modules
-import os, re, shutil, weakref
+import os, re, shutil, weakref, copy
 
 # roundup modules
 import date, password
@@ -623,7 +623,16 @@ All methods except __repr__ must be implemented by a concrete backend Database.
     BACKEND_MISSING_NUMBER = None
     BACKEND_MISSING_BOOLEAN = None
 
-    def __init__(self, config, journaltag=None):
+    # detector init functions not applied yet, see apply_detectors
+    pending_detectors = ()
+
+    # roundup.profiler.Profile recording the activity, if any
+    profile = None
+
+    # the Labels cache of the current request, see getlabels()
+    labels = None
+
+    def __init__(self, config, journaltag=None, base_security=None):
         """Open a hyperdatabase given a specifier to some storage.
 
         The 'storagelocator' is obtained from config.DATABASE.
@@ -636,6 +645,10 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         entries for any edits done on the database.  If 'journaltag' is
         None, the database is opened in read-only mode: the Class.create(),
         Class.set(), and Class.retire() methods are disabled.
+
+        If 'base_security' is given, the database gets a copy of that
+        Security instead of building a new one, as Tracker.open() does
+        for databases opened after the first.
         """
         raise NotImplementedError
 
@@ -743,16 +756,52 @@ All methods except __repr__ must be implemented by a concrete backend Database.
         """
         raise NotImplementedError
 
-    def getjournal(self, classname, nodeid):
+    def getjournal(self, classname, nodeid, direction='ascending',
+            limit=None, offset=None, daterange=None):
         """ get the journal for id
+
+            The entries are ordered by date, oldest first unless
+            "direction" is 'descending', and entries of the same date by
+            their user, action and parameters so pages of the journal
+            don't overlap. Only those in the date.Range (or
+            range spec) "daterange" are returned, at most "limit" of them
+            after skipping "offset" entries.
         """
         raise NotImplementedError
 
+    def journal_daterange(self, daterange):
+        """ Return the (from, to) Dates of the getjournal() "daterange",
+            either may be None.
+        """
+        if daterange is None:
+            return None, None
+        if isinstance(daterange, type('')):
+            daterange = Date().range_from_raw(daterange, self)
+        return daterange.from_value, daterange.to_value
+
     def pack(self, pack_before):
         """ pack the database
         """
         raise NotImplementedError
 
+    def queue_text(self, identifier):
+        """Queue the (classname, nodeid, property) "identifier" for
+        deferred full-text indexing. The entry is saved on commit().
+        """
+        raise NotImplementedError
+
+    def get_text_queue(self, limit=None):
+        """Return at most "limit" queued (identifier, timestamp) entries,
+        oldest first.
+        """
+        raise NotImplementedError
+
+    def dequeue_text(self, entries):
+        """Remove the (identifier, timestamp) entries from the indexing
+        queue unless they've been queued again since.
+        """
+        raise NotImplementedError
+
     def commit(self):
         """ Commit the current transactions.
 
@@ -782,6 +831,16 @@ All methods except __repr__ must be implemented by a concrete backend Database.
 
         """
 
+    def apply_detectors(self):
+        """Call the detector init functions in "pending_detectors".
+
+        Tracker.open() may defer the detectors of a database so that
+        they're only bound when an auditor or reactor is first fired.
+        """
+        detectors, self.pending_detectors = self.pending_detectors, ()
+        for detector in detectors:
+            detector(self)
+
 def iter_roles(roles):
     ''' handle the text processing of turning the roles list
         into something python can use more easily
@@ -834,6 +893,18 @@ class Class:
         """
         return '<hyperdb.Class "%s">'%self.classname
 
+    def clone(self, db):
+        """Return a copy of this class for the database "db", which must
+        have the same schema. The property definitions are shared, the
+        detectors are not copied.
+        """
+        klass = copy.copy(self)
+        klass.db = weakref.proxy(db)
+        actions = "create set retire restore".split()
+        klass.auditors = dict([(a, PrioList()) for a in actions])
+        klass.reactors = dict([(a, PrioList()) for a in actions])
+        return klass
+
     # Editing nodes:
 
     def create(self, **propvalues):
@@ -878,6 +949,19 @@ class Class:
         """
         return Node(self, nodeid)
 
+    def getnodes(self, nodeids, props=None):
+        """ Return an iterator over convenience wrappers for the nodes.
+
+        This is the bulk form of getnode(): backends load the nodes (and
+        those of the properties listed in 'props' that need extra work
+        to fetch, default all) with as few database accesses as
+        possible and keep them in the node cache while they are
+        consumed. As with getnode(), an IndexError is raised when a
+        property of a nonexisting node is accessed.
+        """
+        for nodeid in nodeids:
+            yield Node(self, nodeid)
+
     def getnodeids(self, retired=None):
         """Retrieve all the ids of the nodes for a particular Class.
         """
@@ -947,7 +1031,8 @@ class Class:
         if there are any references to the node.
         """
 
-    def history(self, nodeid):
+    def history(self, nodeid, direction='ascending', limit=None,
+            offset=None, daterange=None):
         """Retrieve the journal of edits on a particular node.
 
         'nodeid' must be the id of an existing node of this class or an
@@ -955,14 +1040,21 @@ class Class:
 
         The returned list contains tuples of the form
 
-            (date, tag, action, params)
+            (nodeid, date, tag, action, params)
 
         'date' is a Timestamp object specifying the time of the change and
         'tag' is the journaltag specified when the database was opened.
+
+        The entries are ordered by date, oldest first unless 'direction'
+        is 'descending'. 'daterange' (a date.Range or a range spec like
+        "2012-01-01;") restricts them to a period, 'limit' and 'offset'
+        select a page of them, eg. the last 10 changes are
+        history(nodeid, 'descending', 10).
         """
         if not self.do_journal:
             raise ValueError('Journalling is disabled for this class')
-        return self.db.getjournal(self.classname, nodeid)
+        return self.db.getjournal(self.classname, nodeid, direction, limit,
+            offset, daterange)
 
     # Locating nodes:
     def hasnode(self, nodeid):
@@ -1164,7 +1256,8 @@ class Class:
             sortattr.append(('+', 'id'))
         return sortattr
 
-    def filter(self, search_matches, filterspec, sort=[], group=[]):
+    def filter(self, search_matches, filterspec, sort=[], group=[],
+            limit=None, offset=None):
         """Return a list of the ids of the active nodes in this class that
         match the 'filter' spec, sorted by the group spec and then the
         sort spec.
@@ -1184,6 +1277,9 @@ class Class:
         1. String properties must match all elements in the list, and
         2. Other properties must match any of the elements in the list.
 
+        "limit" and "offset" select a page of the sorted result, i.e.
+        at most "limit" ids starting at index "offset".
+
         Note that now the propname in filterspec and prop in a
         sort/group spec may be transitive, i.e., it may contain
         properties of the form link.link.link.name, e.g. you can search
@@ -1201,14 +1297,42 @@ class Class:
         sortattr = self._sortattr(sort = sort, group = group)
         proptree = self._proptree(filterspec, sortattr)
         proptree.search(search_matches)
-        return proptree.sort()
+        l = proptree.sort()
+        if limit is not None or offset:
+            offset = offset or 0
+            if limit is None:
+                return l[offset:]
+            return l[offset:offset + limit]
+        return l
+
+    def filter_count(self, search_matches, filterspec):
+        """Return the number of active nodes in this class that match
+        the 'filter' spec, see filter for the arguments.
+        """
+        return len(self.filter(search_matches, filterspec))
 
-    # non-optimized filter_iter, a backend may chose to implement a
-    # better version that provides a real iterator that pre-fills the
-    # cache for each id returned. Note that the filter_iter doesn't
-    # promise to correctly sort by multilink (which isn't sane to do
-    # anyway).
-    filter_iter = filter
+    def filter_iter(self, search_matches, filterspec, sort=[], group=[],
+            limit=None, offset=None, multilinks=None):
+        """Return an iterable of the ids of the nodes matching the filter,
+        see filter for the arguments. "multilinks" names the Multilink
+        properties the caller is going to use, a backend may fetch
+        these in bulk.
+
+        This is the non-optimized version, a backend may chose to
+        implement a better version that provides a real iterator that
+        pre-fills the cache for each id returned. Note that the
+        filter_iter doesn't promise to correctly sort by multilink
+        (which isn't sane to do anyway).
+        """
+        return self.filter(search_matches, filterspec, sort, group,
+            limit=limit, offset=offset)
+
+    def prefetch_multilinks(self, nodeids, propnames=None):
+        """Hint that the given Multilink properties (default: all) of the
+        nodes are about to be used. Backends that load Multilinks lazily
+        fetch them for all nodes at once. The default does nothing.
+        """
+        pass
 
     def count(self):
         """Get the number of nodes in this class.
@@ -1261,6 +1385,8 @@ class Class:
 
     def fireAuditors(self, event, nodeid, newvalues):
         """Fire all registered auditors"""
+        if self.db.pending_detectors:
+            self.db.apply_detectors()
         for prio, name, audit in self.auditors[event]:
             audit(self.db, self, nodeid, newvalues)
 
@@ -1270,6 +1396,10 @@ class Class:
 
     def fireReactors(self, event, nodeid, oldvalues):
         """Fire all registered reactors"""
+        if self.db.labels is not None:
+            self.db.labels.forget(self.classname, nodeid)
+        if self.db.pending_detectors:
+            self.db.apply_detectors()
         for prio, name, react in self.reactors[event]:
             react(self.db, self, nodeid, oldvalues)
 
@@ -1471,6 +1601,94 @@ class FileClass:
             self.db.indexer.add_text((self.classname, nodeid, 'content'),
                 self.get(nodeid, 'content'), mime_type)
 
+class Labels:
+    """ The labels of items (the value of their labelprop(1) or another
+        property) needed while handling a request, fetched in bulk.
+
+        Callers first declare the items they are going to show with
+        want(), then get() their labels; the missing labels of each class
+        are fetched with one getnodes() pass (one query per chunk of ids
+        in the rdbms backends) instead of one get() per item. Labels are
+        kept until the database cache is cleared (commit or rollback) or
+        the item is changed.
+    """
+    # label of items that don't exist
+    missing = object()
+
+    def __init__(self, db):
+        self.db = db
+        # (classname, itemid, propname) -> label
+        self.labels = {}
+        # (classname, propname) -> {itemid: 1} still to fetch
+        self.wanted = {}
+        # classname -> labelprop(1)
+        self.labelprops = {}
+
+    def _propname(self, classname, propname):
+        if propname is None:
+            propname = self.labelprops.get(classname)
+            if propname is None:
+                propname = self.db.getclass(classname).labelprop(1)
+                self.labelprops[classname] = propname
+        return propname
+
+    def want(self, classname, itemids, propname=None):
+        """ Note that the labels of the items will be needed.
+        """
+        propname = self._propname(classname, propname)
+        wanted = None
+        for itemid in itemids:
+            if (classname, itemid, propname) in self.labels:
+                continue
+            if wanted is None:
+                wanted = self.wanted.setdefault((classname, propname), {})
+            wanted[itemid] = 1
+
+    def resolve(self):
+        """ Fetch the labels wanted.
+        """
+        wanted, self.wanted = self.wanted, {}
+        for (classname, propname), itemids in wanted.items():
+            itemids = [itemid for itemid in itemids
+                if (classname, itemid, propname) not in self.labels]
+            if propname == 'id':
+                for itemid in itemids:
+                    self.labels[(classname, itemid, propname)] = itemid
+                continue
+            cl = self.db.getclass(classname)
+            for node in cl.getnodes(itemids, [propname]):
+                try:
+                    label = node[propname]
+                except IndexError:
+                    label = self.missing
+                self.labels[(classname, node.nodeid, propname)] = label
+
+    def get(self, classname, itemid, propname=None):
+        """ Return the label of the item, the value of "propname" if
+            given. Raise IndexError if the item doesn't exist.
+        """
+        k = (classname, itemid, self._propname(classname, propname))
+        if k not in self.labels:
+            self.want(classname, [itemid], k[2])
+            self.resolve()
+        label = self.labels[k]
+        if label is self.missing:
+            raise IndexError('%s has no node %s'%(classname, itemid))
+        return label
+
+    def forget(self, classname, itemid):
+        """ Drop the labels of an item that was changed.
+        """
+        for k in [k for k in self.labels if k[:2] == (classname, itemid)]:
+            del self.labels[k]
+
+    def clear(self, param=None):
+        """ Drop all the labels (a clearCache callback).
+        """
+        self.labels.clear()
+        self.wanted.clear()
+        self.labelprops.clear()
+
 class Node:
     """ A convenience wrapper for the given node
     """
@@ -1516,8 +1734,8 @@ class Node:
             raise AttributeError, str(value)
     def __setitem__(self, name, value):
         self.cl.set(self.nodeid, **{name: value})
-    def history(self):
-        return self.cl.history(self.nodeid)
+    def history(self, *args, **kw):
+        return self.cl.history(self.nodeid, *args, **kw)
     def retire(self):
         return self.cl.retire(self.nodeid)
 
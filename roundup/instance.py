@@ -52,6 +52,9 @@ class Tracker:
         # same variables (in particular db) as schema.py main purpose is
         # for regression tests
         self.schema_hook = None
+        # classes and security settings of the first opened database,
+        # copied into the later ones when optimize is set
+        self.prototype = None
         self.config = configuration.CoreConfig(tracker_home)
         self.actions = {}
         self.cgi_actions = {}
@@ -84,11 +87,19 @@ class Tracker:
         return name
 
     def open(self, name=None):
-        # load the database schema
-        # we cannot skip this part even if self.optimize is set
-        # because the schema has security settings that must be
-        # applied to each database instance
         backend = self.backend
+        if self.prototype is not None:
+            # copy the schema and security settings set up by the first
+            # open() instead of executing schema.py again; the detectors
+            # are only applied when an auditor or reactor is first fired
+            db = backend.Database(self.config, name,
+                base_security=self.prototype.security)
+            self.prototype.stamp(db)
+            db.pending_detectors = self.detectors
+            db.tx_Source = None
+            return db
+
+        # load the database schema
         env = {
             'Class': backend.Class,
             'FileClass': backend.FileClass,
@@ -153,8 +164,18 @@ class Tracker:
 
             db.post_init()
             self.db_open = 1
+            # the schema hook is called for every database
+            if self.optimize and self.schema_hook is None:
+                self.prototype = SchemaPrototype(db)
         return db
 
+    def release_db(self, db, failed=False):
+        """Called by the web Client when it is done with a database it
+        got from open(); "failed" is true if the request raised an
+        exception. This closes the database.
+        """
+        db.close()
+
     def load_interfaces(self):
         """load interfaces.py (if any), initialize Client and MailGW attrs"""
         env = {}
@@ -235,6 +256,23 @@ class Tracker:
     def registerUtil(self, name, function):
         self.templating_utils[name] = function
 
+class SchemaPrototype:
+    """The classes and security settings that schema.py and the
+    detectors set up for a database, to be copied into databases opened
+    later. schema.py must not do anything else with the database.
+    """
+    def __init__(self, db):
+        self.classes = [db.getclass(cn) for cn in db.getclasses()]
+        self.security = db.security.copy(db)
+
+    def stamp(self, db):
+        """Give the (just opened) database "db" the classes. It is
+        opened with a copy of the security settings, see
+        hyperdb.Database.
+        """
+        for klass in self.classes:
+            db.classes[klass.classname] = klass.clone(db)
+
 class TrackerError(Exception):
     pass
 
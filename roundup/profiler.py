@@ -0,0 +1,162 @@
+"""Per-request profiling of the web interface.
+
+A Profile records the SQL statements executed, the time spent
+rendering templates and macros, and the node cache and permission
+check statistics of the database while a request is handled. See the
+"profile" and "profile_log" options of the [web] section of the
+tracker configuration.
+"""
+
+__docformat__ = 'restructuredtext'
+
+import re, time
+
+from roundup.anypy.json_ import json
+
+def normalise_sql(sql,
+        space_re=re.compile(r'\s+'),
+        literal_re=re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s"),
+        list_re=re.compile(r'\(\?(?:, ?\?)+\)')):
+    '''Return the statement "sql" with literals and parameters replaced
+    by "?" and lists of them by "(?...)", so that statements only
+    differing in their values are counted together.
+    '''
+    sql = space_re.sub(' ', sql.strip())
+    sql = literal_re.sub('?', sql)
+    return list_re.sub('(?...)', sql)
+
+class Profile:
+    '''Statistics of a single web request.
+    '''
+    def __init__(self):
+        self.start = time.time()
+        # normalised statement or template name -> [count, seconds]
+        self.sql = {}
+        self.templates = {}
+        # the database statistics counters of the databases used
+        self.counters = {}
+        self.db = None
+
+    def attach(self, db):
+        '''Record the activity of "db" from now on.
+        '''
+        if self.db is not None:
+            self.detach()
+        self.db = db
+        db.profile = self
+        self.db_counters = self._counters(db)
+
+    def detach(self):
+        '''Stop recording the activity of the database, keeping the
+        statistics collected so far.
+        '''
+        if self.db is None:
+            return
+        self.counters = self._current_counters()
+        self.db.profile = None
+        self.db = None
+
+    def _counters(self, db):
+        counters = {}
+        for key in 'cache_hits', 'cache_misses':
+            counters[key] = db.stats.get(key, 0)
+        stats = db.security.decision_stats()
+        counters['permission_checks'] = stats['hits'] + stats['misses']
+        counters['permission_check_calls'] = stats['checks']
+        return counters
+
+    def _current_counters(self):
+        '''Return the counters including those of the current database.
+        '''
+        counters = dict(self.counters)
+        if self.db is not None:
+            for key, value in self._counters(self.db).items():
+                counters[key] = (counters.get(key, 0) + value
+                    - self.db_counters[key])
+        return counters
+
+    def add_sql(self, sql, seconds):
+        self._add(self.sql, normalise_sql(sql), seconds)
+
+    def add_template(self, name, seconds):
+        self._add(self.templates, name, seconds)
+
+    def _add(self, entries, key, seconds):
+        entry = entries.get(key)
+        if entry is None:
+            entries[key] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def report(self, **info):
+        '''Return the statistics as a dict; "info" is included as is.
+
+        Statements and templates are listed as (name, count, seconds)
+        with the most expensive first. Template times include those of
+        the templates and macros they use.
+        '''
+        report = dict(info)
+        report['time'] = self.start
+        report['elapsed'] = time.time() - self.start
+        report['sql'] = self._sorted(self.sql)
+        report['sql_count'] = sum([n for n, seconds in self.sql.values()])
+        report['sql_time'] = sum([seconds for n, seconds in
+            self.sql.values()])
+        report['templates'] = self._sorted(self.templates)
+        counters = self._current_counters()
+        for key in ('cache_hits', 'cache_misses', 'permission_checks',
+                'permission_check_calls'):
+            report[key] = counters.get(key, 0)
+        hits, misses = report['cache_hits'], report['cache_misses']
+        if hits + misses:
+            report['cache_ratio'] = float(hits) / (hits + misses)
+        else:
+            report['cache_ratio'] = None
+        return report
+
+    def _sorted(self, entries):
+        l = [(name, count, seconds)
+            for name, (count, seconds) in entries.items()]
+        l.sort(key=lambda entry: -entry[2])
+        return l
+
+def dumps(report):
+    '''Return "report" as a line of JSON.
+    '''
+    return json.dumps(report, sort_keys=True)
+
+def summarise(lines, limit=10):
+    '''Aggregate the JSON reports in "lines".
+
+    Return a tuple (pages, statements) of the "limit" most expensive
+    pages, as (page, requests, seconds, sql count, sql seconds), and
+    statements, as (statement, count, seconds), by total time.
+    '''
+    pages = {}
+    statements = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            report = json.loads(line)
+        except ValueError:
+            continue
+        entry = pages.setdefault(report.get('page'), [0, 0.0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += report['elapsed']
+        entry[2] += report['sql_count']
+        entry[3] += report['sql_time']
+        for sql, count, seconds in report['sql']:
+            entry = statements.setdefault(sql, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+    pages = [(page,) + tuple(entry) for page, entry in pages.items()]
+    pages.sort(key=lambda entry: -entry[2])
+    statements = [(sql,) + tuple(entry)
+        for sql, entry in statements.items()]
+    statements.sort(key=lambda entry: -entry[2])
+    return pages[:limit], statements[:limit]
+
+# vim: set et sts=4 sw=4 :
@@ -165,6 +165,38 @@ class Database:
             for method, param in self.cache_callbacks:
                 method(param)
 
+    def getlabels(self):
+        """ Return the hyperdb.Labels cache of this database, kept until
+            its cache is cleared.
+        """
+        if self.labels is None:
+            self.labels = hyperdb.Labels(self)
+            self.registerClearCacheCallback(self.labels.clear)
+        return self.labels
+
+    # the session and OTK stores handed out by getSessionManager and
+    # getOTKManager, kept for the life of the database
+    sessions = otks = None
+
+    def commitSessions(self):
+        """ Tell the session and OTK stores that a transaction ended, so
+            they write out and forget what they hold.
+        """
+        for store in self.sessions, self.otks:
+            if store is not None:
+                store.commit()
+
+    def expire_sessions(self, limit=None):
+        """ Remove the sessions and one-time keys that haven't been used
+            for a week, looking at no more than "limit" of each. Return
+            true if there may be more to remove.
+        """
+        more = False
+        for store in self.getSessionManager(), self.getOTKManager():
+            if store.clean(limit) == limit:
+                more = True
+        return more
+
     def registerClearCacheCallback(self, method, param = None):
         """ Register a callback method for clearing the cache.
             It is called with the given param as the only parameter.
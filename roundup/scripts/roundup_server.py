@@ -34,7 +34,7 @@ if (osp.exists(thisdir + '/__init__.py') and
 
 
 import errno, cgi, getopt, os, socket, sys, traceback, urllib, time
-import ConfigParser, BaseHTTPServer, SocketServer, StringIO
+import ConfigParser, BaseHTTPServer, SocketServer, StringIO, signal
 
 try:
     from OpenSSL import SSL
@@ -79,8 +79,11 @@ try:
 except ImportError:
     pass
 else:
+    import threading, Queue
     MULTIPROCESS_TYPES.append("thread")
 if hasattr(os, 'fork'):
+    if "thread" in MULTIPROCESS_TYPES:
+        MULTIPROCESS_TYPES.append("prefork")
     MULTIPROCESS_TYPES.append("fork")
 DEFAULT_MULTIPROCESS = MULTIPROCESS_TYPES[-1]
 
@@ -166,12 +169,181 @@ class SecureHTTPServer(BaseHTTPServer.HTTPServer):
             conn = ConnFixer(conn)
         return (conn, info)
 
+class WorkerPoolMixIn:
+    """Serve connections from pre-forked worker processes, each handling
+    the connections it accepts with a fixed pool of threads.
+
+    A worker only accepts a connection when one of its threads is idle,
+    so connections wait in the listen backlog while all are busy. After
+    'max_requests' connections the worker exits and is replaced.
+    """
+    workers = 2
+    threads = 8
+    max_requests = 0
+
+    def serve_forever(self, poll_interval=None):
+        """Start the workers and replace them when they exit."""
+        self.children = {}
+        signal.signal(signal.SIGTERM, self.terminate)
+        try:
+            while 1:
+                while len(self.children) < self.workers:
+                    self.start_worker()
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                started = self.children.pop(pid, None)
+                if started is not None and time.time() - started < 1:
+                    # don't spin if the workers fail on startup
+                    time.sleep(1)
+        finally:
+            for pid in self.children.keys():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in self.children.keys():
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return
+        try:
+            try:
+                self.serve_worker()
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except:
+                traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            os._exit(0)
+
+    def terminate(self, signum, frame):
+        raise SystemExit
+
+    def serve_worker(self):
+        """Accept connections and hand them to the thread pool."""
+        self.queue = Queue.Queue()
+        self.idle = threading.Semaphore(self.threads)
+        self.stats_lock = threading.Lock()
+        self.connections = self.busy = self.max_busy = self.saturated = 0
+        self.service_time = self.saturated_time = 0.0
+        pool = []
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.process_queue)
+            thread.setDaemon(True)
+            thread.start()
+            pool.append(thread)
+        accepted = 0
+        try:
+            while not self.max_requests or accepted < self.max_requests:
+                # wait for a thread to become available
+                if not self.idle.acquire(False):
+                    start = time.time()
+                    self.idle.acquire()
+                    self.saturated += 1
+                    self.saturated_time += time.time() - start
+                try:
+                    request, client_address = self.get_request()
+                except socket.error:
+                    self.idle.release()
+                    continue
+                if self.verify_request(request, client_address):
+                    self.queue.put((request, client_address))
+                    accepted += 1
+                else:
+                    self.shutdown_request(request)
+                    self.idle.release()
+            # recycle the worker: finish the connections being handled
+            for thread in pool:
+                self.queue.put(None)
+            for thread in pool:
+                thread.join()
+        finally:
+            print _('Worker %(pid)d exiting: %(stats)s') % {
+                'pid': os.getpid(), 'stats': self.format_stats()}
+
+    def process_queue(self):
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                break
+            request, client_address = item
+            self.stats_lock.acquire()
+            self.busy += 1
+            self.max_busy = max(self.max_busy, self.busy)
+            self.stats_lock.release()
+            start = time.time()
+            try:
+                try:
+                    self.finish_request(request, client_address)
+                except:
+                    self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.stats_lock.acquire()
+                self.busy -= 1
+                self.connections += 1
+                self.service_time += time.time() - start
+                self.stats_lock.release()
+                self.idle.release()
+
+    def stats(self):
+        """Return the worker's connection and thread pool statistics."""
+        self.stats_lock.acquire()
+        try:
+            return {
+                'connections': self.connections,
+                'busy': self.busy,
+                'max_busy': self.max_busy,
+                'queued': self.queue.qsize(),
+                'saturated': self.saturated,
+                'saturated_time': self.saturated_time,
+                'service_time': self.service_time,
+            }
+        finally:
+            self.stats_lock.release()
+
+    def format_stats(self):
+        stats = self.stats()
+        return ('%(connections)d connections in %(service_time).3fs,'
+            ' %(max_busy)d threads busy at most, all threads busy'
+            ' %(saturated)d times for %(saturated_time).3fs') % stats
+
+class ChunkedWriter(object):
+    """Write to a file using the HTTP/1.1 chunked transfer coding."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def close(self):
+        self.wfile.write('0\r\n\r\n')
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
 class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     TRACKER_HOMES = {}
     TRACKERS = None
     LOG_IPADDRESS = 1
     DEBUG_MODE = False
     CONFIG = None
+    # Seconds to wait for the next request on a persistent connection.
+    # Persistent connections are only used if protocol_version is set
+    # to "HTTP/1.1".
+    KEEP_ALIVE_TIMEOUT = 5
 
     def get_tracker(self, name):
         """Return a tracker instance for given tracker name"""
@@ -200,14 +372,26 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         """ Execute the CGI command. Wrap an innner call in an error
             handler so all errors can be caught.
         """
+        self.response_code = None
         try:
-            self.inner_run_cgi()
+            try:
+                self.inner_run_cgi()
+            except:
+                if self.response_code is None:
+                    raise
+                # the client has got part of a response already and
+                # can't be sent an error now
+                self.abort_response()
+            else:
+                self.finish_response()
         except client.NotFound:
             self.send_error(404, self.path)
         except client.Unauthorised, message:
             self.send_error(403, '%s (%s)'%(self.path, message))
         except:
             exc, val, tb = sys.exc_info()
+            # the request body may not have been read
+            self.close_connection = 1
             if hasattr(socket, 'timeout') and isinstance(val, socket.timeout):
                 self.log_error('timeout')
             else:
@@ -239,6 +423,96 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     do_GET = do_POST = do_HEAD = run_cgi
 
+    def handle(self):
+        """Handle requests until the connection is to be closed, waiting
+        at most KEEP_ALIVE_TIMEOUT seconds for each further request.
+        """
+        self.waiting = 0
+        self.close_connection = 1
+        self.handle_one_request()
+        self.request_timeout = self.connection.gettimeout()
+        while not self.close_connection:
+            self.waiting = 1
+            self.connection.settimeout(self.KEEP_ALIVE_TIMEOUT)
+            self.handle_one_request()
+
+    def parse_request(self):
+        if self.waiting:
+            self.waiting = 0
+            self.connection.settimeout(self.request_timeout)
+        if not BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
+            return False
+        # the cgi module may leave part of a request body unread
+        if self.headers.getheader('content-length', '0').strip() != '0':
+            self.close_connection = 1
+        return True
+
+    def send_response(self, code, message=None):
+        self.response_code = code
+        self.body_length_sent = self.connection_sent = 0
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code,
+            message)
+
+    def send_header(self, keyword, value):
+        keyword_lower = keyword.lower()
+        if keyword_lower in ('content-length', 'transfer-encoding'):
+            self.body_length_sent = 1
+        elif keyword_lower == 'connection':
+            self.connection_sent = 1
+        BaseHTTPServer.BaseHTTPRequestHandler.send_header(self, keyword,
+            value)
+
+    def end_headers(self):
+        """Make sure the client can tell where the response body ends
+        if the connection is kept open: use the chunked transfer coding
+        if the response has no Content-Length.
+        """
+        chunked = 0
+        if self.protocol_version >= "HTTP/1.1":
+            if (self.body_length_sent or self.command == 'HEAD'
+                    or self.response_code in (204, 304)):
+                pass
+            elif (not self.close_connection
+                    and self.request_version >= "HTTP/1.1"):
+                self.send_header('Transfer-Encoding', 'chunked')
+                chunked = 1
+            else:
+                self.close_connection = 1
+            if not self.connection_sent:
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                elif self.request_version < "HTTP/1.1":
+                    self.send_header('Connection', 'keep-alive')
+        BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+        if chunked:
+            self.wfile = ChunkedWriter(self.wfile)
+
+    def finish_response(self):
+        """End the chunked response body, if there is one."""
+        if isinstance(self.wfile, ChunkedWriter):
+            self.wfile.close()
+            self.wfile = self.wfile.wfile
+
+    def abort_response(self):
+        """Close the connection in the middle of a response, leaving a
+        chunked body unterminated so the client sees it is incomplete.
+        """
+        self.close_connection = 1
+        if isinstance(self.wfile, ChunkedWriter):
+            self.wfile = self.wfile.wfile
+        exc, val, tb = sys.exc_info()
+        if hasattr(socket, 'timeout') and isinstance(val, socket.timeout):
+            self.log_error('timeout')
+        else:
+            print 'EXCEPTION AT', time.ctime()
+            traceback.print_exc()
+
+    def log_error(self, format, *args):
+        if self.waiting:
+            # the client didn't send another request in time
+            return
+        BaseHTTPServer.BaseHTTPRequestHandler.log_error(self, format, *args)
+
     def index(self):
         ''' Print up an index of the available trackers
         '''
@@ -378,6 +652,9 @@ class RoundupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if os.environ.has_key('CGI_SHOW_TIMING'):
             env['CGI_SHOW_TIMING'] = os.environ['CGI_SHOW_TIMING']
         env['HTTP_ACCEPT_LANGUAGE'] = self.headers.get('accept-language')
+        accept_encoding = self.headers.getheader('accept-encoding')
+        if accept_encoding:
+            env['HTTP_ACCEPT_ENCODING'] = accept_encoding
         range = self.headers.getheader('range')
         if range:
             env['HTTP_RANGE'] = range
@@ -521,6 +798,21 @@ class ServerConfig(configuration.Config):
             (configuration.Option, "multiprocess", DEFAULT_MULTIPROCESS,
                 "Set processing of each request in separate subprocess.\n"
                 "Allowed values: %s." % ", ".join(MULTIPROCESS_TYPES)),
+            (configuration.IntegerNumberOption, "workers", "2",
+                "Number of worker processes in the prefork mode."),
+            (configuration.IntegerNumberOption, "threads", "8",
+                "Number of threads handling connections in each\n"
+                "worker process in the prefork mode."),
+            (configuration.IntegerNumberOption, "max_requests", "0",
+                "Number of connections a worker process handles before\n"
+                "it is replaced with a new one in the prefork mode.\n"
+                "0 means the worker processes are never replaced."),
+            (configuration.IntegerNumberOption, "keep_alive_timeout", "5",
+                "Seconds to wait for the next request on a persistent\n"
+                "HTTP/1.1 connection in the prefork mode.\n"
+                "0 closes the connection after each request."),
+            (configuration.IntegerNumberOption, "backlog", "64",
+                "Maximum number of connections waiting to be accepted."),
             (configuration.NullableFilePathOption, "template", "",
                 "Tracker index template. If unset, built-in will be used."),
             (configuration.BooleanOption, "ssl", "no",
@@ -548,6 +840,7 @@ class ServerConfig(configuration.Config):
         "nodaemon": "D",
         "log_hostnames": "N",
         "multiprocess": "t:",
+        "workers": "w:",
         "template": "i:",
         "ssl": "s",
         "pem": "e:",
@@ -598,6 +891,11 @@ class ServerConfig(configuration.Config):
         # we don't want the cgi module interpreting the command-line args ;)
         sys.argv = sys.argv[:1]
 
+        if self["MULTIPROCESS"] not in MULTIPROCESS_TYPES:
+            print _("Multiprocess mode \"%s\" is not available, "
+                "switching to single-process") % self["MULTIPROCESS"]
+            self["MULTIPROCESS"] = "none"
+
         # preload all trackers unless we are in "debug" mode
         tracker_homes = self.trackers()
         if self["MULTIPROCESS"] == "debug":
@@ -605,6 +903,13 @@ class ServerConfig(configuration.Config):
         else:
             trackers = dict([(name, roundup.instance.open(home, optimize=1))
                 for (name, home) in tracker_homes])
+        if self["MULTIPROCESS"] == "prefork":
+            # keep a database open in each thread of the workers
+            from roundup.cgi.wsgi_handler import ThreadDatabaseTracker
+            for name, tracker in trackers.items():
+                trackers[name] = ThreadDatabaseTracker(tracker)
+        keep_alive = (self["MULTIPROCESS"] == "prefork"
+            and self["KEEP_ALIVE_TIMEOUT"] > 0)
 
         # build customized request handler class
         class RequestHandler(RoundupRequestHandler):
@@ -613,6 +918,9 @@ class ServerConfig(configuration.Config):
             TRACKERS = trackers
             DEBUG_MODE = self["MULTIPROCESS"] == "debug"
             CONFIG = self
+            KEEP_ALIVE_TIMEOUT = self["KEEP_ALIVE_TIMEOUT"]
+            if keep_alive:
+                protocol_version = "HTTP/1.1"
 
             def setup(self):
                 if self.CONFIG["SSL"]:
@@ -638,17 +946,22 @@ class ServerConfig(configuration.Config):
                 socket.setdefaulttimeout(60)
             base_server = BaseHTTPServer.HTTPServer
 
+        class ListeningServer(base_server):
+            request_queue_size = self["BACKLOG"]
+        base_server = ListeningServer
+
         # obtain request server class
-        if self["MULTIPROCESS"] not in MULTIPROCESS_TYPES:
-            print _("Multiprocess mode \"%s\" is not available, "
-                "switching to single-process") % self["MULTIPROCESS"]
-            self["MULTIPROCESS"] = "none"
-            server_class = base_server
-        elif self["MULTIPROCESS"] == "fork":
+        if self["MULTIPROCESS"] == "fork":
             class ForkingServer(SocketServer.ForkingMixIn,
                 base_server):
                     pass
             server_class = ForkingServer
+        elif self["MULTIPROCESS"] == "prefork":
+            class WorkerPoolServer(WorkerPoolMixIn, base_server):
+                workers = self["WORKERS"]
+                threads = self["THREADS"]
+                max_requests = self["MAX_REQUESTS"]
+            server_class = WorkerPoolServer
         elif self["MULTIPROCESS"] == "thread":
             class ThreadingServer(SocketServer.ThreadingMixIn,
                 base_server):
@@ -769,6 +1082,7 @@ Options:
  -e <fname>    PEM file containing SSL key and certificate
  -t <mode>     multiprocess mode (default: %(mp_def)s).
                Allowed values: %(mp_types)s.
+ -w <number>   number of worker processes in the prefork mode
 %(os_part)s
 
 Long options:
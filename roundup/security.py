@@ -2,7 +2,7 @@
 """
 __docformat__ = 'restructuredtext'
 
-import weakref
+import weakref, copy
 
 from roundup import hyperdb, support
 
@@ -24,15 +24,30 @@ class Permission:
         If check function is set, permission is granted only when
         the function returns value interpreted as boolean true.
         The function is called with arguments db, userid, itemid.
+
+        A Permission with a check function may also have a filter
+        function, the batch form of the check used by
+        Security.filterItems: it is called with arguments db, userid,
+        itemids and returns the ids from itemids for which the check
+        function would return true.
     '''
     def __init__(self, name='', description='', klass=None,
-            properties=None, check=None):
+            properties=None, check=None, filter=None):
         self.name = name
         self.description = description
         self.klass = klass
         self.properties = properties
         self._properties_dict = support.TruthDict(properties)
         self.check = check
+        self.filter = filter
+
+    def filter_items(self, db, userid, itemids):
+        ''' Return the ids from itemids passing the check function.
+        '''
+        if self.filter is not None:
+            return self.filter(db, userid, itemids)
+        check = self.check
+        return [itemid for itemid in itemids if check(db, userid, itemid)]
 
     def test(self, db, permission, classname, property, userid, itemid):
         if permission != self.name:
@@ -97,6 +112,10 @@ class Role:
         - description
         - permissions
     '''
+    # weak reference to the Security the Role belongs to, whose
+    # permission decisions are cleared when the permissions are replaced
+    security = None
+
     def __init__(self, name='', description='', permissions=None):
         self.name = name.lower()
         self.description = description
@@ -104,6 +123,13 @@ class Role:
             permissions = []
         self.permissions = permissions
 
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        if name == 'permissions' and self.security is not None:
+            security = self.security()
+            if security is not None:
+                security.clearDecisions()
+
     def __repr__(self):
         return '<Role 0x%x %r,%r>'%(id(self), self.name, self.permissions)
 
@@ -120,6 +146,11 @@ class Security:
         # roles are mapped by name to the Role
         self.role = {}
 
+        # compiled permission decisions, see hasPermission
+        self.decisions = {}
+        self.decision_hits = self.decision_misses = 0
+        self.check_calls = 0
+
         # the default Roles
         self.addRole(name="User", description="A regular user, no privs")
         self.addRole(name="Admin", description="An admin user, full privs")
@@ -137,6 +168,27 @@ class Security:
         from roundup import mailgw
         mailgw.initialiseSecurity(self)
 
+    def copy(self, db):
+        ''' Return a Security for "db" with the same Roles and
+            Permissions. Adding Roles or Permissions to one doesn't
+            change the other; the compiled decisions are shared until
+            then.
+        '''
+        security = copy.copy(self)
+        security.db = weakref.proxy(db)
+        security.permission = dict([(name, list(perms))
+            for name, perms in self.permission.iteritems()])
+        security.role = {}
+        for name, role in self.role.iteritems():
+            role = copy.copy(role)
+            # same permissions: the shared decisions still hold
+            role.__dict__['permissions'] = list(role.permissions)
+            role.security = weakref.ref(security)
+            security.role[name] = role
+        security.decision_hits = security.decision_misses = 0
+        security.check_calls = 0
+        return security
+
     def getPermission(self, permission, classname=None, properties=None,
             check=None):
         ''' Find the Permission matching the name and for the class, if the
@@ -163,7 +215,7 @@ class Security:
             classname)
 
     def hasPermission(self, permission, userid, classname=None,
-            property=None, itemid=None):
+            property=None, itemid=None, skip_permissions_with_check=False):
         '''Look through all the Roles, and hence Permissions, and
            see if "permission" exists given the constraints of
            classname, property and itemid.
@@ -181,21 +233,110 @@ class Security:
            either no check function defined or the check function,
            when invoked, must return a True value.
 
-           Note that this functionality is actually implemented by the
-           Permission.test() method.
+           If skip_permissions_with_check is true, only Permissions
+           without a check function are considered. A True result then
+           means the permission holds for *every* item of the class.
+
+           The matching is done by the Permission.test() method, once
+           for each combination of the user's roles, permission,
+           classname and property; the result is kept in a decision
+           cache so only check functions are called on later lookups.
+           The cache is cleared by addRole, addPermission,
+           addPermissionToRole and when the permissions list of one of
+           this Security's Roles is replaced; code appending
+           to that list directly must call clearDecisions.
         '''
         if itemid and classname is None:
             raise ValueError, 'classname must accompany itemid'
-        for rolename in self.db.user.get_roles(userid):
+        granted, perms = self.getDecision(permission, userid, classname,
+            property)
+        if granted:
+            return 1
+        if skip_permissions_with_check or not perms:
+            return 0
+        if itemid is None:
+            return 1
+        for perm in perms:
+            self.check_calls += 1
+            if perm.check(self.db, userid, itemid):
+                return 1
+        return 0
+
+    def getDecision(self, permission, userid, classname, property):
+        '''Return the (possibly cached) compiled decision, see
+           compileDecision, for the user's roles.
+        '''
+        key = (tuple(self.db.user.get_roles(userid)), permission, classname,
+            property)
+        decision = self.decisions.get(key)
+        if decision is None:
+            self.decision_misses += 1
+            decision = self.decisions[key] = self.compileDecision(*key)
+        else:
+            self.decision_hits += 1
+        return decision
+
+    def compileDecision(self, rolenames, permission, classname, property):
+        '''Compute the part of a hasPermission decision that doesn't
+           depend on the user or item: return a tuple (granted, perms)
+           where granted is true if one of the roles has a matching
+           Permission without a check function, and perms is the list
+           of the other matching Permissions (those with a check).
+        '''
+        perms = []
+        for rolename in rolenames:
             if not rolename or not self.role.has_key(rolename):
                 continue
-            # for each of the user's Roles, check the permissions
             for perm in self.role[rolename].permissions:
-                # permission match?
-                if perm.test(self.db, permission, classname, property,
-                        userid, itemid):
-                    return 1
-        return 0
+                if not perm.test(self.db, permission, classname, property,
+                        None, None):
+                    continue
+                if perm.check is None:
+                    return (True, [])
+                perms.append(perm)
+        return (False, perms)
+
+    def filterItems(self, permission, userid, classname, itemids,
+            property=None):
+        '''Return the ids from itemids (in the same order) for which
+           hasPermission(permission, userid, classname, property, itemid)
+           is true.
+
+           If the user has a matching Permission without check function
+           the whole list is returned without looking at the items.
+           Otherwise the ids are passed through the matching
+           Permissions in turn, using their batch filter function if
+           they have one and calling their check function per item if
+           not.
+        '''
+        granted, perms = self.getDecision(permission, userid, classname,
+            property)
+        if granted:
+            return list(itemids)
+        allowed = {}
+        todo = list(itemids)
+        for perm in perms:
+            if not todo:
+                break
+            self.check_calls += len(todo)
+            for itemid in perm.filter_items(self.db, userid, todo):
+                allowed[itemid] = 1
+            todo = [itemid for itemid in todo if itemid not in allowed]
+        return [itemid for itemid in itemids if itemid in allowed]
+
+    def clearDecisions(self):
+        '''Forget the compiled permission decisions. This happens
+           automatically when Roles are added or changed.
+        '''
+        # a new dict: copies of this Security may share the old one
+        self.decisions = {}
+
+    def decision_stats(self):
+        '''Return the permission decision cache hit/miss counters and
+           the number of items passed to Permission check functions.
+        '''
+        return {'entries': len(self.decisions), 'hits': self.decision_hits,
+            'misses': self.decision_misses, 'checks': self.check_calls}
 
     def roleHasSearchPermission(self, classname, property, *rolenames):
         """ For each of the given roles, check the permissions.
@@ -279,13 +420,16 @@ class Security:
         '''
         perm = Permission(**propspec)
         self.permission.setdefault(perm.name, []).append(perm)
+        self.clearDecisions()
         return perm
 
     def addRole(self, **propspec):
         ''' Create a new Role with the properties defined in 'propspec'
         '''
         role = Role(**propspec)
+        role.security = weakref.ref(self)
         self.role[role.name] = role
+        self.clearDecisions()
         return role
 
     def addPermissionToRole(self, rolename, permission, classname=None,
@@ -304,6 +448,7 @@ class Security:
                 properties, check)
         role = self.role[rolename.lower()]
         role.permissions.append(permission)
+        self.clearDecisions()
 
     # Convenience methods for removing non-allowed properties from a
     # filterspec or sort/group list
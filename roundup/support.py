@@ -58,6 +58,131 @@ class PrioList:
             self.sorted = True
         return iter(self.list)
 
+class LRUCache:
+    '''Mapping that holds at most 'size' entries, discarding the least
+    recently used entry when full.
+
+    Recency is kept in a circular doubly-linked list threaded through
+    the dict values, so lookups, insertions, refreshes and evictions
+    are all constant time regardless of the cache size. Each link is a
+    list [prev, next, key, value]; the list head is a sentinel link.
+
+    Membership tests and item access (`in`, `[]`) do not change the LRU
+    order; use get() for a counted, order-refreshing lookup.
+
+    >>> c = LRUCache(2)
+    >>> c['a'] = 1; c['b'] = 2
+    >>> c.get('a')
+    1
+    >>> c['c'] = 3
+    >>> sorted(c.keys())
+    ['a', 'c']
+    >>> c.hits, c.misses, c.evictions
+    (1, 0, 1)
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        '''Drop all entries (the hit/miss/eviction counters are kept).
+        '''
+        self.map = {}
+        root = self.root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link_front(self, link):
+        root = self.root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def get(self, key, default=None):
+        '''Return the value for 'key' and mark it most recently used.
+        Counts as a hit or miss in the cache statistics.
+        '''
+        link = self.map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(link)
+        self._link_front(link)
+        return link[3]
+
+    def refresh(self, key):
+        '''Mark 'key' most recently used without counting a hit.
+        '''
+        link = self.map[key]
+        self._unlink(link)
+        self._link_front(link)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def __getitem__(self, key):
+        return self.map[key][3]
+
+    def __setitem__(self, key, value):
+        link = self.map.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._link_front(link)
+            return
+        link = [None, None, key, value]
+        self._link_front(link)
+        self.map[key] = link
+        if len(self.map) > self.size:
+            # the least recently used link is the one before the root
+            last = self.root[0]
+            self._unlink(last)
+            del self.map[last[2]]
+            self.evictions += 1
+
+    def __delitem__(self, key):
+        link = self.map.pop(key)
+        self._unlink(link)
+
+    def pop(self, key, default=None):
+        link = self.map.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def __len__(self):
+        return len(self.map)
+
+    def keys(self):
+        '''Return the keys, most recently used first.
+        '''
+        l = []
+        root = self.root
+        link = root[1]
+        while link is not root:
+            l.append(link[2])
+            link = link[1]
+        return l
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def stats(self):
+        '''Return a dict of the cache statistics.
+        '''
+        return {'size': self.size, 'entries': len(self.map),
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
 class Progress:
     '''Progress display for console applications.
 
@@ -79,12 +79,14 @@ class RoundupInstance:
         cl = self.db.getclass(classname)
         if not propname:
             propname = cl.labelprop()
-        result = [cl.get(itemid, propname)
-                  for itemid in cl.list()
-                  if self.db.security.hasPermission('View', self.db.getuid(),
-                                                    classname, propname, itemid)
-                  ]
-        return result
+        itemids = [itemid for itemid in cl.list()
+                   if self.db.security.hasPermission('View', self.db.getuid(),
+                                                     classname, propname, itemid)
+                   ]
+        # fetch the values in bulk
+        labels = self.db.getlabels()
+        labels.want(classname, itemids, propname)
+        return [labels.get(classname, itemid, propname) for itemid in itemids]
 
     def filter(self, classname, search_matches, filterspec,
                sort=[], group=[]):
@@ -95,9 +97,7 @@ class RoundupInstance:
         sort = security.filterSortspec (uid, classname, sort)
         group = security.filterSortspec (uid, classname, group)
         result = cl.filter(search_matches, filterspec, sort=sort, group=group)
-        check = security.hasPermission
-        x = [id for id in result if check('View', uid, classname, itemid=id)]
-        return x
+        return security.filterItems('View', uid, classname, result)
 
     def lookup(self, classname, key):
         cl = self.db.getclass(classname)
@@ -120,7 +120,8 @@ class RoundupInstance:
                                                   classname, p, itemid):
                 raise Unauthorised('Permission to view %s of %s denied'%
                                    (p, designator))
-            result = [(prop, cl.get(itemid, prop)) for prop in props]
+        node = cl.getnodes([itemid], props).next()
+        result = [(prop, node[prop]) for prop in props]
         return dict(result)
 
     def create(self, classname, *args):
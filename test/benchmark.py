@@ -117,7 +117,223 @@ def main(backendname, time=time.time, numissues=10):
     print ' %-6.2f'%(last-first)
     sys.stdout.flush()
 
-if __name__ == '__main__':
+def lru_main(sizes=(100, 1000, 10000, 100000), lookups=100000,
+        time=time.time):
+    """ Time node cache hits (roundup.support.LRUCache as used by
+        rdbms_common.Database) for growing RDBMS_CACHE_SIZE values.
+        The time per hit should stay flat as the cache grows.
+    """
+    import random
+    from roundup.support import LRUCache
+    print 'cache size   usec/hit   usec/miss+evict'
+    for size in sizes:
+        cache = LRUCache(size)
+        keys = [('issue', str(i)) for i in range(size)]
+        for key in keys:
+            cache[key] = {}
+        probe = [random.choice(keys) for i in range(lookups)]
+        start = time()
+        for key in probe:
+            cache.get(key)
+        hit = time() - start
+        start = time()
+        for i in range(lookups):
+            key = ('msg', str(i))
+            if cache.get(key) is None:
+                cache[key] = {}
+        miss = time() - start
+        print '%10d   %8.3f   %8.3f'%(size, hit * 1e6 / lookups,
+            miss * 1e6 / lookups)
+
+def open_main(backendname='sqlite', opens=200, time=time.time):
+    """ Time Tracker.open() and close() of an optimized classic tracker,
+        executing schema.py for every open (as before) and copying the
+        schema and security settings of the first opened database, also
+        with a connection pool.
+    """
+    import shutil
+    from roundup import instance
+    from db_test_base import setupTracker
+    if not os.path.exists('_benchmark'):
+        os.makedirs('_benchmark')
+    dirname = os.path.join('_benchmark', 'open-%s'%backendname)
+    setupTracker(dirname, backendname)
+    try:
+        tracker = instance.open(dirname, optimize=1)
+        tracker.open('admin').close()
+        prototype = tracker.prototype
+        print 'open+close     msec/open'
+        for title, proto, pool in (('schema.py', None, 0),
+                ('prototype', prototype, 0), ('+ pool', prototype, 1)):
+            tracker.prototype = proto
+            tracker.config.RDBMS_CONNECTION_POOL_SIZE = pool
+            start = time()
+            for i in range(opens):
+                db = tracker.open('anonymous')
+                db.user.lookup('anonymous')
+                db.close()
+            print '%-12s   %9.3f'%(title, (time() - start) * 1e3 / opens)
+    finally:
+        shutil.rmtree(dirname)
+
+def decode_main(backendname='sqlite', rows=20000, time=time.time):
+    """ Time making up nodes of the classic issue and user classes from
+        their database rows, looking up the converter of every column
+        (as before) and with the per-class row decoder.
+    """
+    import shutil
+    from roundup.backends.rdbms_common import decode_row
+    from db_test_base import setupTracker
+    if not os.path.exists('_benchmark'):
+        os.makedirs('_benchmark')
+    dirname = os.path.join('_benchmark', 'decode-%s'%backendname)
+    tracker = setupTracker(dirname, backendname)
+    db = tracker.open('admin')
+    try:
+        db.issue.create(title='spam', status='1', priority='1',
+            nosy=['1'], assignedto='1')
+        print 'usec/row          converter per column'
+        print 'class    columns     looked up   decoder'
+        for cn in 'issue', 'user':
+            statements = db.class_statements(cn)
+            db.sql(statements.getnode, ('1',))
+            row = db.sql_fetchone()
+            props = db.getclass(cn).getprops(protected=1)
+            start = time()
+            for i in range(rows):
+                node = {}
+                for col in range(len(statements.cols)):
+                    name = statements.cols[col][0][1:]
+                    if name.endswith('_int__'):
+                        continue
+                    value = row[col]
+                    if value is not None:
+                        value = db.to_hyperdb_value(props[name].__class__)(
+                            value)
+                    node[name] = value
+            old = time() - start
+            start = time()
+            for i in range(rows):
+                node = decode_row(statements.decoder, row)
+            new = time() - start
+            print '%-8s %7d   %11.2f   %7.2f'%(cn, len(statements.cols),
+                old * 1e6 / rows, new * 1e6 / rows)
+    finally:
+        db.close()
+        shutil.rmtree(dirname)
+
+def csv_main(backendname='sqlite', numissues=2000, time=time.time):
+    """ Time the CSV export of the classic issue index, getting every
+        cell with a permission check and get() (as before) and with the
+        streaming ExportCSVAction, as the admin and as a User.
+    """
+    import shutil, csv, StringIO
+    from roundup.cgi import actions, client
+    from db_test_base import setupTracker
+    from test_cgi import makeForm
+    from mocknull import MockNull
+    if not os.path.exists('_benchmark'):
+        os.makedirs('_benchmark')
+    dirname = os.path.join('_benchmark', 'csv-%s'%backendname)
+    tracker = setupTracker(dirname, backendname)
+    db = tracker.open('admin')
+    columns = 'id,title,creation,status,priority,assignedto,nosy'
+    try:
+        for i in range(10):
+            db.user.create(username='user%s'%i, roles='User')
+        for i in range(numissues):
+            db.issue.create(title='issue %s'%i, status=str(i%8+1),
+                priority=str(i%5+1), assignedto=str(i%10+3),
+                nosy=[str(i%10+3), str((i+1)%10+3)])
+        db.commit()
+        print 'export of %d issues    sec/export'%numissues
+        print 'user    per cell   streaming'
+        for userid in '1', '3':
+            db.clearCache()
+            start = time()
+            output = StringIO.StringIO()
+            writer = csv.writer(output)
+            for itemid in db.issue.filter(None, {}, [('+', 'id')]):
+                row = []
+                for name in columns.split(','):
+                    db.security.hasPermission('View', userid, 'issue',
+                        itemid=itemid, property=name)
+                    row.append(str(db.issue.get(itemid, name)))
+                writer.writerow(row)
+            old = time() - start
+            db.clearCache()
+            cl = client.Client(tracker, None, {'PATH_INFO': '/',
+                'REQUEST_METHOD': 'GET'}, makeForm({'@columns': columns,
+                '@sort': 'id'}))
+            cl.classname = 'issue'
+            cl.db = db
+            cl.userid = userid
+            cl.language = ('en',)
+            cl.request = MockNull()
+            cl.request.wfile = StringIO.StringIO()
+            start = time()
+            actions.ExportCSVAction(cl).handle()
+            new = time() - start
+            print '%-6s %9.3f   %9.3f'%(db.user.get(userid, 'username'),
+                old, new)
+    finally:
+        db.close()
+        shutil.rmtree(dirname)
+
+def sessions_main(backends=('anydbm', 'sqlite'), sessions=1000,
+        time=time.time):
+    """ Time the session store operations of a web request: set() of a
+        new and of an existing session, get(), getall() and
+        updateTimestamp().
+    """
+    import shutil
+    from roundup.backends import get_backend
+    if not os.path.exists('_benchmark'):
+        os.makedirs('_benchmark')
+    print 'usec/op   set new   set old       get    getall   timestamp'
+    for backendname in backends:
+        backend = get_backend(backendname)
+        config.DATABASE = os.path.join('_benchmark', 'sessions-%s'%
+            backendname)
+        if os.path.exists(config.DATABASE):
+            shutil.rmtree(config.DATABASE)
+        os.makedirs(config.DATABASE + '/files')
+        db = backend.Database(config, 'admin')
+        setupSchema(db, backend)
+        keys = ['session%s'%i for i in range(sessions)]
+        try:
+            results = []
+            for op in ('set', 'set', 'get', 'getall', 'updateTimestamp'):
+                start = time()
+                for key in keys:
+                    store = db.getSessionManager()
+                    if op == 'set':
+                        store.set(key, user='admin', last_use=start)
+                    elif op == 'get':
+                        store.get(key, 'user')
+                    elif op == 'getall':
+                        store.getall(key)
+                    else:
+                        store.updateTimestamp(key)
+                db.commit()
+                results.append((time() - start) * 1e6 / sessions)
+            print '%-7s %9.1f %9.1f %9.1f %9.1f %11.1f'%((backendname,) +
+                tuple(results))
+        finally:
+            db.close()
+            shutil.rmtree(config.DATABASE)
+
+if __name__ == '__main__' and sys.argv[1:] == ['lru']:
+    lru_main()
+elif __name__ == '__main__' and sys.argv[1:] == ['open']:
+    open_main()
+elif __name__ == '__main__' and sys.argv[1:] == ['decode']:
+    decode_main()
+elif __name__ == '__main__' and sys.argv[1:] == ['csv']:
+    csv_main()
+elif __name__ == '__main__' and sys.argv[1:] == ['sessions']:
+    sessions_main()
+elif __name__ == '__main__':
     #      0         1         2         3         4         5         6
     #      01234567890123456789012345678901234567890123456789012345678901234
     print 'Test name       fetch  journl jprops lookup filter filtml TOTAL '
@@ -24,7 +24,7 @@ from roundup.hyperdb import String, Password, Link, Multilink, Date, \
     Interval, DatabaseError, Boolean, Number, Node
 from roundup.mailer import Mailer
 from roundup import date, password, init, instance, configuration, \
-    roundupdb, i18n
+    roundupdb, i18n, security
 from roundup.cgi.templating import HTMLItem
 
 from mocknull import MockNull
@@ -922,6 +922,57 @@ class DBTest(commonDBTest):
         self.assertEqual(len(self.db.getjournal('user', id)), 1)
         self.db.commit()
 
+    def testJournalPaging(self):
+        ae = self.assertEqual
+        id = self.db.issue.create(title="spam")
+        for day in range(1, 6):
+            self.db.addjournal('issue', id, 'set', {'title': str(day)},
+                creation=date.Date('2010-01-%02d'%day))
+        def titles(**kw):
+            return [params.get('title', action) for (nodeid, date_stamp, tag,
+                action, params) in self.db.issue.history(id, **kw)]
+        for i in range(2):
+            # uncommitted and committed
+            ae(titles(), ['1', '2', '3', '4', '5', 'create'])
+            ae(titles(direction='descending', limit=2), ['create', '5'])
+            ae(titles(direction='descending', limit=2, offset=2), ['4', '3'])
+            ae(titles(limit=2), ['1', '2'])
+            ae(titles(offset=4), ['5', 'create'])
+            ae(titles(daterange='2010-01-02;2010-01-04'), ['2', '3', '4'])
+            ae(titles(daterange=date.Range('2010-01-04;', date.Date),
+                direction='descending', limit=2), ['create', '5'])
+            ae(self.db.getjournal('issue', id, 'descending', 1)[0][3],
+                'create')
+            self.db.commit()
+        # entries of the same date are in the same order on every page
+        for title in 'cab':
+            self.db.addjournal('issue', id, 'set', {'title': title},
+                creation=date.Date('2010-01-06'))
+        self.db.commit()
+        ae(titles(offset=5, limit=3), ['a', 'b', 'c'])
+        for direction in ('ascending', 'descending'):
+            pages = [titles(direction=direction, limit=1, offset=offset)
+                for offset in range(9)]
+            ae(sum(pages, []), titles(direction=direction))
+
+    def testLabels(self):
+        ae = self.assertEqual
+        labels = self.db.getlabels()
+        ae(self.db.getlabels() is labels, True)
+        labels.want('status', ['1', '2', '99'])
+        labels.want('user', ['1'], 'username')
+        ae(labels.get('status', '1'), 'unread')
+        ae(labels.get('status', '2'), 'in-progress')
+        ae(labels.get('status', '2', 'name'), 'in-progress')
+        ae(labels.get('user', '1', 'username'), 'admin')
+        self.assertRaises(IndexError, labels.get, 'status', '99')
+        # changes are seen
+        self.db.status.set('2', name='started')
+        ae(labels.get('status', '2'), 'started')
+        self.db.rollback()
+        ae(labels.labels, {})
+        ae(labels.get('status', '2'), 'in-progress')
+
     def testPack(self):
         id = self.db.issue.create(title="spam", status='1')
         self.db.commit()
@@ -970,6 +1021,118 @@ class DBTest(commonDBTest):
         # unindexed stopword
         self.assertEquals(self.db.indexer.search(['the'], self.db.issue), {})
 
+    def testIndexerSearchScores(self):
+        m1 = self.db.msg.create(content="the flebble plops")
+        i1 = self.db.issue.create(title="flebble frooz", messages=[m1])
+        i2 = self.db.issue.create(title="frooz the flebble")
+        i3 = self.db.issue.create(title="plop")
+        self.db.commit()
+        scores = self.db.indexer.search_scores
+        self.assertEquals(scores('', self.db.issue), {})
+        self.assertEquals(scores('the', self.db.issue), {})
+        self.assertEquals(sorted(scores('flebble', self.db.issue)), [i1, i2])
+        # hits in linked messages add to the score
+        s = scores('flebble', self.db.issue)
+        self.assert_(s[i1] > s[i2])
+        # prefixes
+        self.assertEquals(sorted(scores('plop*', self.db.issue)), [i1, i3])
+        self.assertEquals(sorted(scores('fle* fro*', self.db.issue)),
+            [i1, i2])
+        # phrases
+        self.assertEquals(sorted(scores('"frooz the flebble"',
+            self.db.issue)), [i2])
+        self.assertEquals(sorted(scores('"flebble frooz"', self.db.issue)),
+            [i1])
+        self.assertEquals(sorted(scores('"flebble frooz" fro*',
+            self.db.issue)), [i1])
+        # the links of the nodes that are hits are fetched together
+        fetched = []
+        getnodes = self.db.issue.getnodes
+        def recording_getnodes(nodeids, props=None):
+            fetched.append(sorted(nodeids))
+            return getnodes(nodeids, props)
+        self.db.issue.getnodes = recording_getnodes
+        try:
+            s2 = scores('flebble', self.db.issue)
+        finally:
+            del self.db.issue.getnodes
+        self.assertEquals(s2, s)
+        self.assertEquals(fetched, [sorted([i1, i2])])
+
+    def testDeferredIndexing(self):
+        from roundup.backends.indexer_common import DeferredIndexer
+        indexer = DeferredIndexer(self.db, self.db.indexer)
+        self.db.indexer = indexer
+        m1 = self.db.msg.create(content="one two")
+        i1 = self.db.issue.create(title="flebble", messages=[m1])
+        self.db.commit()
+        queued = [entry[0] for entry in self.db.get_text_queue()]
+        self.assert_(('msg', m1, 'content') in queued)
+        self.assert_(('issue', i1, 'title') in queued)
+        # the queued texts are searched directly
+        self.assertEquals(indexer.indexer.search(['two'], self.db.issue), {})
+        self.assertEquals(indexer.search(['two'], self.db.issue),
+            {i1: {'messages': [m1]}})
+        self.assertEquals(indexer.search_scores('fleb*', self.db.issue).keys(),
+            [i1])
+        # the words of the queued texts are only loaded once
+        loaded = []
+        get_text = indexer.get_text
+        def counting_get_text(identifier):
+            loaded.append(identifier)
+            return get_text(identifier)
+        indexer.get_text = counting_get_text
+        self.assertEquals(indexer.search(['one'], self.db.issue),
+            {i1: {'messages': [m1]}})
+        self.assertEquals(loaded, [])
+        del indexer.get_text
+        # index in batches
+        self.assertEquals(indexer.index_pending(1), 1)
+        self.assertEquals(len(self.db.get_text_queue()), len(queued) - 1)
+        while indexer.index_pending(1):
+            self.db.commit()
+        self.assertEquals(self.db.get_text_queue(), [])
+        self.assertEquals(indexer.indexer.search(['two'], self.db.issue),
+            {i1: {'messages': [m1]}})
+
+        # stale index entries of queued texts are ignored
+        self.db.issue.set(i1, title="frooz")
+        self.db.commit()
+        self.assertEquals(indexer.indexer.search(['flebble'], self.db.issue),
+            {i1: {}})
+        self.assertEquals(indexer.search(['flebble'], self.db.issue), {})
+        self.assertEquals(indexer.search(['frooz'], self.db.issue), {i1: {}})
+        indexer.search_pending = False
+        self.assertEquals(indexer.search(['frooz'], self.db.issue), {})
+        self.assertEquals(indexer.index_pending(), 1)
+        self.db.commit()
+        self.assertEquals(indexer.search(['frooz'], self.db.issue), {i1: {}})
+
+        # rolled back changes aren't queued
+        self.db.issue.set(i1, title="plop")
+        self.db.rollback()
+        self.assertEquals(self.db.get_text_queue(), [])
+
+    def testTextQueue(self):
+        self.db.queue_text(('issue', '1', 'title'))
+        self.db.commit()
+        entries = self.db.get_text_queue()
+        self.assertEquals([entry[0] for entry in entries],
+            [('issue', '1', 'title')])
+        # queued again after being read: the new entry is kept
+        time.sleep(.01)
+        self.db.queue_text(('issue', '1', 'title'))
+        self.db.queue_text(('msg', '1', 'content'))
+        self.db.commit()
+        self.db.dequeue_text(entries)
+        self.db.commit()
+        self.assertEquals([entry[0] for entry in self.db.get_text_queue()],
+            [('issue', '1', 'title'), ('msg', '1', 'content')])
+        self.assertEquals(len(self.db.get_text_queue(1)), 1)
+        self.db.dequeue_text(self.db.get_text_queue())
+        self.db.commit()
+        self.assertEquals(self.db.get_text_queue(), [])
+
     def testIndexerSearchingLink(self):
         m1 = self.db.msg.create(content="one two")
         i1 = self.db.issue.create(messages=[m1])
@@ -1222,6 +1385,40 @@ class DBTest(commonDBTest):
             ae(filt(None, {'id': '2'}, ('+','id'), (None,None)), ['2'])
             ae(filt(None, {'id': '100'}, ('+','id'), (None,None)), [])
 
+    def testGetnodes(self):
+        ae, filter, filter_iter = self.filteringSetup()
+        nodes = list(self.db.issue.getnodes(['3', '1', '2']))
+        ae([n.nodeid for n in nodes], ['3', '1', '2'])
+        ae([n.title for n in nodes], ['issue three', 'issue one',
+            'issue two'])
+        ae([n['nosy'] for n in nodes], [['1','2'], [], []])
+        nodes = list(self.db.issue.getnodes(['1', '99'], ['title']))
+        ae(nodes[0].title, 'issue one')
+        self.assertRaises(IndexError, nodes[1].__getitem__, 'title')
+
+    def testFilteringLimitOffset(self):
+        ae, filter, filter_iter = self.filteringSetup()
+        def filt_iter(*args, **kw):
+            return list(self.db.issue.filter_iter(*args, **kw))
+        for filt in filter, filt_iter:
+            ae(filt(None, {}, ('-','id'), (None,None), limit=2), ['4','3'])
+            ae(filt(None, {}, ('-','id'), (None,None), limit=2, offset=1),
+                ['3','2'])
+            ae(filt(None, {}, ('+','id'), (None,None), offset=3), ['4'])
+            ae(filt(None, {'status': '1'}, ('+','id'), (None,None), limit=1,
+                offset=1), ['3'])
+            ae(filt(None, {}, ('+','id'), (None,None), limit=2, offset=10),
+                [])
+        # sorting by Multilink is done outside the database
+        l = filter(None, {}, ('+','nosy'), (None,None))
+        ae(filter(None, {}, ('+','nosy'), (None,None), limit=2, offset=1),
+            l[1:3])
+        ae(self.db.issue.filter_count(None, {}), 4)
+        ae(self.db.issue.filter_count(None, {'status': '1'}), 2)
+        ae(self.db.issue.filter_count(None, {'nosy': ['1', '2']}), 2)
+        ae(self.db.issue.filter_count(['1', '3'], {'status': '1'}), 1)
+        ae(self.db.issue.filter_count([], {}), 0)
+
     def testFilteringBoolean(self):
         ae, filter, filter_iter = self.filteringSetup('user')
         a = 'assignable'
@@ -2462,6 +2659,266 @@ class FilterCacheTest(commonDBTest):
             self.db.clearCache()
         ae (result, ['4', '5', '6', '7', '8', '1', '2', '3'])
 
+    def testNodeCacheLRU(self):
+        ae = self.assertEqual
+        for name in 'a', 'b', 'c':
+            self.db.status.create(name=name)
+        self.db.commit()
+        self.db.cache.size = 2
+        before = self.db.cache_stats()
+        self.db.status.get('1', 'name')
+        self.db.status.get('2', 'name')
+        self.db.status.get('1', 'name')
+        # evicts status2, the least recently used node
+        self.db.status.get('3', 'name')
+        ae(sorted(self.db.cache.keys()), [('status', '1'), ('status', '3')])
+        stats = self.db.cache_stats()
+        ae(stats['hits'] - before['hits'], 1)
+        ae(stats['misses'] - before['misses'], 3)
+        ae(stats['evictions'] - before['evictions'], 1)
+        # destroying or changing a node drops it from the cache
+        self.db.status.set('1', name='aa')
+        ae(('status', '1') in self.db.cache, False)
+        self.db.status.destroy('3')
+        ae(('status', '3') in self.db.cache, False)
+        ae(len(self.db.cache), 0)
+
+    def testPrefetchMultilinks(self):
+        ae, filter, filter_iter = self.filteringSetupTransitiveSearch()
+        self.db.commit()
+        statements = []
+        sql = self.db.sql
+        def counting_sql(*args, **kw):
+            statements.append(args[0])
+            return sql(*args, **kw)
+        self.db.sql = counting_sql
+        ids = self.db.issue.filter(None, {}, ('+','id'))
+        ae(ids, ['1', '2', '3', '4', '5', '6', '7', '8'])
+        del statements[:]
+        self.db.issue.prefetch_multilinks(ids, ['nosy', 'messages'])
+        # one query for the nodes and one for each Multilink
+        ae(len(statements), 3)
+        ae([self.db.issue.get(id, 'nosy') for id in ids],
+            [['4'], ['5'], [], [], [], [], [], []])
+        ae(self.db.issue.get('8', 'messages'), ['7', '8'])
+        ae(len(statements), 3)
+
+        self.db.clearCache()
+        del statements[:]
+        result = []
+        for id in self.db.issue.filter_iter(None, {'status': '1'},
+                ('+','id'), multilinks=['messages']):
+            result.append((id, self.db.issue.get(id, 'messages')))
+        ae(result, [('2', ['4']), ('4', ['6']), ('6', ['8']),
+            ('8', ['7', '8'])])
+        ae(len(statements), 2)
+
+    def testGetnodes(self):
+        ae, filter, filter_iter = self.filteringSetupTransitiveSearch()
+        self.db.commit()
+        statements = []
+        sql = self.db.sql
+        def counting_sql(*args, **kw):
+            statements.append(args[0])
+            return sql(*args, **kw)
+        self.db.sql = counting_sql
+        self.db.clearCache()
+        ids = ['1', '2', '3', '4', '5', '6', '7', '8']
+        nodes = list(self.db.issue.getnodes(ids, ['title', 'nosy']))
+        # one query for the nodes and one for the requested Multilink
+        ae(len(statements), 2)
+        ae([n.nodeid for n in nodes], ids)
+        ae([n.nosy for n in nodes], [['4'], ['5'], [], [], [], [], [], []])
+        ae(len(statements), 2)
+        # chunks are bounded by the node cache size
+        self.db.clearCache()
+        del statements[:]
+        self.db.cache_size = self.db.cache.size = 3
+        titles = [n.title for n in self.db.issue.getnodes(ids, [])]
+        ae(len(titles), 8)
+        # and each chunk is still cached when its nodes are read
+        ae(len(statements), 3)
+
+    def testLabelsBulk(self):
+        ae = self.assertEqual
+        self.filteringSetupTransitiveSearch()
+        self.db.commit()
+        self.db.clearCache()
+        statements = []
+        sql = self.db.sql
+        def counting_sql(*args, **kw):
+            statements.append(args[0])
+            return sql(*args, **kw)
+        self.db.sql = counting_sql
+        labels = self.db.getlabels()
+        labels.want('user', ['3', '4', '5', '6'])
+        ae([labels.get('user', id) for id in '3', '4', '5', '6'],
+            ['ceo', 'grouplead1', 'grouplead2', 'worker1'])
+        ae(len(statements), 1)
+        # and for the Multilinks rendered
+        from roundup.cgi.templating import MultilinkHTMLProperty
+        client = MockNull(db=self.db, userid='1', form={})
+        del statements[:]
+        self.db.clearCache()
+        ae(len(labels.labels), 0)
+        prop = MultilinkHTMLProperty(client, 'issue', '8',
+            self.db.issue.getprops()['nosy'], 'nosy', ['7', '8', '9'])
+        prop.is_view_ok = lambda: True
+        ae(prop.plain(), 'worker2, worker3, worker4')
+        ae(len(statements), 1)
+
+    def testClassStatements(self):
+        ae = self.assertEqual
+        statements = self.db.class_statements('issue')
+        # figured out once by post_init, shared by clones
+        ae(self.db.issue.statements is statements, True)
+        ae(self.db.issue.clone(self.db).statements is statements, True)
+        ae(self.db.class_statements('issue') is statements, True)
+        ae(statements.mls, [c for c, p in self.db.issue.properties.items()
+            if isinstance(p, Multilink)])
+        ae(statements.setnode(('status', 'title')),
+            statements.setnode(('status', 'title')))
+        # the row decoder skips the Interval-as-seconds column
+        names = [name for idx, name, cvt in statements.decoder]
+        ae(names.count('foo'), 1)
+        ae([n for n in names if n.endswith('_int__')], [])
+        ae(sorted(names), sorted([c for c in self.db.issue.getprops()
+            if c != 'id' and c not in statements.mls]))
+
+        executed = []
+        sql_prepared = self.db.sql_prepared
+        def recording_sql_prepared(sql, args):
+            executed.append(sql)
+            return sql_prepared(sql, args)
+        self.db.sql_prepared = recording_sql_prepared
+        id = self.db.issue.create(title='spam', status='1', nosy=['1'])
+        self.db.issue.set(id, title='eggs')
+        self.db.commit()
+        self.db.clearCache()
+        ae(self.db.issue.get(id, 'title'), 'eggs')
+        ae(self.db.issue.get(id, 'nosy'), ['1'])
+        ae(self.db.issue.get(id, 'status'), '1')
+        ae(statements.addnode in executed, True)
+        ae(statements.getnode in executed, True)
+        ae(statements.multilink['nosy'] in executed, True)
+        ae(statements.multilink_add['nosy'] in executed, True)
+        ae([sql for sql in statements.setnode_sql.values()
+            if sql in executed] != [], True)
+
+        # the profile has the statements, even when they are prepared
+        from roundup import profiler
+        profile = profiler.Profile()
+        profile.attach(self.db)
+        try:
+            self.db.clearCache()
+            self.db.issue.get(id, 'title')
+        finally:
+            profile.detach()
+        ae(profile.sql.keys(), [profiler.normalise_sql(statements.getnode)])
+
+        # adding a property invalidates the statements
+        self.db.issue.addprop(fixer=Link("user"))
+        ae(self.db.issue.statements, None)
+        self.db.post_init()
+        ae('_fixer' in self.db.class_statements('issue').scols, True)
+        self.db.clearCache()
+        self.db.issue.set(id, fixer='1')
+        self.db.clearCache()
+        ae(self.db.issue.get(id, 'fixer'), '1')
+        ae(self.db.issue.get(id, 'title'), 'eggs')
+
+    def testSharedNodeCache(self):
+        ae = self.assertEqual
+        self.db.close()
+        config.RDBMS_SHARED_CACHE_CLASSES = 'status'
+        try:
+            self.open_database()
+            setupSchema(self.db, 0, self.module)
+            db2 = self.module.Database(config, 'admin')
+            setupSchema(db2, 0, self.module)
+        finally:
+            config.RDBMS_SHARED_CACHE_CLASSES = ''
+        try:
+            ae(self.db.shared_cache is db2.shared_cache, True)
+            self.db.shared_cache.invalidate()
+            statements = []
+            sql = db2.sql
+            def counting_sql(*args, **kw):
+                statements.append(args[0])
+                return sql(*args, **kw)
+            db2.sql = counting_sql
+            ae(self.db.status.get('1', 'name'), 'unread')
+            ae(self.db.status.get('2', 'name'), 'in-progress')
+            ae(db2.status.get('1', 'name'), 'unread')
+            ae(db2.status.get('1', 'mls'), ['1', '2'])
+            ae(db2.status.get('2', 'name'), 'in-progress')
+            ae(statements, [])
+            # classes not in shared_cache_classes still go to the database
+            db2.priority.get('1', 'name')
+            ae(len(statements), 1)
+
+            # uncommitted changes are only seen by the changing connection
+            self.db.status.set('2', name='foo')
+            ae(self.db.status.get('2', 'name'), 'foo')
+            db2.rollback()
+            ae(db2.status.get('2', 'name'), 'in-progress')
+            self.db.commit()
+            db2.rollback()
+            del statements[:]
+            ae(db2.status.get('2', 'name'), 'foo')
+            ae(db2.status.get('1', 'name'), 'unread')
+            # the commit invalidated the whole class (node + multilink)
+            ae(len(statements), 4)
+            db2.rollback()
+            del statements[:]
+            ae(db2.status.get('2', 'name'), 'foo')
+            ae(statements, [])
+        finally:
+            db2.close()
+
+    def testConnectionPool(self):
+        ae = self.assertEqual
+        self.db.close()
+        config.RDBMS_CONNECTION_POOL_SIZE = 1
+        try:
+            self.open_database()
+            setupSchema(self.db, 0, self.module)
+            pool = self.db.connection_pool
+            pool.clear()
+            conn = self.db.conn
+            # uncommitted changes are rolled back on return to the pool
+            self.db.status.set('1', name='foo')
+            self.db.close()
+            self.db.close()
+            ae(pool.stats()['idle'], 1)
+            self.open_database()
+            setupSchema(self.db, 0, self.module)
+            ae(self.db.conn is conn, True)
+            ae(pool.stats()['idle'], 0)
+            ae(self.db.status.get('1', 'name'), 'unread')
+            # a full pool closes the connection
+            db2 = self.module.Database(config, 'admin')
+            ae(db2.conn is conn, False)
+            self.db.close()
+            db2.close()
+            ae(pool.stats()['idle'], 1)
+            # broken and expired connections are discarded
+            conn.close()
+            self.open_database()
+            ae(self.db.conn is conn, False)
+            ae(pool.stats()['discarded'], 1)
+            self.db.close()
+            pool.max_idle = -1
+            self.open_database()
+            ae(pool.stats()['discarded'], 2)
+            pool.max_idle = 300
+        finally:
+            config.RDBMS_CONNECTION_POOL_SIZE = 0
+        self.db.close()
+        pool.clear()
+        self.open_database()
+        setupSchema(self.db, 0, self.module)
+
 
 class ClassicInitBase(unittest.TestCase):
     count = 0
@@ -2511,6 +2968,56 @@ class ClassicInitTest(ClassicInitBase):
         l = db.issue.list()
         ae(l, [])
 
+    def testSchemaPrototype(self):
+        ae = self.assertEqual
+        setupTracker(self.dirname, self.backend)
+        tracker = instance.open(self.dirname, optimize=1)
+        db = tracker.open('admin')
+        prototype = tracker.prototype
+        ae(prototype is not None, True)
+        db.close()
+
+        # later databases get copies of the classes and security,
+        # without building a Security of their own
+        built = []
+        security_init = security.Security.__init__
+        def counting_init(self, db):
+            built.append(db)
+            security_init(self, db)
+        security.Security.__init__ = counting_init
+        try:
+            db = self.db = tracker.open('admin')
+        finally:
+            security.Security.__init__ = security_init
+        ae(built, [])
+        ae(tracker.prototype is prototype, True)
+        ae(db.getclasses(), [k.classname for k in prototype.classes])
+        issue_proto = [k for k in prototype.classes
+            if k.classname == 'issue'][0]
+        ae(db.issue is issue_proto, False)
+        ae(db.issue.properties is issue_proto.properties, True)
+        ae(db.security.hasPermission('Edit', db.getuid(), 'issue'), 1)
+        ae(db.security.hasPermission('Edit',
+            db.user.lookup('anonymous'), 'issue'), 0)
+        db.security.addRole(name='Frob')
+        ae('frob' in prototype.security.role, False)
+        # the detectors are applied when first needed
+        ae(len(db.pending_detectors), 4)
+        issue = db.issue.create(title='spam')
+        ae(db.pending_detectors, ())
+        ae(db.issue.get(issue, 'status'), db.status.lookup('unread'))
+        db.commit()
+        db.close()
+
+        # the schema hook is called for every database
+        calls = []
+        tracker = instance.open(self.dirname, optimize=1)
+        tracker.schema_hook = lambda **env: calls.append(env['db'])
+        tracker.open('admin').close()
+        db = self.db = tracker.open('admin')
+        ae(tracker.prototype, None)
+        ae(len(calls), 2)
+
 
 class ConcurrentDBTest(ClassicInitBase):
     def testConcurrency(self):
@@ -2630,4 +3137,49 @@ class HTMLItemTest(ClassicInitBase):
         ae(bool(issue ['assignedto']['username']),False)
         ae(bool(issue ['priority']['name']),False)
 
+    def testHTMLItemHistory(self):
+        import cgi
+        ae = self.assertEqual
+        for day in range(1, 6):
+            self.db.addjournal('issue', '1', 'set', {'title': 'day%d'%day},
+                creation=date.Date('2010-01-%02d'%day))
+        self.db.commit()
+        # the latest entries are the creation and the last two changes
+        issue = HTMLItem(self.client, 'issue', '1')
+        history = issue.history(limit=3, more='history_limit')
+        ae('day5' in history, True)
+        ae('day4' in history, True)
+        ae('day3' in history, False)
+        ae('href="issue1?history_limit=6"' in history, True)
+        # the link keeps the rest of the request
+        self.client.env['QUERY_STRING'] = '@template=item&history_limit=3'
+        history = issue.history(limit=3, more='history_limit')
+        ae('href="issue1?%40template=item&amp;history_limit=6"' in history,
+            True)
+        # the form variable overrides the limit
+        self.client.form = cgi.FieldStorage(environ={
+            'QUERY_STRING': 'history_limit=10', 'REQUEST_METHOD': 'GET'})
+        history = issue.history(limit=2, more='history_limit')
+        ae('day1' in history, True)
+        ae('history_limit' in history, False)
+        # values below 1 are ignored, large ones capped
+        for value in '-5', '0':
+            self.client.form = cgi.FieldStorage(environ={
+                'QUERY_STRING': 'history_limit=' + value,
+                'REQUEST_METHOD': 'GET'})
+            history = issue.history(limit=2, more='history_limit')
+            ae('day5' in history, True)
+            ae('day4' in history, False)
+            ae('history_limit=4' in history, True)
+        issue.max_history_limit = 3
+        self.client.form = cgi.FieldStorage(environ={
+            'QUERY_STRING': 'history_limit=1000', 'REQUEST_METHOD': 'GET'})
+        history = issue.history(limit=2, more='history_limit')
+        ae('day4' in history, True)
+        ae('day3' in history, False)
+        ae('history_limit' in history, False)
+        del issue.max_history_limit
+        history = issue.history(daterange='2010-01-02;2010-01-03')
+        ae([d for d in range(1, 6) if 'day%d'%d in history], [2, 3])
+
 # vim: set et sts=4 sw=4 :
@@ -137,8 +137,8 @@ class BasicDatabase(dict):
         pass
     def updateTimestamp(self, sessid):
         pass
-    def clean(self):
-        pass
+    def clean(self, limit=None):
+        return 0
 
 class Sessions(BasicDatabase, sessions_dbm.Sessions):
     name = 'sessions'
@@ -178,7 +178,7 @@ class Database(back_anydbm.Database):
       modified. Do some sort of conflict checking on the dirty stuff.
     - perhaps detect write collisions (related to above)?
     """
-    def __init__(self, config, journaltag=None):
+    def __init__(self, config, journaltag=None, base_security=None):
         self.config, self.journaltag = config, journaltag
         self.classes = {}
         self.items = {}
@@ -186,7 +186,10 @@ class Database(back_anydbm.Database):
         self.journals = {}
         self.files = {}
         self.tx_files = {}
-        self.security = security.Security(self)
+        if base_security is None:
+            self.security = security.Security(self)
+        else:
+            self.security = base_security.copy(self)
         self.stats = {'cache_hits': 0, 'cache_misses': 0, 'get_items': 0,
             'filtering': 0}
         self.sessions = Sessions()
@@ -199,6 +202,8 @@ class Database(back_anydbm.Database):
         self.newnodes = {}      # keep track of the new nodes by class
         self.destroyednodes = {}# keep track of the destroyed nodes by class
         self.transactions = []
+        self.textqueue = {}
+        self.queued_texts = {}
         self.tx_Source = None
 
     def filename(self, classname, nodeid, property=None, create=0):
@@ -310,6 +315,25 @@ class Database(back_anydbm.Database):
     def getCachedJournalDB(self, classname):
         return self.journals.setdefault(classname, {})
 
+    #
+    # Deferred indexing queue
+    #
+    def get_text_queue(self, limit=None):
+        entries = self.queued_texts.items()
+        entries.sort(key=lambda entry: entry[1])
+        if limit is not None:
+            entries = entries[:limit]
+        return entries
+
+    def dequeue_text(self, entries):
+        for identifier, stamp in entries:
+            if self.queued_texts.get(identifier, stamp + 1) <= stamp:
+                del self.queued_texts[identifier]
+
+    def doSaveTextQueue(self):
+        self.queued_texts.update(self.textqueue)
+        self.textqueue = {}
+
     #
     # Node IDs
     #
@@ -334,7 +358,8 @@ class Database(back_anydbm.Database):
     def doSetJournal(self, classname, nodeid, journal):
         self.journals.setdefault(classname, {})[nodeid] = journal
 
-    def getjournal(self, classname, nodeid):
+    def getjournal(self, classname, nodeid, direction='ascending',
+            limit=None, offset=None, daterange=None):
         # our journal result
         res = []
 
@@ -353,11 +378,11 @@ class Database(back_anydbm.Database):
                 res.append((cache_nodeid, cache_creation, cache_creator,
                     cache_action, cache_params))
         try:
-            res += self.journals.get(classname, {})[nodeid]
+            res = self.journals.get(classname, {})[nodeid] + res
         except KeyError:
-            if res: return res
-            raise IndexError, nodeid
-        return res
+            if not res:
+                raise IndexError, nodeid
+        return self.select_journal(res, direction, limit, offset, daterange)
 
     def pack(self, pack_before):
         """ Delete all journal entries except "create" before 'pack_before'.
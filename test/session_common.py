@@ -1,4 +1,4 @@
-import os, shutil, unittest
+import os, shutil, unittest, time
 
 from db_test_base import config
 
@@ -49,9 +49,103 @@ class SessionTest(unittest.TestCase):
         self.sessions.set('random_key', text='nope')
         self.assertEqual(self.sessions.get('random_key', 'text'), 'nope')
 
+    def testValues(self):
+        values = {'user': 'admin', 'uid': 3, 'last_use': 1234.5,
+            'text': u'\xe4', 'none': None}
+        self.sessions.set('random_key', **values)
+        self.sessions.commit()
+        sessions = self.db.getSessionManager()
+        self.assertEqual(sessions.getall('random_key'), values)
+        self.assertEqual(sessions.get('random_key', 'none', 1), None)
+        self.assertEqual(sessions.get('other_key', 'user', 1), 1)
+
 class DBMTest(SessionTest):
     import roundup.backends.sessions_dbm as sessions_module
 
 class RDBMSTest(SessionTest):
     import roundup.backends.sessions_rdbms as sessions_module
 
+    def testSingleStatement(self):
+        statements = []
+        class Cursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+            def execute(self, sql, *args):
+                statements.append(sql)
+                return self.cursor.execute(sql, *args)
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+        self.sessions.cursor = Cursor(self.sessions.cursor)
+        self.assertEqual(self.sessions.exists('random_key'), False)
+        self.sessions.set('random_key', text='hello, world!', user='admin')
+        self.assertEqual(len(statements), 2)
+        self.assert_(statements[-1].startswith('insert'))
+        self.sessions.set('random_key', text='nope')
+        self.assertEqual(len(statements), 3)
+        self.assert_(statements[-1].startswith('update'))
+        self.assertEqual(self.sessions.getall('random_key'),
+            {'text': 'nope', 'user': 'admin'})
+        self.assertEqual(len(statements), 3)
+        # the value isn't repr()'d
+        self.db.cursor.execute('select session_value from sessions')
+        value = self.db.cursor.fetchone()[0]
+        self.assertEqual(self.sessions_module.decode_value(value),
+            {'text': 'nope', 'user': 'admin'})
+
+    def testUpdateNoRowsChanged(self):
+        # MySQL doesn't count the rows an update leaves as they were
+        class Cursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+            def execute(self, sql, *args):
+                self.rowcount = None
+                result = self.cursor.execute(sql, *args)
+                if sql.startswith('update'):
+                    self.rowcount = 0
+                return result
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+        self.sessions.set('random_key', text='hello, world!')
+        self.sessions.cursor = Cursor(self.sessions.cursor)
+        self.sessions.set('random_key', text='nope')
+        self.db.cursor.execute('select session_value from sessions')
+        rows = self.db.cursor.fetchall()
+        self.assertEqual([self.sessions_module.decode_value(row[0])
+            for row in rows], [{'text': 'nope'}])
+        # an item destroyed by someone else is inserted again
+        self.db.cursor.execute('delete from sessions')
+        self.sessions.set('random_key', text='again')
+        self.db.cursor.execute('select session_value from sessions')
+        rows = self.db.cursor.fetchall()
+        self.assertEqual([self.sessions_module.decode_value(row[0])
+            for row in rows], [{'text': 'again'}])
+
+    def testUpgradeValues(self):
+        # the values were stored as repr() text before version 7
+        a = self.db.arg
+        for key, value in (('a', repr({'user': 'admin', 'uid': 3})),
+                ('b', '(broken')):
+            self.db.cursor.execute('insert into sessions (session_key, '
+                'session_time, session_value) values (%s, %s, %s)'%(a, a, a),
+                (key, time.time(), value))
+        self.db.cursor.execute('insert into otks (otk_key, otk_time, '
+            'otk_value) values (%s, %s, %s)'%(a, a, a),
+            ('c', time.time(), repr({'__time': 1234.5})))
+        self.db.fix_version_6_tables()
+        self.assertEqual(self.sessions.getall('a'),
+            {'user': 'admin', 'uid': 3})
+        self.assertEqual(self.sessions.list(), ['a'])
+        self.assertEqual(self.otks.getall('c'), {'__time': 1234.5})
+
+    def testExpiry(self):
+        for key in 'a', 'b', 'c', 'new':
+            self.sessions.set(key, user='admin')
+        self.db.cursor.execute('update sessions set session_time=%s '
+            'where session_key<>%s'%(self.db.arg, self.db.arg),
+            (time.time() - 8*24*60*60, 'new'))
+        self.assertEqual(self.sessions.clean(2), 2)
+        self.assertEqual(self.sessions.clean(2), 1)
+        self.assertEqual(self.sessions.clean(2), 0)
+        self.assertEqual(self.sessions.list(), ['new'])
+        self.assertEqual(self.sessions.exists('a'), False)
+
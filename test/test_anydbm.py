@@ -44,7 +44,34 @@ class anydbmHTMLItemTest(HTMLItemTest):
 
 from session_common import DBMTest
 class anydbmSessionTest(anydbmOpener, DBMTest):
-    pass
+    def testTwoStores(self):
+        sessions = self.db.getSessionManager()
+        self.assert_(self.db.getSessionManager() is sessions)
+        # another process using the same file
+        other = self.sessions_module.Sessions(self.db)
+        sessions.set('a', text='one')
+        other.set('b', text='two')
+        sessions.set('c', text='three')
+        other.updateTimestamp('a')
+        l = sessions.list()
+        l.sort()
+        self.assertEqual(l, ['a', 'b', 'c'])
+        self.assertEqual(other.getall('c'), {'text': 'three'})
+
+    def testExpiry(self):
+        sessions = self.db.getSessionManager()
+        old = time.time() - 8*24*60*60
+        for key in 'a', 'b', 'c':
+            sessions.set(key, user='admin', __timestamp=old)
+        sessions.set('new', user='admin')
+        # used since
+        sessions.set('b', __timestamp=time.time())
+        self.db.commit()
+        self.assertEqual(sessions.clean(2), 2)
+        self.assertEqual(sessions.clean(2), 1)
+        self.assertEqual(sessions.clean(2), 0)
+        self.assertEqual(sorted(sessions.list()), ['b', 'new'])
+        self.assertEqual(self.db.expire_sessions(2), False)
 
 def test_suite():
     suite = unittest.TestSuite()
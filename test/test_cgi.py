@@ -8,7 +8,7 @@
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 
-import unittest, os, shutil, errno, sys, difflib, cgi, re, StringIO
+import unittest, os, shutil, errno, sys, difflib, cgi, re, StringIO, gzip
 
 from roundup.cgi import client, actions, exceptions
 from roundup.cgi.exceptions import FormError
@@ -944,6 +944,26 @@ class FormTestCase(unittest.TestCase):
         self.db.user.set('1', roles='')
         self.assert_(not item.hasRole(''))
 
+    def testSessionExpiry(self):
+        sessions = self.db.getSessionManager()
+        sessions.set('a', user='admin')
+        sessions.set('b', user='admin')
+        self.db.commit()
+        # everything counts as expired
+        sessions.lifetime = -1200
+        cl = self._make_client({})
+        self.instance.config.WEB_SESSION_EXPIRY = 'admin'
+        cl.clean_up()
+        self.assertEqual(len(sessions.list()), 2)
+        # a batch per request until all are gone
+        self.instance.config.WEB_SESSION_EXPIRY = 'request'
+        self.instance.config.WEB_SESSION_EXPIRY_BATCH_SIZE = 1
+        otks = self.db.getOTKManager()
+        for remaining, done in (1, False), (0, False), (0, True):
+            cl.clean_up()
+            self.assertEqual(len(sessions.list()), remaining)
+            self.assertEqual(otks.exists('last_clean'), done)
+
     def testCSVExport(self):
         cl = self._make_client({'@columns': 'id,name'}, nodeid=None,
             userid='1')
@@ -957,6 +977,99 @@ class FormTestCase(unittest.TestCase):
             '8,resolved\r\n',
             output.getvalue())
 
+    def testCSVExportLinks(self):
+        self.db.issue.create(title='spam', status='2', nosy=['3', '4'],
+            assignedto='3')
+        self.db.issue.create(title='eggs', status='1', nosy=[])
+        self.db.issue.create(title='ham, bacon', nosy=['4'])
+        cl = self._make_client({'@columns': 'id,title,status,nosy,assignedto',
+            '@sort': 'id'}, nodeid=None, userid='1')
+        cl.classname = 'issue'
+        output = StringIO.StringIO()
+        cl.request = MockNull()
+        cl.request.wfile = output
+        action = actions.ExportCSVAction(cl)
+        # stream the rows a couple of items at a time
+        action.chunk_size = 2
+        action.flush_size = 1
+        action.handle()
+        self.assertEquals('id,title,status,nosy,assignedto\r\n'
+            '1,spam,deferred,Chef;mary,Chef\r\n'
+            '2,eggs,unread,,\r\n'
+            '3,"ham, bacon",unread,mary,\r\n',
+            output.getvalue())
+
+    def testCSVExportSortMultilink(self):
+        self.db.issue.create(title='spam', nosy=['4'])
+        self.db.issue.create(title='eggs', nosy=['3', '4'])
+        self.db.issue.create(title='ham', nosy=[])
+        # filter_iter can't sort by Multilinks
+        def filter_iter(*args, **kw):
+            raise AssertionError('filter_iter used')
+        self.db.issue.filter_iter = filter_iter
+        try:
+            cl = self._make_client({'@columns': 'id', '@sort': 'nosy'},
+                nodeid=None, userid='1')
+            cl.classname = 'issue'
+            output = StringIO.StringIO()
+            cl.request = MockNull()
+            cl.request.wfile = output
+            actions.ExportCSVAction(cl).handle()
+        finally:
+            del self.db.issue.filter_iter
+        ids = self.db.issue.filter(None, {}, [('+', 'nosy')])
+        self.assertEquals(output.getvalue(), 'id\r\n%s\r\n'
+            % '\r\n'.join(ids))
+
+    def testCSVExportCheckPermission(self):
+        # mary may only view her own address
+        form = {'@columns': 'id,username,address', '@filter': 'username',
+            'username': 'mary'}
+        cl = self._make_client(form, nodeid=None, userid='4')
+        cl.classname = 'user'
+        output = StringIO.StringIO()
+        cl.request = MockNull()
+        cl.request.wfile = output
+        actions.ExportCSVAction(cl).handle()
+        self.assertEquals('id,username,address\r\n4,mary,mary@test.test\r\n',
+            output.getvalue())
+        del form['@filter']
+        cl = self._make_client(form, nodeid=None, userid='4')
+        cl.classname = 'user'
+        cl.request = MockNull()
+        cl.request.wfile = StringIO.StringIO()
+        self.assertRaises(exceptions.Unauthorised,
+            actions.ExportCSVAction(cl).handle)
+
+    def testCSVExportCompressed(self):
+        cl = self._make_client({'@columns': 'id,name'}, nodeid=None,
+            userid='1')
+        cl.classname = 'status'
+        cl.env['HTTP_ACCEPT_ENCODING'] = 'deflate, gzip'
+        output = StringIO.StringIO()
+        cl.request = MockNull()
+        cl.request.wfile = output
+        action = actions.ExportCSVAction(cl)
+        action.chunk_size = 3
+        action.flush_size = 1
+        action.handle()
+        cl.finish_compression()
+        self.assert_(cl.request.wfile is output)
+        self.assertEqual(cl.additional_headers['Content-Encoding'], 'gzip')
+        self.assertEqual(cl.additional_headers['Vary'], 'Accept-Encoding')
+        self.assertEquals('id,name\r\n1,unread\r\n2,deferred\r\n'
+            '3,chatting\r\n4,need-eg\r\n5,in-progress\r\n6,testing\r\n'
+            '7,done-cbb\r\n8,resolved\r\n', gunzip(output.getvalue()))
+
+    def testAcceptsGzip(self):
+        cl = self._make_client({})
+        for accept, result in (('', False), ('gzip', True),
+                ('deflate, gzip;q=0.5', True), ('gzip;q=0, *', False),
+                ('*', True), ('identity, *;q=0', False),
+                ('x-gzip', True)):
+            cl.env['HTTP_ACCEPT_ENCODING'] = accept
+            self.assertEqual(cl.accepts_gzip(), result, accept)
+
     def testCSVExportBadColumnName(self):
         cl = self._make_client({'@columns': 'falseid,name'}, nodeid=None,
             userid='1')
@@ -980,6 +1093,248 @@ class FormTestCase(unittest.TestCase):
             actions.ExportCSVAction(cl).handle)
 
 
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+class WsgiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = '_test_cgi_wsgi'
+        db_test_base.setupTracker(self.dirname, 'sqlite')
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError, error:
+            if error.errno not in (errno.ENOENT, errno.ESRCH): raise
+
+    def testTrackerCached(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        dispatcher = RequestDispatcher(self.dirname)
+        tracker = dispatcher.get_tracker()
+        self.assert_(dispatcher.get_tracker() is tracker)
+        db = tracker.open('anonymous')
+        try:
+            self.assertEqual(db.getuid(), db.user.lookup('anonymous'))
+            db.user.set(db.getuid(), realname='changed')
+            # the Client releases the database after each request
+            tracker.release_db(db)
+            self.assert_(tracker.open('admin') is db)
+            self.assertEqual(db.getuid(), '1')
+            self.assertEqual(db.user.get(db.user.lookup('anonymous'),
+                'realname'), None)
+            # a failed request doesn't leave its database for the next
+            tracker.release_db(db, True)
+            other = tracker.open('admin')
+            self.assert_(other is not db)
+            # nor does a failed rollback
+            def rollback():
+                raise hyperdb.DatabaseError('connection lost')
+            other.rollback = rollback
+            self.assertRaises(hyperdb.DatabaseError,
+                tracker.release_db, other)
+            self.assert_(tracker.open('admin') is not other)
+        finally:
+            tracker.close()
+
+    def testDebugReload(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        dispatcher = RequestDispatcher(self.dirname, debug=True)
+        tracker = dispatcher.get_tracker()
+        self.assert_(dispatcher.get_tracker() is tracker)
+        config = os.path.join(self.dirname, 'config.ini')
+        mtime = os.stat(config).st_mtime + 10
+        os.utime(config, (mtime, mtime))
+        self.assert_(dispatcher.get_tracker() is not tracker)
+
+    def serve(self, dispatcher, path, **env):
+        from wsgiref.util import setup_testing_defaults
+        from wsgiref.util import FileWrapper
+        setup_testing_defaults(env)
+        env.setdefault('wsgi.file_wrapper', FileWrapper)
+        env['PATH_INFO'] = path
+        env['SCRIPT_NAME'] = ''
+        status = []
+        def start_response(response, headers):
+            status.append(response)
+            status.append(dict(headers))
+            return output.write
+        output = StringIO.StringIO()
+        for data in dispatcher(env, start_response):
+            output.write(data)
+        return status[0], status[1], output.getvalue()
+
+    def testServeFile(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        dispatcher = RequestDispatcher(self.dirname)
+        tracker = dispatcher.get_tracker()
+        content = ''.join([chr(i % 256) for i in range(200000)])
+        db = tracker.open('admin')
+        try:
+            db.file.create(name='big.bin', type='image/png',
+                content=content)
+            db.commit()
+        finally:
+            tracker.close()
+        chunk_size = client.Client.FILE_CHUNK_SIZE
+        client.Client.FILE_CHUNK_SIZE = 1000
+        try:
+            status, headers, body = self.serve(dispatcher, '/file1/big.bin')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(headers['Content-Length'], '200000')
+            self.assertEqual(body, content)
+            status, headers, body = self.serve(dispatcher, '/file1/big.bin',
+                HTTP_RANGE='bytes=1000-2999')
+            self.assertEqual(status, '206 Partial Content')
+            self.assertEqual(body, content[1000:3000])
+            self.assertEqual(headers['Content-Range'],
+                'bytes 1000-2999/200000')
+            # the same without the server's file_wrapper
+            status, headers, body = self.serve(dispatcher, '/file1/big.bin',
+                HTTP_RANGE='bytes=1000-2999', **{'wsgi.file_wrapper': None})
+            self.assertEqual(body, content[1000:3000])
+            # a request without sendfile, as from roundup_server
+            class Request:
+                wfile = StringIO.StringIO()
+                def start_response(self, headers, response):
+                    self.response = response
+            request = Request()
+            env = {'PATH_INFO': 'file1/big.bin', 'REQUEST_METHOD': 'GET',
+                'HTTP_RANGE': 'bytes=10-', 'HTTP_HOST': 'localhost',
+                'TRACKER_NAME': 'test'}
+            cl = tracker.Client(tracker, request, env, makeForm({}))
+            cl.main()
+            self.assertEqual(request.response, 206)
+            self.assertEqual(request.wfile.getvalue(), content[10:])
+        finally:
+            client.Client.FILE_CHUNK_SIZE = chunk_size
+            tracker.close()
+
+    def testCompression(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        dispatcher = RequestDispatcher(self.dirname)
+        tracker = dispatcher.get_tracker()
+        try:
+            status, headers, body = self.serve(dispatcher, '/issue')
+            self.assert_('Content-Encoding' not in headers)
+            self.assertEqual(headers['Vary'], 'Accept-Encoding')
+            page = body
+            status, headers, body = self.serve(dispatcher, '/issue',
+                HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assert_(len(body) < len(page))
+            self.assertEqual(gunzip(body), page)
+
+            # small responses are sent as they are
+            tracker.config.WEB_COMPRESSION_MIN_SIZE = len(page) * 2
+            status, headers, body = self.serve(dispatcher, '/issue',
+                HTTP_ACCEPT_ENCODING='gzip')
+            self.assert_('Content-Encoding' not in headers)
+            self.assert_('Vary' not in headers)
+            tracker.config.WEB_COMPRESSION_MIN_SIZE = 1024
+
+            # static files are compressed as they are sent unless a
+            # range is asked for
+            path = '/@@file/style.css'
+            css = open(os.path.join(self.dirname, 'html',
+                'style.css'), 'rb').read()
+            status, headers, body = self.serve(dispatcher, path)
+            etag = headers['ETag']
+            self.assertEqual(body, css)
+            status, headers, body = self.serve(dispatcher, path,
+                HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(headers['ETag'], etag[:-1] + '-gzip"')
+            self.assert_('Accept-Ranges' not in headers)
+            self.assertEqual(gunzip(body), css)
+            status, headers, body = self.serve(dispatcher, path,
+                HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+            self.assertEqual(status, '206 Partial Content')
+            self.assert_('Content-Encoding' not in headers)
+            self.assertEqual(body, css[:10])
+
+            # and precompressed copies are served as they are
+            gz = os.path.join(self.dirname, 'html',
+                'style.css.gz')
+            f = gzip.GzipFile(gz, 'wb')
+            f.write(css)
+            f.close()
+            compressed = open(gz, 'rb').read()
+            status, headers, body = self.serve(dispatcher, path,
+                HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(headers['Content-Length'], str(len(compressed)))
+            self.assertEqual(headers['Accept-Ranges'], 'bytes')
+            self.assert_(headers['ETag'] not in (etag, etag[:-1] + '-gzip"'))
+            self.assertEqual(body, compressed)
+            status, headers, body = self.serve(dispatcher, path,
+                HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+            self.assertEqual(status, '206 Partial Content')
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(body, compressed[:10])
+            status, headers, body = self.serve(dispatcher, path)
+            self.assert_('Content-Encoding' not in headers)
+            self.assertEqual(headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(body, css)
+        finally:
+            tracker.close()
+
+    def testStreamTemplates(self):
+        from roundup.cgi.wsgi_handler import RequestDispatcher
+        dispatcher = RequestDispatcher(self.dirname)
+        tracker = dispatcher.get_tracker()
+        f = open(os.path.join(self.dirname, 'html', 'issue.broken.html'), 'w')
+        f.write('<html><body><p>%s</p>'
+            '<p tal:content="python:1/0"></p></body></html>' % ('x' * 500))
+        f.close()
+        tracker.config.WEB_DEBUG = 1
+        chunk_size = client.Client.STREAM_CHUNK_SIZE
+        client.Client.STREAM_CHUNK_SIZE = 100
+        try:
+            status, headers, page = self.serve(dispatcher, '/issue')
+            tracker.config.WEB_STREAM_TEMPLATES = 1
+            status, headers, body = self.serve(dispatcher, '/issue')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(body, page)
+            status, headers, body = self.serve(dispatcher, '/issue',
+                HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gunzip(body), page)
+
+            # the page is sent a piece at a time
+            class Request:
+                def __init__(self):
+                    self.writes = []
+                    self.wfile = self
+                def write(self, data):
+                    self.writes.append(data)
+                def start_response(self, headers, response):
+                    self.headers = dict(headers)
+                    self.response = response
+            request = Request()
+            env = {'PATH_INFO': 'issue', 'REQUEST_METHOD': 'GET',
+                'HTTP_HOST': 'localhost', 'TRACKER_NAME': 'test',
+                'QUERY_STRING': ''}
+            tracker.Client(tracker, request, env, makeForm({})).main()
+            self.assertEqual(''.join(request.writes), page)
+            self.assert_(len(request.writes) > 1)
+            self.assert_('Content-Length' not in request.headers)
+
+            # an error found after the first piece is sent ends the page
+            status, headers, body = self.serve(dispatcher, '/issue',
+                QUERY_STRING='@template=broken')
+            self.assertEqual(status, '200 OK')
+            self.assert_(body.startswith('<html><body><p>xxx'))
+            self.assert_('ZeroDivisionError' in body)
+            # and one found before is reported as usual
+            client.Client.STREAM_CHUNK_SIZE = 1000
+            status, headers, body = self.serve(dispatcher, '/issue',
+                QUERY_STRING='@template=broken')
+            self.assert_(not body.startswith('<html><body><p>xxx'))
+            self.assert_('ZeroDivisionError' in body)
+        finally:
+            client.Client.STREAM_CHUNK_SIZE = chunk_size
+            tracker.close()
+
 def test_suite():
     suite = unittest.TestSuite()
 
@@ -987,6 +1342,7 @@ def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(FormTestCase))
     suite.addTest(unittest.makeSuite(MessageTestCase))
+    suite.addTest(unittest.makeSuite(WsgiTestCase))
     return suite
 
 if __name__ == '__main__':
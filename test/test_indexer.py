@@ -130,6 +130,41 @@ class IndexerTest(unittest.TestCase):
             self.assertSeqEqual(self.dex.find([k]),
                 [('test', '1', 'a'), ('test', '2', 'a')])
 
+    def test_ranking(self):
+        """Test scoring by term frequency and text length."""
+        self.dex.add_text(('test', '1', 'a'), 'spam eggs')
+        self.dex.add_text(('test', '2', 'a'), 'spam spam spam eggs')
+        self.dex.add_text(('test', '3', 'a'), 'spam eggs ham bacon beans '
+            'toast tomato mushroom sausage')
+        self.dex.add_text(('test', '4', 'a'), 'eggs')
+        hits = self.dex.getScoredHits(['SPAM'], [])
+        self.assertEqual(sorted(hits), [('test', '1', 'a'),
+            ('test', '2', 'a'), ('test', '3', 'a')])
+        # more occurrences rank higher, longer texts lower
+        self.assert_(hits[('test', '2', 'a')] > hits[('test', '1', 'a')])
+        self.assert_(hits[('test', '1', 'a')] > hits[('test', '3', 'a')])
+        self.assertEqual(self.dex.getScoredHits(['SPAM', 'HAM'], []).keys(),
+            [('test', '3', 'a')])
+
+    def test_prefix(self):
+        """Test prefix searches."""
+        self.dex.add_text(('test', '1', 'a'), 'spamalot')
+        self.dex.add_text(('test', '2', 'a'), 'spam eggs')
+        self.dex.add_text(('test', '3', 'a'), 'sparrow eggs')
+        self.assertEqual(sorted(self.dex.getScoredHits([], ['SPAM'])),
+            [('test', '1', 'a'), ('test', '2', 'a')])
+        self.assertEqual(sorted(self.dex.getScoredHits(['EGGS'], ['SPA'])),
+            [('test', '2', 'a'), ('test', '3', 'a')])
+        self.assertEqual(self.dex.getScoredHits([], ['SPUD']), {})
+
+    def test_parse_query(self):
+        parse = self.dex.parse_query
+        self.assertEqual(parse('Hello the wor* "big bad world" x'),
+            (['BIG', 'BAD', 'WORLD', 'HELLO'], ['WOR'],
+             [['BIG', 'BAD', 'WORLD']]))
+        self.assertEqual(parse('"single" "un closed'),
+            (['SINGLE', 'UN', 'CLOSED'], [], []))
+
     def test_manyresults(self):
         """Test if searches find many results."""
         for i in range(123):
@@ -148,6 +183,73 @@ class XapianIndexerTest(IndexerTest):
         self.dex = Indexer(db)
     def tearDown(self):
         shutil.rmtree('test-index')
+    # xapian does its own ranking
+    def test_ranking(self):
+        pass
+    def test_prefix(self):
+        pass
+
+class MmapIndexerTest(IndexerTest):
+    def setUp(self):
+        if os.path.exists('test-index'):
+            shutil.rmtree('test-index')
+        os.mkdir('test-index')
+        from roundup.backends.indexer_mmap import Indexer
+        self.dex = Indexer(db)
+
+    def reopen(self):
+        from roundup.backends.indexer_mmap import Indexer
+        self.dex.close()
+        self.dex = Indexer(db)
+
+    def test_save(self):
+        self.assert_(self.dex.should_reindex())
+        self.dex.add_text(('test', '1', 'foo'), 'a the hello world')
+        self.dex.add_text(('test', '2', 'foo'), 'blah blah the world')
+        self.dex.save_index()
+        self.reopen()
+        self.failIf(self.dex.should_reindex())
+        self.assertSeqEqual(self.dex.find(['world']), [('test', '1', 'foo'),
+                                                    ('test', '2', 'foo')])
+        # uncommitted changes are visible but go away on rollback
+        self.dex.add_text(('test', '1', 'foo'), 'blah')
+        self.assertSeqEqual(self.dex.find(['world']), [('test', '2', 'foo')])
+        self.assertSeqEqual(self.dex.find(['blah']), [('test', '1', 'foo'),
+                                                    ('test', '2', 'foo')])
+        self.dex.rollback()
+        self.assertSeqEqual(self.dex.find(['world']), [('test', '1', 'foo'),
+                                                    ('test', '2', 'foo')])
+        # committed changes replace the previous text
+        self.dex.add_text(('test', '1', 'foo'), 'blah')
+        self.dex.add_text(('test', '2', 'foo'), '')
+        self.dex.save_index()
+        self.reopen()
+        self.assertSeqEqual(self.dex.find(['world']), [])
+        self.assertSeqEqual(self.dex.find(['blah']), [('test', '1', 'foo')])
+
+    def test_merge(self):
+        self.dex.merge_factor = 3
+        for i in range(10):
+            self.dex.add_text(('test', str(i), 'foo'), 'hello world n%d'%i)
+            self.dex.add_text(('test', str(i + 1), 'foo'), 'hello n%d'%i)
+            self.dex.save_index()
+            self.assert_(len(self.dex.read_manifest()['segments']) <= 3)
+        self.assertSeqEqual(self.dex.find(['world']),
+            [('test', str(i), 'foo') for i in range(10)])
+        self.assertEqual(len(self.dex.find(['hello'])), 11)
+        self.assertSeqEqual(self.dex.find(['hello', 'n9']),
+            [('test', '10', 'foo'), ('test', '9', 'foo')])
+        self.reopen()
+        self.dex.merge_factor = 3
+        self.dex.merge()
+        self.assertEqual(len(self.dex.read_manifest()['segments']), 1)
+        self.assertEqual(len(self.dex.find(['hello'])), 11)
+        self.assertSeqEqual(self.dex.find(['world', 'n5']),
+            [('test', '5', 'foo')])
+
+    def tearDown(self):
+        self.dex.close()
+        shutil.rmtree('test-index')
 
 class RDBMSIndexerTest(IndexerTest):
     def setUp(self):
@@ -162,6 +264,16 @@ class RDBMSIndexerTest(IndexerTest):
         if os.path.exists(config.DATABASE):
             shutil.rmtree(config.DATABASE)
 
+    def test_ranking(self):
+        # no term frequencies: all hits of a query score the same
+        self.dex.add_text(('test', '1', 'a'), 'spam eggs')
+        self.dex.add_text(('test', '2', 'a'), 'spam spam spam eggs')
+        self.dex.add_text(('test', '3', 'a'), 'eggs')
+        hits = self.dex.getScoredHits(['SPAM'], [])
+        self.assertEqual(sorted(hits), [('test', '1', 'a'),
+            ('test', '2', 'a')])
+        self.assertEqual(hits[('test', '1', 'a')], hits[('test', '2', 'a')])
+
 class postgresqlIndexerTest(postgresqlOpener, RDBMSIndexerTest):
     def setUp(self):
         postgresqlOpener.setUp(self)
@@ -185,6 +297,7 @@ def test_suite():
     suite = unittest.TestSuite()
 
     suite.addTest(unittest.makeSuite(IndexerTest))
+    suite.addTest(unittest.makeSuite(MmapIndexerTest))
 
     try:
         import xapian
@@ -0,0 +1,127 @@
+import os, shutil, errno, sys, unittest, StringIO
+
+from roundup import profiler
+from roundup.admin import AdminTool
+from roundup.anypy.json_ import json
+
+import db_test_base
+
+class NormaliseTestCase(unittest.TestCase):
+    def testNormalise(self):
+        n = profiler.normalise_sql
+        self.assertEqual(n('select _name from _user\n  where id=%s'),
+            'select _name from _user where id=?')
+        self.assertEqual(n("select id from _issue where _title='a''b'"
+            " and _priority in (1,2, 3) limit 50"),
+            'select id from _issue where _title=? and _priority in (?...)'
+            ' limit ?')
+        self.assertEqual(n('select id from _issue where id in (?,?)'),
+            n('select id from _issue where id in (%s,%s,%s)'))
+
+    def testSummarise(self):
+        lines = [
+            profiler.dumps({'page': 'issue.index', 'elapsed': 1.0,
+                'sql_count': 3, 'sql_time': 0.5,
+                'sql': [['select ?', 3, 0.5]]}),
+            profiler.dumps({'page': 'issue.index', 'elapsed': 2.0,
+                'sql_count': 1, 'sql_time': 0.1,
+                'sql': [['select ?', 1, 0.1]]}),
+            'not json\n',
+            profiler.dumps({'page': 'home', 'elapsed': 0.5,
+                'sql_count': 2, 'sql_time': 0.2,
+                'sql': [['select ?', 1, 0.1], ['update ?', 1, 0.1]]}),
+        ]
+        pages, statements = profiler.summarise(lines)
+        self.assertEqual(pages, [('issue.index', 2, 3.0, 4, 0.6),
+            ('home', 1, 0.5, 2, 0.2)])
+        self.assertEqual([s[:2] for s in statements], [('select ?', 5),
+            ('update ?', 1)])
+        pages, statements = profiler.summarise(lines, limit=1)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(len(statements), 1)
+
+class ProfileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = '_test_profiler'
+        self.tracker = db_test_base.setupTracker(self.dirname, 'sqlite')
+
+    def tearDown(self):
+        try:
+            shutil.rmtree(self.dirname)
+        except OSError, error:
+            if error.errno not in (errno.ENOENT, errno.ESRCH): raise
+
+    def testProfile(self):
+        db = self.tracker.open('admin')
+        try:
+            db.issue.create(title='spam')
+            db.commit()
+            profile = profiler.Profile()
+            profile.attach(db)
+            self.assert_(db.profile is profile)
+            db.issue.get('1', 'title')
+            db.issue.get('1', 'title')
+            report = profile.report()
+            self.assertEqual(report['cache_hits'], 1)
+            self.assertEqual(report['cache_misses'], 1)
+            self.assertEqual(report['cache_ratio'], 0.5)
+            self.assertEqual(report['sql_count'], 1)
+            self.assertEqual(report['permission_checks'], 0)
+            db.security.hasPermission('View', '1', 'issue')
+            report = profile.report()
+            self.assertEqual(report['permission_checks'], 1)
+            profile.detach()
+            self.assertEqual(db.profile, None)
+            db.issue.filter(None, {'title': 'spam'})
+            self.assertEqual(profile.report()['sql_count'],
+                report['sql_count'])
+        finally:
+            db.close()
+
+    def testClient(self):
+        self.tracker.config.WEB_PROFILE = 1
+        self.tracker.config.WEB_PROFILE_LOG = 'profile.log'
+        self.tracker.config.save()
+        class Request:
+            rfile = StringIO.StringIO()
+            wfile = StringIO.StringIO()
+            def start_response(self, headers, response):
+                pass
+        for i in range(2):
+            env = {'PATH_INFO': 'issue', 'REQUEST_METHOD': 'GET',
+                'HTTP_HOST': 'localhost', 'TRACKER_NAME': 'test',
+                'QUERY_STRING': ''}
+            cl = self.tracker.Client(self.tracker, Request(), env)
+            cl.main()
+        lines = open(os.path.join(self.dirname, 'profile.log')).readlines()
+        self.assertEqual(len(lines), 2)
+        report = json.loads(lines[0])
+        self.assertEqual(report['page'], 'issue.index')
+        self.assertEqual(report['status'], 200)
+        self.assert_(report['sql_count'] > 0)
+        self.assert_(report['permission_checks'] > 0)
+        names = [name for name, count, seconds in report['templates']]
+        self.assert_('issue.index' in names)
+        self.assert_([name for name in names if name.startswith('macro ')])
+
+        # and the report of roundup-admin
+        stdout, argv = sys.stdout, sys.argv
+        sys.stdout = out = StringIO.StringIO()
+        sys.argv = ['roundup-admin', '-i', self.dirname, 'profile', '5']
+        try:
+            AdminTool().main()
+        finally:
+            sys.stdout, sys.argv = stdout, argv
+        out = out.getvalue()
+        self.assert_('issue.index' in out)
+        self.assert_('select' in out)
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(NormaliseTestCase))
+    suite.addTest(unittest.makeSuite(ProfileTestCase))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    unittest.main(testRunner=runner)
@@ -0,0 +1,271 @@
+#
+# This module is free software, and you may redistribute it and/or modify
+# under the same terms as Python, so long as this copyright message and
+# disclaimer are retained in their original form.
+#
+# This module is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+
+import unittest, socket, sys, threading, httplib, StringIO, BaseHTTPServer
+
+from roundup.cgi import client
+from roundup.scripts import roundup_server
+
+class Handler(roundup_server.RoundupRequestHandler):
+    """Answer requests with canned responses chosen by the path."""
+    protocol_version = 'HTTP/1.1'
+
+    def inner_run_cgi(self):
+        if self.path == '/missing':
+            raise client.NotFound
+        if self.path == '/fail':
+            raise ValueError, 'before the response'
+        if self.path == '/notmodified':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if self.path == '/length':
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write('hello')
+            return
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        self.wfile.write('hello')
+        self.wfile.write(' world')
+        if self.path == '/broken':
+            raise ValueError, 'after the response started'
+
+    def log_message(self, format, *args):
+        self.server.messages.append(format % args)
+
+class Server:
+    """Just enough of a server for a handler run outside of one."""
+    def __init__(self):
+        self.messages = []
+
+class FakeSocket:
+    """Hand all the responses the same file to read from."""
+    def __init__(self, data):
+        self.file = StringIO.StringIO(data)
+    def makefile(self, *args):
+        return self
+    def readline(self, *args):
+        return self.file.readline(*args)
+    def read(self, *args):
+        return self.file.read(*args)
+    def close(self):
+        pass
+
+class RequestHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = Server()
+        self.output = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.output
+
+    def handle(self, requests, handler=Handler, close=True):
+        """Send the requests over a connection to a handler and return
+        all it writes back.
+
+        If close is false the connection is left open after the
+        requests have been sent.
+        """
+        listener = socket.socket()
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            client_end = socket.create_connection(listener.getsockname())
+            server_end, address = listener.accept()
+        finally:
+            listener.close()
+        try:
+            client_end.sendall(requests)
+            if close:
+                client_end.shutdown(socket.SHUT_WR)
+            handler(server_end, address, self.server)
+            server_end.close()
+            data = []
+            while 1:
+                s = client_end.recv(4096)
+                if not s:
+                    break
+                data.append(s)
+            return ''.join(data)
+        finally:
+            server_end.close()
+            client_end.close()
+
+    def parse(self, data, *methods):
+        """Parse one response for each of the request methods."""
+        sock = FakeSocket(data)
+        responses = []
+        for method in methods:
+            response = httplib.HTTPResponse(sock, method=method)
+            response.begin()
+            response.body = response.read()
+            responses.append(response)
+        self.assertEqual(sock.file.read(), '')
+        return responses
+
+    def testChunked(self):
+        data = self.handle('GET /stream HTTP/1.1\r\nHost: x\r\n\r\n')
+        head, body = data.split('\r\n\r\n', 1)
+        self.assert_('Transfer-Encoding: chunked' in head)
+        self.assert_('Connection' not in head)
+        self.assertEqual(body, '5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n')
+        [response] = self.parse(data, 'GET')
+        self.assertEqual(response.body, 'hello world')
+
+    def testContentLength(self):
+        data = self.handle('GET /length HTTP/1.1\r\nHost: x\r\n\r\n')
+        self.assert_('Transfer-Encoding' not in data)
+        [response] = self.parse(data, 'GET')
+        self.assertEqual(response.getheader('content-length'), '5')
+        self.assertEqual(response.body, 'hello')
+
+    def testKeepAlive(self):
+        request = 'GET %s HTTP/1.1\r\nHost: x\r\n\r\n'
+        data = self.handle(request % '/stream' + request % '/length'
+            + request % '/stream')
+        responses = self.parse(data, 'GET', 'GET', 'GET')
+        self.assertEqual([r.body for r in responses],
+            ['hello world', 'hello', 'hello world'])
+        self.assertEqual([r.will_close for r in responses],
+            [False, False, False])
+        # the client going away isn't an error
+        self.assertEqual(len(self.server.messages), 3)
+
+    def testKeepAliveTimeout(self):
+        class TimeoutHandler(Handler):
+            KEEP_ALIVE_TIMEOUT = 0.1
+        data = self.handle('GET /length HTTP/1.1\r\nHost: x\r\n\r\n',
+            TimeoutHandler, close=False)
+        [response] = self.parse(data, 'GET')
+        self.assertEqual(response.body, 'hello')
+        self.assertEqual(len(self.server.messages), 1)
+
+    def testConnectionClose(self):
+        data = self.handle('GET /stream HTTP/1.1\r\nHost: x\r\n'
+            'Connection: close\r\n\r\n'
+            'GET /length HTTP/1.1\r\nHost: x\r\n\r\n')
+        [response] = self.parse(data, 'GET')
+        self.assertEqual(response.getheader('connection'), 'close')
+        self.assertEqual(response.getheader('transfer-encoding'), None)
+        self.assertEqual(response.body, 'hello world')
+
+    def testHTTP10(self):
+        # a HTTP/1.0 client can't read a chunked body
+        data = self.handle('GET /length HTTP/1.0\r\n'
+            'Connection: keep-alive\r\n\r\n'
+            'GET /stream HTTP/1.0\r\nConnection: keep-alive\r\n\r\n'
+            'GET /length HTTP/1.0\r\n\r\n')
+        first, second = self.parse(data, 'GET', 'GET')
+        self.assertEqual(first.getheader('connection'), 'keep-alive')
+        self.assertEqual(first.body, 'hello')
+        self.assertEqual(second.getheader('connection'), 'close')
+        self.assertEqual(second.getheader('transfer-encoding'), None)
+        self.assertEqual(second.body, 'hello world')
+
+    def testRequestBody(self):
+        # the handler leaves request bodies unread
+        data = self.handle('POST /length HTTP/1.1\r\nHost: x\r\n'
+            'Content-Length: 3\r\n\r\nabc'
+            'GET /length HTTP/1.1\r\nHost: x\r\n\r\n')
+        [response] = self.parse(data, 'POST')
+        self.assertEqual(response.getheader('connection'), 'close')
+
+    def testNoBody(self):
+        request = '%s %s HTTP/1.1\r\nHost: x\r\n\r\n'
+        data = self.handle(request % ('HEAD', '/stream')
+            + request % ('HEAD', '/length')
+            + request % ('GET', '/notmodified')
+            + request % ('GET', '/length'))
+        self.assert_('chunked' not in data)
+        self.assert_('0\r\n\r\n' not in data)
+        responses = self.parse(data, 'HEAD', 'HEAD', 'GET', 'GET')
+        self.assertEqual([r.status for r in responses],
+            [200, 200, 304, 200])
+        self.assertEqual([r.body for r in responses], ['', '', '', 'hello'])
+        self.assertEqual(responses[1].getheader('content-length'), '5')
+
+    def testErrors(self):
+        request = 'GET %s HTTP/1.1\r\nHost: x\r\n\r\n'
+        data = self.handle(request % '/missing' + request % '/length')
+        [response] = self.parse(data, 'GET')
+        self.assertEqual(response.status, 404)
+        # an unexpected error closes the connection
+        data = self.handle(request % '/fail' + request % '/length')
+        [response] = self.parse(data, 'GET')
+        self.assertEqual(response.status, 400)
+        self.assertEqual(response.getheader('connection'), 'close')
+        self.assert_('ValueError' in sys.stdout.getvalue())
+
+    def testErrorAfterResponseStarted(self):
+        request = 'GET %s HTTP/1.1\r\nHost: x\r\n\r\n'
+        data = self.handle(request % '/broken' + request % '/length')
+        head, body = data.split('\r\n\r\n', 1)
+        self.assert_(head.startswith('HTTP/1.1 200 '))
+        # the body is cut off without its last chunk or an error page
+        self.assertEqual(body, '5\r\nhello\r\n6\r\n world\r\n')
+        self.assert_('ValueError' in sys.stdout.getvalue())
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.output = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.output
+
+    def testServeWorker(self):
+        class PoolServer(roundup_server.WorkerPoolMixIn,
+                BaseHTTPServer.HTTPServer):
+            threads = 2
+            max_requests = 4
+        server = PoolServer(('127.0.0.1', 0), Handler)
+        server.messages = []
+        try:
+            worker = threading.Thread(target=server.serve_worker)
+            worker.setDaemon(True)
+            worker.start()
+            bodies = []
+            for i in range(server.max_requests):
+                connection = httplib.HTTPConnection('127.0.0.1',
+                    server.server_port)
+                # two requests over the same connection
+                for path in ('/length', '/stream'):
+                    connection.request('GET', path)
+                    bodies.append(connection.getresponse().read())
+                connection.close()
+            # the worker exits after max_requests connections
+            worker.join(10)
+            self.assert_(not worker.isAlive())
+        finally:
+            server.server_close()
+        self.assertEqual(bodies, ['hello', 'hello world'] * 4)
+        stats = server.stats()
+        self.assertEqual(stats['connections'], 4)
+        self.assertEqual(stats['busy'], 0)
+        self.assertEqual(stats['queued'], 0)
+        self.assert_(1 <= stats['max_busy'] <= 2)
+        self.assert_('4 connections' in sys.stdout.getvalue())
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RequestHandlerTestCase))
+    suite.addTest(unittest.makeSuite(WorkerPoolTestCase))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    unittest.main(testRunner=runner)
+
+# vim: set filetype=python sts=4 sw=4 et si :
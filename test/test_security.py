@@ -23,6 +23,7 @@ import os, unittest, shutil
 from roundup import backends
 import roundup.password
 from db_test_base import setupSchema, MyTestCase, config
+import memorydb
 
 class PermissionTest(MyTestCase):
     def setUp(self):
@@ -175,6 +176,113 @@ class PermissionTest(MyTestCase):
         self.assertEquals(has('Test', super, 'test', itemid='2'), 1)
         self.assertEquals(has('Test', none, 'test', itemid='1'), 0)
         self.assertEquals(has('Test', none, 'test', itemid='2'), 0)
+        # only permissions without check function
+        skip = lambda userid: has('Test', userid, 'test',
+            skip_permissions_with_check=True)
+        self.assertEquals(skip(user1), 1)
+        self.assertEquals(skip(user3), 0)
+        self.assertEquals(skip(super), 1)
+        self.assertEquals(skip(none), 0)
+
+    def testDecisionCache(self):
+        sec = self.db.security
+        add = sec.addPermission
+        has = sec.hasPermission
+        sec.addRole(name='Role1')
+        sec.addPermissionToRole('Role1', add(name="Test", klass="test"))
+        calls = []
+        def check(db, userid, itemid):
+            calls.append(itemid)
+            return itemid == '1'
+        sec.addRole(name='Role2')
+        sec.addPermissionToRole('Role2', add(name="Test", klass="test",
+            check=check))
+        user = self.db.user.create(username='user', roles='Role2')
+        stats = sec.decision_stats()
+        self.assertEquals((stats['hits'], stats['misses']), (0, 0))
+        self.assertEquals(has('Test', user, 'test', itemid='1'), 1)
+        self.assertEquals(has('Test', user, 'test', itemid='2'), 0)
+        self.assertEquals(has('Test', user, 'test'), 1)
+        # the check function is still called for each item
+        self.assertEquals(calls, ['1', '2'])
+        stats = sec.decision_stats()
+        self.assertEquals((stats['hits'], stats['misses']), (2, 1))
+        self.assertEquals(stats['checks'], 2)
+        # a change of the user's roles is a different cache entry
+        self.db.user.set(user, roles='Role1,Role2')
+        self.assertEquals(has('Test', user, 'test', itemid='2'), 1)
+        self.assertEquals(calls, ['1', '2'])
+        # a change of the roles' permissions clears the cache
+        self.db.user.set(user, roles='Role2')
+        self.assertEquals(has('Test', user, 'test', property='a'), 1)
+        sec.addPermissionToRole('Role2', add(name="Test", klass="test",
+            properties=['b']))
+        self.assertEquals(sec.decision_stats()['entries'], 0)
+        self.assertEquals(has('Test', user, 'test', 'b', itemid='2'), 1)
+        self.assertEquals(has('Test', user, 'test', 'a', itemid='2'), 0)
+        # as does replacing a role's permissions
+        sec.role['role2'].permissions = []
+        self.assertEquals(has('Test', user, 'test', 'b', itemid='2'), 0)
+
+    def testDecisionCacheOtherDatabase(self):
+        # the Security of another database has decisions of its own
+        sec = self.db.security
+        has = sec.hasPermission
+        self.assertEquals(has('Edit', '1', 'issue'), 1)
+        self.assertEquals(has('Edit', '1', 'issue'), 1)
+        stats = sec.decision_stats()
+        db = memorydb.create('admin')
+        try:
+            db.security.addRole(name='Other')
+            self.assertEquals(has('Edit', '1', 'issue'), 1)
+        finally:
+            db.close()
+        self.assertEquals(sec.decision_stats()['hits'], stats['hits'] + 1)
+        self.assertEquals(sec.decision_stats()['misses'], stats['misses'])
+
+    def testFilterItems(self):
+        sec = self.db.security
+        add = sec.addPermission
+        filt = sec.filterItems
+        none = self.db.user.create(username='none', roles='None')
+        sec.addRole(name='Role1')
+        sec.addPermissionToRole('Role1', add(name="Test", klass="test"))
+        user1 = self.db.user.create(username='user1', roles='Role1')
+        calls = []
+        def check(db, userid, itemid):
+            calls.append(itemid)
+            return itemid in ('1', '3')
+        sec.addRole(name='Role2')
+        sec.addPermissionToRole('Role2', add(name="Test", klass="test",
+            check=check))
+        user2 = self.db.user.create(username='user2', roles='Role2')
+        def check3(db, userid, itemid):
+            return int(itemid) > 2
+        def filter(db, userid, itemids):
+            calls.append(itemids)
+            return [id for id in itemids if int(id) > 2]
+        sec.addRole(name='Role3')
+        sec.addPermissionToRole('Role3', add(name="Test", klass="test",
+            check=check3, filter=filter))
+        user3 = self.db.user.create(username='user3', roles='Role3')
+        user4 = self.db.user.create(username='user4', roles='Role2,Role3')
+        ids = ['4', '3', '2', '1']
+        self.assertEquals(filt('Test', user1, 'test', ids), ids)
+        self.assertEquals(filt('Test', none, 'test', ids), [])
+        self.assertEquals(calls, [])
+        self.assertEquals(filt('Test', user2, 'test', ids), ['3', '1'])
+        self.assertEquals(calls, ids)
+        del calls[:]
+        self.assertEquals(filt('Test', user3, 'test', ids), ['4', '3'])
+        self.assertEquals(calls, [ids])
+        del calls[:]
+        # the batch filter only sees the ids not yet allowed
+        self.assertEquals(filt('Test', user4, 'test', ids), ['4', '3', '1'])
+        self.assertEquals(calls, ids + [['4', '2']])
+        for userid in none, user1, user2, user3, user4:
+            self.assertEquals(filt('Test', userid, 'test', ids),
+                [id for id in ids if sec.hasPermission('Test', userid,
+                    'test', itemid=id)])
 
     def testTransitiveSearchPermissions(self):
         add = self.db.security.addPermission
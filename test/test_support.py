@@ -0,0 +1,64 @@
+import unittest
+
+from roundup.support import LRUCache
+
+class LRUCacheTestCase(unittest.TestCase):
+    def testEviction(self):
+        c = LRUCache(3)
+        for k in 'abcd':
+            c[k] = k.upper()
+        self.assertEqual(c.keys(), ['d', 'c', 'b'])
+        self.assert_('a' not in c)
+        self.assertEqual(c.evictions, 1)
+
+    def testGetRefreshes(self):
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c.get('a'), 1)
+        c['c'] = 3
+        self.assertEqual(c.keys(), ['c', 'a'])
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual((c.hits, c.misses), (1, 1))
+
+    def testPeekDoesNotRefresh(self):
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        self.assertEqual(c['a'], 1)
+        self.assert_('a' in c)
+        c['c'] = 3
+        self.assertEqual(c.keys(), ['c', 'b'])
+
+    def testReplaceAndDelete(self):
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        c['a'] = 10
+        self.assertEqual(c.keys(), ['a', 'b'])
+        self.assertEqual(c['a'], 10)
+        del c['a']
+        self.assertEqual(c.pop('b'), 2)
+        self.assertEqual(c.pop('b'), None)
+        self.assertEqual(len(c), 0)
+        self.assertRaises(KeyError, c.__delitem__, 'a')
+
+    def testClearKeepsCounters(self):
+        c = LRUCache(1)
+        c['a'] = 1
+        c['b'] = 2
+        c.get('b')
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.keys(), [])
+        self.assertEqual(c.stats(), {'size': 1, 'entries': 0, 'hits': 1,
+            'misses': 0, 'evictions': 1})
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LRUCacheTestCase))
+    return suite
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner()
+    unittest.main(testRunner=runner)
@@ -181,6 +181,51 @@ class HTMLClassTestCase(TemplatingTestCase) :
             ae(t('http://roundup.net/%c/' % c),
                '<a href="http://roundup.net/%c/">http://roundup.net/%c/</a>' % (c, c))
 
+class BatchTestCase(TemplatingTestCase):
+    class PagingClass:
+        def __init__(self, ids):
+            self.ids = ids
+            self.calls = []
+        def filter(self, search_matches, filterspec, sort=[], group=[],
+                limit=None, offset=None):
+            self.calls.append(('filter', limit, offset))
+            return self.ids[offset:offset + limit]
+        def filter_count(self, search_matches, filterspec):
+            self.calls.append(('count',))
+            return len(self.ids)
+
+    def test_paged_batch(self):
+        ids = [str(i) for i in range(1, 24)]
+        klass = self.PagingClass(ids)
+        seq = PagedFilter(klass, None, {}, [], [], 10)
+        b = Batch(self.client, seq, 10, 10)
+        self.assertEqual(b.sequence_length, 23)
+        self.assertEqual([b[i] for i in range(len(b))], ids[10:20])
+        self.assertEqual(klass.calls, [('count',), ('filter', 10, 10)])
+        self.assertEqual(b.previous().start, 1)
+        n = b.next()
+        self.assertEqual([n[i] for i in range(len(n))], ids[20:])
+        self.assertEqual(n.next(), None)
+        self.assertRaises(IndexError, seq.__getitem__, 23)
+        self.assertEqual(list(seq), ids)
+
+    def test_batch_prefetch(self):
+        prefetched = []
+        def prefetch_multilinks(ids, propnames):
+            prefetched.append((ids, propnames))
+        self.client.db.classes = {'issue':
+            MockNull(prefetch_multilinks=prefetch_multilinks)}
+        ids = [str(i) for i in range(1, 6)]
+        b = Batch(self.client, ids, 2, 2, classname='issue',
+            multilinks=['nosy'])
+        self.assertEqual(prefetched, [(['3', '4'], ['nosy'])])
+
+    def test_batch_list(self):
+        b = Batch(self.client, ['1', '2', '3'], 2, 0)
+        self.assertEqual([b[i] for i in range(len(b))], ['1', '2'])
+        self.assertEqual(b.next()[0], '3')
+        self.assertEqual(b.next().next(), None)
+
 '''
 class HTMLPermissions:
     def is_edit_ok(self):
@@ -355,6 +400,7 @@ def test_suite():
     suite.addTest(unittest.makeSuite(HTMLDatabaseTestCase))
     suite.addTest(unittest.makeSuite(FunctionsTestCase))
     suite.addTest(unittest.makeSuite(HTMLClassTestCase))
+    suite.addTest(unittest.makeSuite(BatchTestCase))
     return suite
 
 if __name__ == '__main__':